@@ -1,8 +1,8 @@
 import streamlit as st
 from ai_helper import BacktestAI
+from backtestcache import BacktestCache
 
-import requests
-import pandas as pd
+from tickers import ticker_reference
 
 st.set_page_config(
     page_title="BacktestAI",
@@ -12,16 +12,18 @@ st.set_page_config(
 # ----------------------------------------------------------------------------
 # ------ Home Page
 
-url = "https://www.sec.gov/files/company_tickers_exchange.json"
-headers = {"User-Agent": "YourName (your@email.com)", "Accept-Encoding": "gzip, deflate"}
-response = requests.get(url, headers=headers)
-response = response.json()["data"]
-
-company_info = pd.DataFrame(response, columns=["CIK", "Company Name", "Ticker", "Exchange"])
-company_info["Info"] = company_info["Ticker"] + " : " + company_info["Company Name"]
+# The SEC ticker list is persisted to disk and held in memory, so reruns do not download it again
+company_info = ticker_reference.companies()
 
 company_dict = dict(zip(company_info.Info, company_info.Ticker))
 
+
+@st.cache_resource
+def backtest_cache():
+    # Shared by every session, so users share the downloaded data and the backtest results
+    return BacktestCache()
+
+
 # ----
 
 with st.sidebar:
@@ -31,25 +33,35 @@ with st.sidebar:
     messages = st.container(height=300)
     if prompt := st.chat_input("What strategy would you like to backtest?"):
         messages.chat_message("user").write(prompt)
+        st.session_state["prompt"] = prompt
+
+    # The last strategy is kept, so changing the company or timeframe backtests it again
+    prompt = st.session_state.get("prompt")
 
 
 # ----
 
 if prompt:
     with st.spinner("Loading..."):
-        gemini_key = st.secrets["gemini_key"]
-        bt = BacktestAI(gemini_key)
-        bt.create_strategy(prompt)
-        results = bt.run_strategy(f"Download {company_dict[company_select]} for the past {timeframe} on a daily interval.")
+        cache = backtest_cache()
+
+        if st.session_state.get("strategy_prompt") != prompt:
+            gemini_key = st.secrets["gemini_key"]
+            bt = BacktestAI(gemini_key, data_helper=cache.data_helper)
+            bt.create_strategy(prompt)
+            st.session_state["backtest_ai"] = bt
+            st.session_state["strategy_prompt"] = prompt
+
+        bt = st.session_state["backtest_ai"]
+        result = cache.run(bt, f"Download {company_dict[company_select]} for the past {timeframe} on a daily interval.",
+                           concurrent=True)
 
-        final_val = results[0].round(0)
-        pct_change = results[1]
-        num_trades = results[2]
-        winrate = results[3]
-        data = results[4]
-        fig = results[5]
+        final_val = result.final_val.round(0)
+        pct_change = result.pct_chg
+        num_trades = result.num_trades
+        winrate = result.win_rate
 
-        st.plotly_chart(fig)
+        st.plotly_chart(result.fig)
 
         strategy_col, bah_col = st.columns(2)
 
@@ -63,15 +75,15 @@ if prompt:
         with bah_col:
             st.write("Buy and Hold Performance")
 
-            final_bah_val = (data["bah_values"].iloc[-1]).round(0)
-            pct_change_bah = ((data["bah_values"].iloc[-1]/data["bah_values"].iloc[0]) - 1)
+            final_bah_val = result.bah_final_val.round(0)
+            pct_change_bah = result.bah_pct_chg
 
             if pct_change_bah < 0:
                 winrate_bah = 0
             else:
                 winrate_bah = 100
 
-            st.metric("Final portfolio value", value=f'${data["bah_values"].iloc[-1]:,.0f}')
+            st.metric("Final portfolio value", value=f'${final_bah_val:,.0f}')
             st.metric("Percentage increase", value=f'{(pct_change_bah * 100):.2f}%')
             st.metric("Number of trades", value=1)
             st.metric("Win rate of trades", value=f'{winrate_bah}%')
@@ -1,28 +1,40 @@
-from google import genai
 from backtest import Backtest
 from datahelper import DataHelper
 from strategy import Strategy
 from indicators import Indicators
-import re
+from instrumentation import Instrumentation
+from llm import CachedClient, GeminiClient, parse_download_request
+import asyncio
 import json
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 
 class BacktestAI:
 
-    def __init__(self, api_key):
+    def __init__(self, api_key=None, client=None, data_helper=DataHelper):
+        """
+        :param api_key: The Gemini API key
+        :param client: Optional LLM client with a generate_json(prompt) method, e.g. a StandInClient. Defaults to Gemini
+        behind a persistent response cache
+        :param data_helper: Function creating the DataHelper of each run, e.g. one with a local OHLCV store
+        """
         self.api_key = api_key
-        self.client = genai.Client(api_key=self.api_key)
+        self.client = client if client is not None else CachedClient(GeminiClient(api_key))
+        self.data_helper = data_helper
         self.strategy = None
         self.indicators = None
         self.data = None
+        self.instrumentation = None
 
     def create_strategy(self, message: str):
 
-        indi_methods = [method for method in dir(Indicators) if not method.startswith("__")]
+        # The batched *_many methods take a list of windows, so they are left out of the prompt
+        indi_methods = [method for method in dir(Indicators)
+                        if not method.startswith("_") and not method.endswith("_many")]
 
-        response = self.client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=(
+        cleaned_json = self.client.generate_json(
+            (
                 f"Please process the following request for stock technical indicators that signal buy and sell signals. "
                 f"Each indicator corresponds to one of these methods in my class: {indi_methods}. "
                 f"Each method, takes one argument which is the number of days used for calculation. "
@@ -31,6 +43,8 @@ class BacktestAI:
                 f"There should be two outputs, the first is a JSON format output that details the indicators used, structured as follows:\n\n"
                 f'[{{"name": name for indicator and arguments, "indicator": corresponding_method, "args": number_of_days}}]\n\n'
                 f"The name of the indicator should reflect the arguments used for it, for example: rsi_20."
+                f"An indicator on a longer interval than the data, such as 1h or 1d, also has "
+                f'"interval": interval and the interval at the end of its name, for example: rsi_14_1d. '
                 f"The second output are the conditions that signal when to buy and sell with the condition "
                 f"parsed and ENSURE that I can use the .eval method (it should consider the name of the indicator"
                 f"and arguments as returned in the first output.  The output should be structured as follows: \n\n"
@@ -41,9 +55,6 @@ class BacktestAI:
             )
         )
 
-        cleaned_json = re.sub(r"```(json)?\n|\n```", "", response.text).strip()
-        cleaned_json = json.loads(cleaned_json)
-
         indicators_json = cleaned_json['indicators']
         signals_json = cleaned_json['signals']
 
@@ -53,54 +64,174 @@ class BacktestAI:
             signal_type = signal['signal_type']
             condition = signal['condition']
 
-            if signal_type == 'buy':
-                strategy.add_buy_signal(condition)
-            elif signal_type == 'sell':
-                strategy.add_sell_signal(condition)
+            try:
+                if signal_type == 'buy':
+                    strategy.add_buy_signal(condition)
+                elif signal_type == 'sell':
+                    strategy.add_sell_signal(condition)
+            except ValueError as e:
+                warnings.warn(f"Skipping the {signal_type} condition: {e}", UserWarning, stacklevel=2)
 
         self.strategy = strategy
         self.indicators = indicators_json
 
-    def run_strategy(self, message: str):
+    def parse_request(self, message: str):
+        """
+        :return dict: The ticker, period and interval of the request
+        """
+        # The structured request built by Home.py is parsed directly, anything else goes to the LLM
+        cleaned_json = parse_download_request(message)
+        if cleaned_json is None:
+            cleaned_json = self.client.generate_json(
+                "Please format the following request into input that will be fed into yfinance Python package"
+                ".history method, i.e. providing a ticker, period and interval. The output should json format of the "
+                "following form: {ticker: str, period: str, interval: str}. If no period or interval is specified, "
+                "please take the period to be 1 year and the interval to be daily:"
+                f"{message}."
+            )
+
+        return cleaned_json
+
+    def strategy_key(self):
+        """
+        :return str: Key identifying the strategy's indicators and conditions, e.g. for caching its results
+        """
+        return json.dumps({"indicators": self.indicators, "buys": self.strategy.buys, "sells": self.strategy.sells},
+                          sort_keys=True)
+
+    def _add_indicators(self, data_class: DataHelper, instrumentation: Instrumentation):
+        for indicator in self.indicators:
+            indicator_name = indicator['name']
+            method_name = indicator['indicator']
+            method_args = indicator['args']
+
+            with instrumentation.stage("add_indicator", indicator=indicator_name, rows=len(data_class.data)):
+                data_class.add_indicator(indicator_name, method_name, method_args, interval=indicator.get('interval'))
+
+    def _warm_indicators(self, data_class: DataHelper):
+        """
+        Computes the strategy's indicators into the indicator cache, so the add_indicator calls made once the earnings
+        dates arrive are cache hits. Errors are left for add_indicator to report. Indicators on another interval are
+        left to add_indicator, which resamples the data.
+        """
+        indicators = data_class.indicators()
+        for indicator in self.indicators:
+            if indicator.get('interval') is not None:
+                continue
+            if not indicator['indicator'].startswith("_") and hasattr(indicators, indicator['indicator']):
+                try:
+                    getattr(indicators, indicator['indicator'])(indicator['args'])
+                except Exception:
+                    pass
+
+    def run_strategy(self, message: str, instrumentation: Instrumentation = None, plot: bool = True,
+                     max_points: int = 2000, concurrent: bool = False):
+        """
+        :param message: The request describing the ticker, period and interval to backtest
+        :param instrumentation: Optional Instrumentation, e.g. with a callback, logger or profile=True. The stages of
+        the run are recorded on it and it is kept in self.instrumentation
+        :param plot: Whether to build the figure, False runs headless
+        :param max_points: The number of points kept from each line of the figure, None to plot every bar
+        :param concurrent: Whether to overlap the data and earnings downloads, see run_strategy_async
+        """
 
         if self.strategy is None:
             print("Please create a strategy to backtest.")
 
+        elif concurrent:
+            return run_coroutine(self.run_strategy_async(message, instrumentation, plot, max_points))
+
         else:
-            response = self.client.models.generate_content(
-                model="gemini-2.0-flash",
-                contents="Please format the following request into input that will be fed into yfinance Python package"
-                         ".history method, i.e. providing a ticker, period and interval. The output should json format of the "
-                         "following form: {ticker: str, period: str, interval: str}. If no period or interval is specified, "
-                         "please take the period to be 1 year and the interval to be daily:"
-                         f"{message}."
-            )
+            instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+            self.instrumentation = instrumentation
 
-            cleaned_json = re.sub(r"```(json)?\n|\n```", "", response.text).strip()
-            cleaned_json = json.loads(cleaned_json)
+            with instrumentation.stage("parse_request"):
+                cleaned_json = self.parse_request(message)
 
             ticker = cleaned_json["ticker"]
             period = cleaned_json["period"]
             interval = cleaned_json["interval"]
 
-            data_class = DataHelper()
-            data_class.load_ydata(ticker, period, interval)
-            data_class.add_next_earnings(ticker)
+            data_class = self.data_helper()
+            with instrumentation.stage("load_ydata", ticker=ticker) as record:
+                data_class.load_ydata(ticker, period, interval)
+                record["rows"] = len(data_class.data)
+            with instrumentation.stage("add_next_earnings", ticker=ticker, rows=len(data_class.data)):
+                data_class.add_next_earnings(ticker)
 
             # ---
 
-            for indicator in self.indicators:
-                indicator_name = indicator['name']
-                method_name = indicator['indicator']
-                method_args = indicator['args']
-
-                data_class.add_indicator(indicator_name, method_name, method_args)
+            self._add_indicators(data_class, instrumentation)
 
             # ---
 
             self.data = data_class.data
 
             bt_ai = Backtest(self.strategy)
-            result = bt_ai.run_strategy(data_class.data)
+            result = bt_ai.run_strategy(data_class.data, instrumentation=instrumentation, plot=plot, max_points=max_points)
 
             return result
+
+    async def run_strategy_async(self, message: str, instrumentation: Instrumentation = None, plot: bool = True,
+                                 max_points: int = 2000):
+        """
+        Same as run_strategy, but the blocking stages run in threads so they overlap. The SEC ticker list loads while
+        the request is parsed. The price data and earnings dates then download together, and the indicators are
+        computed as soon as the price data arrives. Await it from async code, or call run_strategy(concurrent=True).
+        """
+
+        if self.strategy is None:
+            print("Please create a strategy to backtest.")
+            return None
+
+        instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        self.instrumentation = instrumentation
+
+        data_class = self.data_helper()
+        ticker_list = asyncio.create_task(asyncio.to_thread(data_class.tickers.companies))
+
+        with instrumentation.stage("parse_request"):
+            cleaned_json = await asyncio.to_thread(self.parse_request, message)
+
+        ticker = cleaned_json["ticker"]
+        period = cleaned_json["period"]
+        interval = cleaned_json["interval"]
+
+        async def earnings_dates():
+            with instrumentation.stage("earnings_date", ticker=ticker):
+                await ticker_list
+                return await asyncio.to_thread(data_class.earnings_date, ticker)
+
+        async def load_data():
+            with instrumentation.stage("load_ydata", ticker=ticker) as record:
+                await asyncio.to_thread(data_class.load_ydata, ticker, period, interval)
+                record["rows"] = len(data_class.data)
+            with instrumentation.stage("warm_indicators", rows=len(data_class.data)):
+                await asyncio.to_thread(self._warm_indicators, data_class)
+
+        dates, _ = await asyncio.gather(earnings_dates(), load_data())
+
+        with instrumentation.stage("add_next_earnings", ticker=ticker, rows=len(data_class.data)):
+            data_class.add_next_earnings(ticker, dates)
+
+        self._add_indicators(data_class, instrumentation)
+
+        self.data = data_class.data
+
+        bt_ai = Backtest(self.strategy)
+        return await asyncio.to_thread(bt_ai.run_strategy, data_class.data, instrumentation, plot, max_points)
+
+
+def run_coroutine(coroutine):
+    """
+    Runs the coroutine to completion from synchronous code such as a Streamlit script, using a separate thread when
+    an event loop is already running in this one, e.g. in a notebook
+    :return: The result of the coroutine
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
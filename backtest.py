@@ -1,141 +1,409 @@
 # Class for indicators
 import warnings
 
+import numpy as np
 import pandas as pd
+from instrumentation import no_instrumentation
 from strategy import Strategy
 
 import plotly.express as px
 
 
-class Backtest:
-
-    def __init__(self, strategy: Strategy):
-        self.strategy = strategy
-
-    def generate_signals(self, df: pd.DataFrame):
+def combine_conditions(conditions: list, columns, shape):
+    """
+    Evaluates compiled conditions and combines them with a boolean AND
+    :param conditions: List of compiled conditions from Strategy.compile
+    :param columns: Mapping of column names to arrays, e.g. a DataFrame
+    :param shape: The shape of the signal, i.e. the number of bars
+    :return: Boolean array where every condition holds, all False if no condition could be evaluated
+    """
+    signal = None
+
+    for condition in conditions:
+        missing = [name for name in condition.columns if name not in columns]
+        if missing:
+            warnings.warn(f"The condition '{condition.condition}' refers to missing columns: {missing}.",
+                          UserWarning, stacklevel=3)
+            continue
 
-        data = df.copy()
-        data = data.dropna()
-        data["dates"] = data.index
-        data = data.reset_index(drop=True)
-
-        # ---
+        try:
+            values = condition.evaluate(columns)
+        except Exception as e:
+            warnings.warn(f"An unexpected error occurred: {e}", UserWarning, stacklevel=3)
+            continue
+
+        signal = values if signal is None else signal & values
+
+    if signal is None:
+        signal = np.zeros(shape, dtype=bool)
+
+    return signal
+
+
+def valid_rows(df: pd.DataFrame):
+    """
+    :param df: DataFrame of bars
+    :return: The rows without missing values, i.e. the rows kept by df.dropna(). This is a slice when they are
+    contiguous, as after an indicator warm-up, so selecting them is a view rather than a copy, else a boolean mask.
+    """
+    valid = np.ones(len(df), dtype=bool)
+    for name in df.columns:
+        valid &= df[name].notna().to_numpy()
 
-        added_buys = []
-        added_sells = []
+    first = int(np.argmax(valid)) if valid.any() else len(df)
+    if valid[first:].all():
+        return slice(first, len(df))
 
-        for condition in self.strategy.buys:
-            try:
-                data[condition] = data.eval(condition)
-                added_buys.append(condition)
-            except Exception as e:
-                warnings.warn(f"An unexpected error occurred: {e}", UserWarning, stacklevel=2)
+    return valid
 
-        for condition in self.strategy.sells:
-            try:
-                data[condition] = data.eval(condition)
-                added_sells.append(condition)
-            except Exception as e:
-                warnings.warn(f"An unexpected error occurred: {e}", UserWarning, stacklevel=2)
 
-        # ---
-
-        if len(added_buys) == 0:
-            data["buy_signal"] = 0
-        else:
-            data["buy_signal"] = 1
-            for condition in added_buys:
-                data["buy_signal"] *= data[condition]
-
-        # ---
-
-        if len(added_sells) == 0:
-            data["sell_signal"] = 0
-        else:
-            data["sell_signal"] = 1
-            for condition in added_sells:
-                data["sell_signal"] *= data[condition]
-
-        # ---
+def holding_state(buy_signal, sell_signal):
+    """
+    Vectorised position state machine for the buy/sell signals
+    :param buy_signal: Array of buy signals, 1 where the buy conditions are met
+    :param sell_signal: Array of sell signals, 1 where the sell conditions are met
+    :return: Array of int64 holding states, 1 when in a position and 0 otherwise
+
+    Each bar is mapped to an event: a buy only opens (1), a sell only closes (0), both or neither carry the previous
+    state forward (NaN) and anything else resets to 0. The events are then forward filled, starting flat unless the
+    first bar is a buy.
+    """
+    buys = np.asarray(buy_signal) == 1
+    sells = np.asarray(sell_signal) == 1
+
+    if len(buys) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    carry = (buys & sells) | ((np.asarray(buy_signal) == 0) & (np.asarray(sell_signal) == 0))
+
+    events = np.where(buys & ~sells, 1.0, 0.0)
+    events[carry] = np.nan
+    events[0] = 1.0 if buys[0] else 0.0
+
+    holding = pd.Series(events).ffill().to_numpy()
+
+    return holding.astype(np.int64)
+
+
+def holding_states(buy_signals, sell_signals):
+    """
+    holding_state for a 2D array of signals with one series per row, e.g. resampled paths or tickers
+    :return: Array of int64 holding states, 1 when in a position and 0 otherwise
+    """
+    buys = np.asarray(buy_signals, dtype=bool)
+    sells = np.asarray(sell_signals, dtype=bool)
+
+    if buys.shape[1] == 0:
+        return np.zeros(buys.shape, dtype=np.int64)
+
+    # A buy only opens, a sell only closes and both or neither carry the previous state forward, starting flat unless
+    # the first bar is a buy
+    events = (buys & ~sells).astype(np.int64)
+    events[:, 0] = buys[:, 0]
+    known = buys != sells
+    known[:, 0] = True
+
+    bars = np.where(known, np.arange(buys.shape[1]), 0)
+    np.maximum.accumulate(bars, axis=1, out=bars)
+
+    return np.take_along_axis(events, bars, axis=1)
+
+
+def simulate_trades(close, holding_signal, cash=1000):
+    """
+    Array based simulation of the long-only strategy, trading all cash at the close of each bar
+    :param close: Array of close prices
+    :param holding_signal: Array of holding states as returned by holding_state
+    :param cash: The initial capital
+    :return: Tuple of (strategy_values, bah_values, trade_returns, entries, exits) arrays, where entries and exits are
+    the bar indices of each trade. Any position still open is sold on the last bar.
+    """
+    close = np.asarray(close, dtype=np.float64)
+    n = len(close)
+
+    # Positions are only acted on up to the penultimate bar, the last bar forces an exit
+    in_position = np.zeros(n, dtype=bool)
+    in_position[:-1] = np.asarray(holding_signal)[:-1] == 1
+    was_in_position = np.concatenate(([False], in_position[:-1]))
+
+    entries = np.flatnonzero(in_position & ~was_in_position)
+    exits = np.flatnonzero(~in_position & was_in_position)
+
+    # Cash compounds from trade to trade, so this is sequential over trades rather than bars
+    start = cash
+    positions = np.empty(len(entries))
+    exit_cash = np.empty(len(entries))
+    for k in range(len(entries)):
+        positions[k] = cash / close[entries[k]]
+        cash = positions[k] * close[exits[k]]
+        exit_cash[k] = cash
+
+    bars = np.arange(n)
+    trade_ids = np.searchsorted(entries, bars, side="right") - 1
+    cash_levels = np.concatenate(([start], exit_cash))
+
+    strategy_values = cash_levels[np.searchsorted(exits, bars, side="right")]
+    strategy_values[in_position] = positions[trade_ids[in_position]] * close[in_position]
+
+    bah_values = (start / close[0]) * close
+
+    trade_returns = (close[exits] / close[entries]) - 1
+
+    return strategy_values, bah_values, trade_returns, entries, exits
+
+
+def lttb(x, y, n_out: int):
+    """
+    Largest-Triangle-Three-Buckets downsampling, which keeps the points that best preserve the shape of the line
+    :param x: Array of increasing x values
+    :param y: Array of y values
+    :param n_out: The number of points to keep
+    :return: Array of the indices of the kept points, including the first and last point
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # The points between the first and last are split into n_out - 2 buckets, one point is kept from each
+    every = (n - 2) / (n_out - 2)
+    starts = (np.arange(n_out - 2) * every).astype(np.int64) + 1
+    ends = np.append(starts[1:], n - 1)
+
+    counts = ends - starts
+    mean_x = np.append(np.add.reduceat(x[:-1], starts) / counts, x[-1])
+    mean_y = np.append(np.add.reduceat(y[:-1], starts) / counts, y[-1])
+
+    # Each bucket keeps the point making the largest triangle with the last kept point and the next bucket's mean
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        xs = x[starts[i]:ends[i]]
+        ys = y[starts[i]:ends[i]]
+        area = np.abs((x[a] - mean_x[i + 1]) * (ys - y[a]) - (x[a] - xs) * (mean_y[i + 1] - y[a]))
+        a = starts[i] + int(np.argmax(area))
+        selected[i + 1] = a
+
+    return selected
+
+
+def performance_figure(dates, strategy_values, bah_values, max_points: int = 2000):
+    """
+    :param dates: The dates of the bars
+    :param strategy_values: Array of the strategy portfolio values
+    :param bah_values: Array of the buy and hold portfolio values
+    :param max_points: The number of points kept from each line with LTTB, None to plot every bar
+    :return: Plotly figure of the strategy against buy and hold
+    """
+    dates = pd.Series(dates).reset_index(drop=True)
+    strategy_values = np.asarray(strategy_values)
+    bah_values = np.asarray(bah_values)
+
+    if max_points is not None and len(dates) > max_points:
+        try:
+            x = pd.DatetimeIndex(dates).asi8
+        except (TypeError, ValueError):
+            x = np.arange(len(dates))
+
+        # The points kept from either line, so both lines share the same dates
+        keep = np.union1d(lttb(x, strategy_values, max_points), lttb(x, bah_values, max_points))
+        dates = dates.iloc[keep].reset_index(drop=True)
+        strategy_values, bah_values = strategy_values[keep], bah_values[keep]
+
+    plot_data = pd.DataFrame({"Date": dates, "Custom Strategy": strategy_values, "Buy and Hold": bah_values})
+
+    return px.line(plot_data, x="Date", y=["Custom Strategy", "Buy and Hold"],
+                   labels={"value": "Portfolio Value",
+                           "variable": "Strategy"},
+                   title="Custom Strategy vs Buy & Hold Performance")
+
+
+class BacktestResult:
+    """
+    Result of Backtest.run_strategy holding the equity curves, signals and trades as arrays. The signal DataFrame and
+    the figure are only built when first asked for. It still unpacks and indexes like the former
+    (final_val, pct_chg, num_trades, win_rate, data, fig) tuple.
+    """
+
+    __slots__ = ("final_val", "pct_chg", "num_trades", "win_rate", "dates", "strategy_values", "bah_values",
+                 "entries", "exits", "trade_returns", "instrumentation", "_signals", "_packed", "_source", "_plot",
+                 "_max_points", "_data", "_fig")
+
+    _fields = ("final_val", "pct_chg", "num_trades", "win_rate", "data", "fig")
+
+    def __init__(self, final_val, pct_chg, num_trades, win_rate, dates, strategy_values, bah_values, signals,
+                 trades, source: pd.DataFrame, dtype=np.float64, pack_signals: bool = False, plot: bool = True,
+                 max_points: int = 2000, instrumentation=None):
+        """
+        :param dates: The dates of the bars that were traded, i.e. after dropping rows with missing values
+        :param signals: Tuple of the (buy_signal, sell_signal, holding_signal) arrays
+        :param trades: Tuple of the (entries, exits, trade_returns) arrays from simulate_trades
+        :param source: The rows of the data the backtest traded, taken when it ran so later changes to the data do not
+        reach the result. The signal DataFrame is rebuilt from it on demand
+        :param dtype: The dtype of the equity curves, e.g. np.float32 to halve their memory
+        :param pack_signals: Whether to store the signals as bits rather than bytes
+        """
+        self.final_val = final_val
+        self.pct_chg = pct_chg
+        self.num_trades = num_trades
+        self.win_rate = win_rate
+        self.dates = dates
+        self.strategy_values = np.ascontiguousarray(strategy_values, dtype=dtype)
+        self.bah_values = np.ascontiguousarray(bah_values, dtype=dtype)
+        self.entries, self.exits, self.trade_returns = trades
+        self.instrumentation = instrumentation
+
+        signals = np.stack([np.asarray(signal) == 1 for signal in signals])
+        self._signals = np.packbits(signals, axis=1) if pack_signals else signals
+        self._packed = pack_signals
+
+        self._source = source
+        self._plot = plot
+        self._max_points = max_points
+        self._data = None
+        self._fig = None
+
+    def _signal(self, row: int):
+        if self._packed:
+            return np.unpackbits(self._signals[row], count=len(self.dates)).astype(bool)
+        return self._signals[row]
+
+    @property
+    def buy_signal(self):
+        return self._signal(0)
+
+    @property
+    def sell_signal(self):
+        return self._signal(1)
+
+    @property
+    def holding_signal(self):
+        return self._signal(2)
+
+    @property
+    def bah_final_val(self):
+        return self.bah_values[-1]
+
+    @property
+    def bah_pct_chg(self):
+        return (self.bah_values[-1] / self.bah_values[0]) - 1
+
+    @property
+    def data(self):
+        """
+        :return: DataFrame of the traded bars with their signals and rounded portfolio values
+        """
+        if self._data is None:
+            data = self._source.assign(dates=self._source.index).reset_index(drop=True)
+
+            data["buy_signal"] = self.buy_signal.astype(np.int64)
+            data["sell_signal"] = self.sell_signal.astype(np.int64)
+            data["holding_signal"] = self.holding_signal.astype(np.int64)
+            data["strategy_values"] = self.strategy_values.round(0)
+            data["bah_values"] = self.bah_values.round(0)
+
+            self._data = data
+
+        return self._data
+
+    @property
+    def fig(self):
+        """
+        :return: Plotly figure of the strategy against buy and hold, None when the backtest ran headless
+        """
+        if self._fig is None and self._plot:
+            instrumentation = self.instrumentation if self.instrumentation is not None else no_instrumentation
+            with instrumentation.stage("figure", rows=len(self.dates)):
+                self._fig = performance_figure(pd.Series(self.dates), self.strategy_values.round(0),
+                                               self.bah_values.round(0), self._max_points)
+
+        return self._fig
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self._fields)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(getattr(self, name) for name in self._fields[index])
+        return getattr(self, self._fields[index])
+
+    def __repr__(self):
+        return (f"BacktestResult(final_val={self.final_val:.2f}, pct_chg={self.pct_chg:.4f}, "
+                f"num_trades={self.num_trades}, win_rate={self.win_rate:.4f}, bars={len(self.dates)})")
 
-        data["holding_signal"] = 0
-        if data["buy_signal"].iloc[0] == 1:
-            data.loc[0, "holding_signal"] = 1
 
-        for i in range(1, len(data)):
-            if data["buy_signal"].iloc[i] == 1 and data["sell_signal"].iloc[i] == 1:
-                data.loc[i, "holding_signal"] = data.loc[i - 1, "holding_signal"]
-            elif data["buy_signal"].iloc[i] == 0 and data["sell_signal"].iloc[i] == 0:
-                data.loc[i, "holding_signal"] = data.loc[i - 1, "holding_signal"]
-            elif data["buy_signal"].iloc[i] == 1:
-                data.loc[i, "holding_signal"] = 1
-            elif data["sell_signal"].iloc[i] == 1:
-                data.loc[i, "holding_signal"] = 0
-
-        return data
-
-    def run_strategy(self, df: pd.DataFrame):
-
-        print("Running strategy...")
+class Backtest:
 
-        data = self.generate_signals(df)
-        cash = 1000  # Initial capital
-        start = cash
-        position = 0
-        strategy_values = []
-        winrate = []
-        opening_trade_price = None
+    def __init__(self, strategy: Strategy):
+        self.strategy = strategy
 
-        bah_values = []  # Buy and hold values
-        bah_position = cash / data["close"].iloc[0]
+    def signal_arrays(self, df: pd.DataFrame):
+        """
+        Generates the signals from column arrays of the bars without missing values, without copying the data
+        :param df: The data with the columns the strategy conditions use
+        :return: Tuple of (rows, columns, buy_signal, sell_signal, holding_signal), where rows selects the bars without
+        missing values as returned by valid_rows, columns maps close and the columns the conditions use to their
+        arrays over those bars and the buy and sell signals are boolean arrays
+        """
+        buys, sells = self.strategy.compile()
+        rows = valid_rows(df)
 
-        for i in range(len(data)-1):
-            close_price = data["close"].iloc[i]
+        names = set().union({"close"}, *(condition.columns for condition in buys + sells))
+        columns = {name: df[name].to_numpy()[rows] for name in names if name in df.columns}
+        n_bars = len(df.index[rows])
 
-            # Strategy iteration
+        buy_signal = combine_conditions(buys, columns, n_bars)
+        sell_signal = combine_conditions(sells, columns, n_bars)
 
-            # Opening position
-            if data["holding_signal"].iloc[i] == 1 and cash > 0:
-                position = cash / close_price
-                cash = 0
-                opening_trade_price = close_price
+        return rows, columns, buy_signal, sell_signal, holding_state(buy_signal, sell_signal)
 
-            # Closing position
-            elif data["holding_signal"].iloc[i] == 0 and position > 0:
-                cash = position * close_price
-                position = 0
-                closing_trade_price = close_price
+    def generate_signals(self, df: pd.DataFrame):
 
-                trade_pct = (closing_trade_price/opening_trade_price) - 1
-                winrate.append(trade_pct)
+        _, _, buy_signal, sell_signal, holding_signal = self.signal_arrays(df)
 
-            # --- Getting value of portfolio
+        data = df.dropna()
+        data["dates"] = data.index
+        data = data.reset_index(drop=True)
 
-            current_val = cash + (position * data["close"].iloc[i])
-            strategy_values.append(current_val)
+        # ---
 
-            # Buy and hold iteration
-            bah_values.append(bah_position * close_price)
+        data["buy_signal"] = buy_signal.astype(np.int64)
+        data["sell_signal"] = sell_signal.astype(np.int64)
+        data["holding_signal"] = holding_signal
 
-        if position > 0:  # Selling at end
-            close_price = data["close"].iloc[-1]
-            cash = position * close_price
-            strategy_values.append(cash)
-            bah_values.append(bah_position * close_price)
+        return data
 
-            closing_trade_price = close_price
-            trade_pct = (closing_trade_price / opening_trade_price) - 1
-            winrate.append(trade_pct)
+    def run_strategy(self, df: pd.DataFrame, instrumentation=no_instrumentation, plot: bool = True,
+                     max_points: int = 2000, dtype=np.float64, pack_signals: bool = False):
+        """
+        :param df: The data with the columns the strategy conditions use
+        :param instrumentation: Optional Instrumentation recording the time spent in each stage
+        :param plot: Whether the figure can be built, False runs headless and the result has None in place of the figure
+        :param max_points: The number of points kept from each line of the figure, None to plot every bar
+        :param dtype: The dtype the equity curves are kept in, e.g. np.float32
+        :param pack_signals: Whether to keep the signals as bits
+        :return BacktestResult: The metrics, equity curves, signals and trades, with the data and figure built on demand
+        """
 
-        else:
-            close_price = data["close"].iloc[-1]
-            strategy_values.append(strategy_values[-1])
-            bah_values.append(bah_position * close_price)
+        print("Running strategy...")
 
-        # ---- Adding columns
+        with instrumentation.stage("generate_signals") as record:
+            rows, columns, buy_signal, sell_signal, holding_signal = self.signal_arrays(df)
+            dates = df.index[rows]
+            record["rows"] = len(dates)
+        start = 1000  # Initial capital
 
-        data["strategy_values"] = strategy_values
-        data["bah_values"] = bah_values
+        with instrumentation.stage("simulate_trades", rows=len(dates)):
+            strategy_values, bah_values, winrate, entries, exits = simulate_trades(columns["close"], holding_signal,
+                                                                                   start)
 
         # ---- Metrics
 
@@ -144,7 +412,7 @@ class Backtest:
 
         # Winrate
         if len(winrate) > 0:
-            win_rate = sum(x > 0 for x in winrate)/len(winrate)
+            win_rate = np.count_nonzero(winrate > 0)/len(winrate)
         else:
             win_rate = 0
 
@@ -155,16 +423,8 @@ class Backtest:
         print(f"Win Rate: {win_rate * 100:.2f}%")
         print(f"Total Trades: {num_trades}")
 
-        # --- Plotting
-        data["strategy_values"] = data["strategy_values"].round(0)
-        data["bah_values"] = data["bah_values"].round(0)
-        data = data.rename(columns={"strategy_values": "Custom Strategy", "bah_values": "Buy and Hold", "dates": "Date"})
-
-        fig = px.line(data, x="Date", y=["Custom Strategy", "Buy and Hold"],
-                      labels={"value": "Portfolio Value",
-                              "variable": "Strategy"},
-                      title="Custom Strategy vs Buy & Hold Performance")
-
-        data = data.rename(columns={"Custom Strategy": "strategy_values", "Buy and Hold": "bah_values", "Date": "dates"})
-
-        return final_val, pct_chg, num_trades, win_rate, data, fig
+        return BacktestResult(final_val, pct_chg, num_trades, win_rate, dates, strategy_values,
+                              bah_values, (buy_signal, sell_signal, holding_signal),
+                              (entries, exits, winrate), df.iloc[rows], dtype=dtype, pack_signals=pack_signals,
+                              plot=plot, max_points=max_points,
+                              instrumentation=instrumentation if instrumentation is not no_instrumentation else None)
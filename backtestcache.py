@@ -0,0 +1,106 @@
+# Class for caching backtest data and results across sessions
+import inspect
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+from datahelper import DataHelper
+from datastore import INTERVALS, OHLCVStore
+
+# The arguments of BacktestAI.run_strategy that change its result, and so are part of the cache key
+RESULT_ARGUMENTS = ("plot", "max_points")
+
+
+class BacktestCache:
+
+    def __init__(self, store: OHLCVStore = None, max_results: int = 128, data_helper=DataHelper,
+                 ttl: pd.Timedelta = None):
+        """
+        Process-wide cache for the app, shared by every session. Price data goes through one OHLCVStore, so a shorter
+        period of a ticker already downloaded for a longer one is served by slicing it, and backtest results are kept
+        in an LRU keyed by ticker, period, interval, strategy and the run_strategy arguments that change the result.
+        :param store: The OHLCV store shared by every run, defaults to OHLCVStore()
+        :param max_results: The number of backtest results kept
+        :param data_helper: The DataHelper class, or a function taking store and returning a DataHelper
+        :param ttl: How long a result is served before it is rerun on the newer bars, defaults to the length of a bar
+        of the request's interval, as the store fetches new bars then
+        """
+        self.store = store if store is not None else OHLCVStore()
+        self.max_results = max_results
+        self._data_helper = data_helper
+        self.ttl = ttl
+
+        self._results = OrderedDict()
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def data_helper(self):
+        """
+        :return DataHelper: A DataHelper loading through the shared store, pass this method as BacktestAI's data_helper
+        """
+        return self._data_helper(store=self.store)
+
+    def __len__(self):
+        return len(self._results)
+
+    def run(self, backtest_ai, message: str, **kwargs):
+        """
+        Returns the cached result of the strategy for the request, running it only once even when several sessions
+        ask for it at the same time
+        :param backtest_ai: The BacktestAI with its strategy created
+        :param message: The request describing the ticker, period and interval to backtest
+        :param kwargs: Passed to BacktestAI.run_strategy, e.g. concurrent=True
+        :return BacktestResult: The result of the backtest
+        """
+        request = backtest_ai.parse_request(message)
+        arguments = inspect.signature(backtest_ai.run_strategy).bind(message, **kwargs)
+        arguments.apply_defaults()
+        key = (request["ticker"].upper(), request["period"], request["interval"], backtest_ai.strategy_key(),
+               tuple(arguments.arguments.get(name) for name in RESULT_ARGUMENTS))
+
+        with self._lock:
+            if self._fresh(key):
+                self._results.move_to_end(key)
+                return self._results[key][0]
+            running = self._running.setdefault(key, threading.Lock())
+
+        # Only one session runs each key, the others wait for its result. The lock entry is dropped even when the run
+        # fails, so the next request for the key runs it again
+        with running:
+            try:
+                with self._lock:
+                    if self._fresh(key):
+                        return self._results[key][0]
+
+                result = backtest_ai.run_strategy(message, **kwargs)
+
+                with self._lock:
+                    if result is not None:
+                        self._results[key] = (result, time.monotonic())
+                        while len(self._results) > self.max_results:
+                            self._results.popitem(last=False)
+            finally:
+                with self._lock:
+                    self._running.pop(key, None)
+
+        return result
+
+    def _fresh(self, key: tuple):
+        """
+        :return bool: Whether a result is cached for the key and has not expired, expired results are dropped
+        """
+        if key not in self._results:
+            return False
+
+        ttl = self.ttl if self.ttl is not None else INTERVALS.get(key[2], pd.Timedelta(days=1))
+        if time.monotonic() - self._results[key][1] < ttl.total_seconds():
+            return True
+
+        del self._results[key]
+        return False
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
@@ -0,0 +1,223 @@
+# Benchmarks for the backtest hot paths
+import argparse
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from backtest import Backtest
+from datahelper import DataHelper
+from datastore import INTERVALS
+from indicators import Indicators, indicator_cache
+from strategy import Strategy
+
+
+SIZES = [1_000, 100_000, 10_000_000]
+
+# Arguments each Indicators method is benchmarked with, methods missing here are called without arguments
+INDICATOR_ARGS = {"sma": (20,), "ema": (20,), "rsi": (14,), "sma_many": ([5, 10, 20, 50, 100, 200],),
+                  "ema_many": ([5, 10, 20, 50, 100, 200],), "rsi_many": ([7, 14, 21, 30],),
+                  "bollinger_many": ([10, 20, 50],)}
+
+
+def synthetic_ohlcv(n_bars: int, interval: str = "1m", seed: int = 42, start: str = "2000-01-03",
+                    price: float = 100.0, drift: float = 0.05, volatility: float = 0.2, tz: str = "America/New_York"):
+    """
+    :param n_bars: The number of bars
+    :param interval: The Yahoo Finance interval of the bars
+    :param seed: The random seed, the same seed always gives the same data
+    :param start: The timestamp of the first bar
+    :param price: The first open price
+    :param drift: The annual drift of the geometric Brownian motion
+    :param volatility: The annual volatility of the geometric Brownian motion
+    :param tz: The time zone of the index, as returned by Yahoo Finance
+    :return: DataFrame of OHLCV bars with a Datetime index
+    """
+    rng = np.random.default_rng(seed)
+    bar = INTERVALS[interval]
+    dt = bar / pd.Timedelta(days=365)
+
+    returns = (drift - volatility ** 2 / 2) * dt + volatility * np.sqrt(dt) * rng.standard_normal(n_bars)
+    close = price * np.exp(np.cumsum(returns))
+    open_ = np.concatenate(([price], close[:-1]))
+
+    spread = np.abs(rng.standard_normal((2, n_bars))) * volatility * np.sqrt(dt) / 2
+    high = np.maximum(open_, close) * (1 + spread[0])
+    low = np.minimum(open_, close) * (1 - spread[1])
+    volume = rng.lognormal(mean=10, sigma=1, size=n_bars).astype(np.int64)
+
+    index = pd.date_range(start, periods=n_bars, freq=bar, tz=tz)
+
+    return pd.DataFrame({"open": open_, "high": high, "low": low, "close": close, "volume": volume}, index=index)
+
+
+def quarterly_earnings(index: pd.DatetimeIndex):
+    """
+    :return list: Earnings dates every 91 days, from before the first bar to after the last
+    """
+    first = index[0].tz_localize(None).normalize() - pd.Timedelta(days=30)
+    last = index[-1].tz_localize(None).normalize() + pd.Timedelta(days=91)
+
+    return list(pd.date_range(first, last, freq="91D"))
+
+
+class _FixedTickers:
+    def cik(self, ticker: str):
+        return "0000000000"
+
+
+class _FixedEarnings:
+    def __init__(self, dates: list):
+        self._dates = dates
+
+    def dates(self, cik: str):
+        return self._dates
+
+
+def measure(function, setup=None):
+    """
+    Times the function, then runs it again under tracemalloc for the peak memory, clearing the indicator cache first
+    so every run computes from scratch
+    :param function: The function to benchmark, called with the result of setup
+    :param setup: Optional function preparing the argument, excluded from the measurements
+    :return dict: The wall time in seconds and the peak traced memory in bytes
+    """
+    def run(traced: bool):
+        indicator_cache.clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            argument = setup() if setup is not None else None
+
+            if traced:
+                tracemalloc.start()
+            start = time.perf_counter()
+            function(argument)
+            seconds = time.perf_counter() - start
+        if traced:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return peak
+
+        return seconds
+
+    return {"seconds": run(traced=False), "peak_bytes": run(traced=True)}
+
+
+def benchmarks(df: pd.DataFrame):
+    """
+    :return dict: The benchmarks for the data, each a (function, setup) pair
+    """
+    strategy = Strategy()
+    strategy.add_buy_signal("rsi_14 < 40")
+    strategy.add_sell_signal("rsi_14 > 60")
+    backtest = Backtest(strategy)
+
+    signal_df = df.copy()
+    signal_df["rsi_14"] = Indicators(signal_df).rsi(14)
+
+    def helper():
+        helper = DataHelper(tickers=_FixedTickers(), earnings=_FixedEarnings(quarterly_earnings(df.index)))
+        helper.load_data(df.copy())
+        return helper
+
+    cases = {}
+    for method in [method for method in dir(Indicators) if not method.startswith("_")]:
+        args = INDICATOR_ARGS.get(method, ())
+        cases[f"Indicators.{method}"] = (lambda _, method=method, args=args: getattr(Indicators(df), method)(*args),
+                                         None)
+
+    cases["DataHelper.add_indicator"] = (lambda helper: helper.add_indicator("rsi_14", "rsi", 14), helper)
+    cases["DataHelper.add_next_earnings"] = (lambda helper: helper.add_next_earnings("TEST"), helper)
+    cases["Backtest.generate_signals"] = (lambda _: backtest.generate_signals(signal_df), None)
+    cases["Backtest.run_strategy"] = (lambda _: backtest.run_strategy(signal_df), None)
+    cases["BacktestResult.data"] = (lambda result: result.data, lambda: backtest.run_strategy(signal_df))
+    cases["BacktestResult.fig"] = (lambda result: result.fig, lambda: backtest.run_strategy(signal_df))
+
+    return cases
+
+
+def run_benchmarks(sizes: list = SIZES, interval: str = "1m", seed: int = 42, only: str = None):
+    """
+    :param sizes: The numbers of bars to benchmark
+    :param interval: The interval of the synthetic bars
+    :param seed: The random seed of the synthetic bars
+    :param only: Optional prefix, only benchmarks whose names start with it are run
+    :return dict: The environment and the wall time and peak memory of each benchmark at each size
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+
+    results = {
+        "commit": commit,
+        "created_at": pd.Timestamp.now(tz="UTC").isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "interval": interval,
+        "seed": seed,
+        "results": [],
+    }
+
+    for n_bars in sizes:
+        df = synthetic_ohlcv(n_bars, interval=interval, seed=seed)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            cases = benchmarks(df)
+
+        for name, (function, setup) in cases.items():
+            if only is not None and not name.startswith(only):
+                continue
+
+            result = {"name": name, "bars": n_bars, **measure(function, setup)}
+            results["results"].append(result)
+            print(f"{name:<36}{n_bars:>12,} bars{result['seconds']:>12.4f} s{result['peak_bytes'] / 1024 ** 2:>12.1f} MB")
+
+    return results
+
+
+def compare(previous: dict, current: dict):
+    """
+    Prints the ratio of the current to the previous wall time and peak memory of each benchmark in both runs
+    """
+    before = {(result["name"], result["bars"]): result for result in previous["results"]}
+
+    for result in current["results"]:
+        old = before.get((result["name"], result["bars"]))
+        if old is None:
+            continue
+
+        time_ratio = result["seconds"] / old["seconds"] if old["seconds"] else np.nan
+        memory_ratio = result["peak_bytes"] / old["peak_bytes"] if old["peak_bytes"] else np.nan
+        print(f"{result['name']:<36}{result['bars']:>12,} bars{time_ratio:>10.2f}x time{memory_ratio:>10.2f}x memory")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the backtest hot paths on synthetic OHLCV data.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="The numbers of bars to benchmark")
+    parser.add_argument("--interval", default="1m", help="The interval of the synthetic bars")
+    parser.add_argument("--seed", type=int, default=42, help="The random seed of the synthetic bars")
+    parser.add_argument("--only", default=None, help="Only run benchmarks whose names start with this prefix")
+    parser.add_argument("--output", default="benchmark.json", help="The JSON file the results are saved to")
+    parser.add_argument("--compare", default=None, help="A previous results JSON file to compare against")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, interval=args.interval, seed=args.seed, only=args.only)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {args.output}.")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+# Class for compiled strategy conditions
+import ast
+import functools
+import io
+import tokenize
+
+import numpy as np
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+
+_COMPARISONS = {
+    ast.Lt: (np.less, "<"),
+    ast.LtE: (np.less_equal, "<="),
+    ast.Gt: (np.greater, ">"),
+    ast.GtE: (np.greater_equal, ">="),
+    ast.Eq: (np.equal, "=="),
+    ast.NotEq: (np.not_equal, "!="),
+}
+
+_ARITHMETIC = {
+    ast.Add: (np.add, "+"),
+    ast.Sub: (np.subtract, "-"),
+    ast.Mult: (np.multiply, "*"),
+    ast.Div: (np.true_divide, "/"),
+    ast.Pow: (np.power, "**"),
+    ast.Mod: (np.mod, "%"),
+}
+
+_FUNCTIONS = {
+    "abs": np.abs,
+    "sqrt": np.sqrt,
+    "log": np.log,
+    "exp": np.exp,
+}
+
+
+class Condition:
+
+    def __init__(self, condition: str):
+        """
+        Parses and validates a condition written for DataFrame.eval, e.g. "rsi_20 < 40 and close > sma_50"
+        :param condition: The condition string
+        """
+        self.condition = condition
+        self.columns = set()
+
+        try:
+            tree = ast.parse(self._replace_booleans(condition), mode="eval")
+        except (SyntaxError, tokenize.TokenError) as e:
+            raise ValueError(f"The condition '{condition}' could not be parsed: {e}") from None
+
+        self._evaluate, kind, self.expression = self._compile(tree.body)
+
+        if kind == "number":
+            raise ValueError(f"The condition '{condition}' does not evaluate to True/False.")
+
+    def __repr__(self):
+        return f"Condition({self.condition!r})"
+
+    @staticmethod
+    def _replace_booleans(condition: str):
+        """
+        Gives & and | the same precedence as 'and' and 'or', as DataFrame.eval does
+        """
+        tokens = []
+        for token in tokenize.generate_tokens(io.StringIO(condition).readline):
+            if token.type == tokenize.OP and token.string == "&":
+                tokens.append((tokenize.NAME, "and"))
+            elif token.type == tokenize.OP and token.string == "|":
+                tokens.append((tokenize.NAME, "or"))
+            else:
+                tokens.append((token.type, token.string))
+
+        return tokenize.untokenize(tokens)
+
+    def _compile(self, node):
+        """
+        :return: Tuple of (function of the columns, kind of the result, numexpr expression) for the node
+        """
+        if isinstance(node, ast.Name):
+            name = node.id
+            self.columns.add(name)
+            return (lambda columns: np.asarray(columns[name])), "any", name
+
+        if isinstance(node, ast.Constant) and isinstance(node.value, (bool, int, float)):
+            value = node.value
+            kind = "bool" if isinstance(value, bool) else "number"
+            return (lambda columns: value), kind, repr(value)
+
+        if isinstance(node, ast.BoolOp):
+            operands = [self._compile_operand(value, "bool") for value in node.values]
+            ufunc, op = (np.logical_and, "&") if isinstance(node.op, ast.And) else (np.logical_or, "|")
+            functions = [operand[0] for operand in operands]
+            expression = f" {op} ".join(operand[2] for operand in operands)
+            return (lambda columns: functools.reduce(ufunc, (f(columns) for f in functions))), "bool", f"({expression})"
+
+        if isinstance(node, ast.UnaryOp):
+            if isinstance(node.op, (ast.Not, ast.Invert)):
+                function, _, expression = self._compile_operand(node.operand, "bool")
+                return (lambda columns: np.logical_not(function(columns))), "bool", f"(~{expression})"
+            if isinstance(node.op, (ast.USub, ast.UAdd)):
+                function, _, expression = self._compile_operand(node.operand, "number")
+                if isinstance(node.op, ast.UAdd):
+                    return function, "number", expression
+                return (lambda columns: np.negative(function(columns))), "number", f"(-{expression})"
+
+        if isinstance(node, ast.BinOp) and type(node.op) in _ARITHMETIC:
+            ufunc, op = _ARITHMETIC[type(node.op)]
+            left, _, left_expression = self._compile_operand(node.left, "number")
+            right, _, right_expression = self._compile_operand(node.right, "number")
+            return ((lambda columns: ufunc(left(columns), right(columns))), "number",
+                    f"({left_expression} {op} {right_expression})")
+
+        if isinstance(node, ast.Compare):
+            operands = [self._compile_operand(value, "number") for value in [node.left] + node.comparators]
+            comparisons = []
+            for i, op in enumerate(node.ops):
+                if type(op) not in _COMPARISONS:
+                    break
+                ufunc, symbol = _COMPARISONS[type(op)]
+                comparisons.append((ufunc, symbol, operands[i], operands[i + 1]))
+            else:
+                def compare(columns):
+                    results = (ufunc(left[0](columns), right[0](columns)) for ufunc, _, left, right in comparisons)
+                    return functools.reduce(np.logical_and, results)
+
+                expression = " & ".join(f"({left[2]} {symbol} {right[2]})" for _, symbol, left, right in comparisons)
+                return compare, "bool", f"({expression})"
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _FUNCTIONS \
+                and len(node.args) == 1 and not node.keywords:
+            ufunc = _FUNCTIONS[node.func.id]
+            function, _, expression = self._compile_operand(node.args[0], "number")
+            return (lambda columns: ufunc(function(columns))), "number", f"{node.func.id}({expression})"
+
+        raise ValueError(f"The condition '{self.condition}' contains an unsupported expression: "
+                         f"'{ast.unparse(node)}'.")
+
+    def _compile_operand(self, node, expected: str):
+        """
+        Compiles a node that must be of the expected kind
+        """
+        compiled = self._compile(node)
+        if compiled[1] not in (expected, "any"):
+            raise ValueError(f"The condition '{self.condition}' expects a {expected} but found '{ast.unparse(node)}'.")
+
+        return compiled
+
+    def evaluate(self, columns):
+        """
+        :param columns: Mapping of column names to arrays, e.g. a dict of NumPy arrays or a DataFrame
+        :return: Boolean NumPy array where the condition holds
+        """
+        if numexpr is not None:
+            try:
+                local_dict = {name: np.asarray(columns[name]) for name in self.columns}
+                # numexpr compares float32 columns against float64 constants, while NumPy and DataFrame.eval compare
+                # them in float32, so narrow floats go to NumPy for the signals not to depend on numexpr
+                if not any(values.dtype.kind == "f" and values.dtype.itemsize < 8 for values in local_dict.values()):
+                    return numexpr.evaluate(self.expression, local_dict=local_dict).astype(bool, copy=False)
+            except (KeyError, ValueError, TypeError, NotImplementedError):
+                if any(name not in columns for name in self.columns):
+                    raise
+                # Fall back to NumPy for dtypes numexpr cannot handle
+
+        # Columns may broadcast against each other, e.g. a (paths x bars) close against (bars,) indicators
+        result = np.asarray(self._evaluate(columns), dtype=bool)
+        shape = np.broadcast_shapes(result.shape, *(np.shape(columns[name]) for name in self.columns))
+
+        return np.broadcast_to(result, shape).copy()
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_condition(condition: str):
+    """
+    :param condition: The condition string
+    :return Condition: The compiled condition, cached per condition string
+    """
+    return Condition(condition)
@@ -1,98 +1,316 @@
+from datastore import INTERVALS, OHLCVStore, period_start
+from earnings import EarningsCalendar, earnings_calendar, next_earnings
 from indicators import Indicators
-import pandas as pd
-import requests
+from tickers import TickerReference, ticker_reference
 import numpy as np
+import pandas as pd
+import threading
+import uuid
 import yfinance as yf
 import warnings
+from urllib.parse import urlsplit
 
 from requests import Session
+from requests.adapters import HTTPAdapter
 from requests_cache import CacheMixin, SQLiteCache
 from requests_ratelimiter import LimiterMixin, MemoryQueueBucket
 from pyrate_limiter import Duration, RequestRate, Limiter
 
 
+YAHOO_HOSTS = ["https://query1.finance.yahoo.com", "https://query2.finance.yahoo.com", "https://fc.yahoo.com"]
+
+# The pandas resample rule of each interval, weeks start on Monday and months on the 1st as Yahoo Finance bars do
+RESAMPLE_RULES = {
+    "1m": "1min", "2m": "2min", "5m": "5min", "15m": "15min", "30m": "30min", "60m": "60min", "90m": "90min",
+    "1h": "1h", "1d": "1D", "5d": "5D", "1wk": "W-MON", "1mo": "MS", "3mo": "QS",
+}
+CALENDAR_INTERVALS = ["5d", "1wk", "1mo", "3mo"]
+# Intervals of the same length under another name, compared and cached under the name they map to
+INTERVAL_ALIASES = {"60m": "1h", "24h": "1d"}
+
+
+def canonical_interval(interval: str):
+    """
+    :return str: The interval under its canonical name, e.g. "1h" for "60m"
+    """
+    return INTERVAL_ALIASES.get(interval, interval)
+
+
 class CachedLimiterSession(CacheMixin, LimiterMixin, Session):
     pass
 
 
+class _RedirectAdapter(HTTPAdapter):
+    """
+    Sends requests for a host to another base URL, e.g. a local stand-in for Yahoo Finance
+    """
+
+    def __init__(self, base_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url.rstrip("/")
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        request.url = self.base_url + url.path + (f"?{url.query}" if url.query else "")
+        return super().send(request, **kwargs)
+
+
+class SessionPool:
+
+    def __init__(self, backend=None, requests_per_5s: int = 2, pool_size: int = 16, base_url: str = None):
+        """
+        Process-wide download session, so the rate limiter, HTTP cache and connection pool are shared between calls
+        and threads
+        :param backend: The requests_cache backend, defaults to SQLiteCache("yfinance.cache")
+        :param requests_per_5s: The maximum number of requests every 5 seconds
+        :param pool_size: The number of pooled connections per host
+        :param base_url: Optional base URL that Yahoo Finance requests are sent to instead, e.g. a local stand-in
+        """
+        self.backend = backend
+        self.requests_per_5s = requests_per_5s
+        self.pool_size = pool_size
+        self.base_url = base_url
+        self._session = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        :return CachedLimiterSession: The shared session, created on first use
+        """
+        with self._lock:
+            if self._session is None:
+                session = CachedLimiterSession(
+                    limiter=Limiter(RequestRate(self.requests_per_5s, Duration.SECOND * 5)),
+                    bucket_class=MemoryQueueBucket,
+                    backend=self.backend if self.backend is not None else SQLiteCache("yfinance.cache"),
+                )
+
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+
+                if self.base_url is not None:
+                    for host in YAHOO_HOSTS:
+                        session.mount(host, _RedirectAdapter(self.base_url, pool_connections=self.pool_size,
+                                                             pool_maxsize=self.pool_size))
+
+                self._session = session
+
+        return self._session
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+session_pool = SessionPool()
+
+
 class DataHelper:
 
-    def __init__(self):
+    def __init__(self, store: OHLCVStore = None, sessions: SessionPool = session_pool,
+                 tickers: TickerReference = ticker_reference, earnings: EarningsCalendar = earnings_calendar,
+                 dtype=np.float64):
+        """
+        :param store: Optional local OHLCV store, when given Yahoo Finance is only asked for the bars it is missing
+        :param sessions: The pool providing the download session, shared by every DataHelper by default
+        :param tickers: The SEC ticker to CIK reference, shared by every DataHelper by default
+        :param earnings: The SEC earnings calendar, shared by every DataHelper by default
+        :param dtype: The dtype of the prices and indicators, e.g. np.float32 to halve their memory. Volume is kept as
+        int64 either way
+        """
         self.data = None
+        self.store = store
+        self.sessions = sessions
+        self.tickers = tickers
+        self.earnings = earnings
+        self.dtype = np.dtype(dtype)
+        self.interval = None
+        self._indicators = None
+        self._data_key = None
+        self._keyed_data = None
+        self._pyramid = {}
+        self._pyramid_index = None
+
+    def _compact(self, df: pd.DataFrame):
+        """
+        :return: A shallow copy of the data with float columns in self.dtype and a whole number volume as int64, so the
+        caller's frame is left as it is and columns already in them are not copied
+        """
+        df = df.copy(deep=False)
+
+        for name in df.columns:
+            column = df[name]
+            if name == "volume" and column.dtype.kind == "f":
+                values = column.to_numpy()
+                if np.isfinite(values).all() and (values == np.round(values)).all():
+                    df[name] = column.astype(np.int64)
+            elif column.dtype.kind == "f" and column.dtype != self.dtype:
+                df[name] = column.astype(self.dtype)
+
+        return df
+
+    def _download(self, ticker: str, interval: str, period: str = None, start=None):
+        """
+        :return: DataFrame of the bars downloaded from Yahoo Finance for the period, or from start onwards
+        """
+        yf_ticker = yf.Ticker(ticker, session=self.sessions.get())
+        if start is None:
+            df_hist = yf_ticker.history(period=period, interval=interval)
+        else:
+            df_hist = yf_ticker.history(start=start, interval=interval)
+        df_hist.columns = df_hist.columns.str.lower()
+
+        return df_hist
 
     def load_ydata(self, ticker: str, period: str, interval: str):
         """
         :param ticker: Ticker for CIK
         :param period: The period of data to download
         :param interval: The interval of data
-        :return: Loads data from Yahoo Finance
+        :return: Loads data from Yahoo Finance, or from the local store when one is set
         """
-
-        session = CachedLimiterSession(
-            limiter=Limiter(RequestRate(2, Duration.SECOND * 5)),  # max 2 requests per 5 seconds
-            bucket_class=MemoryQueueBucket,
-            backend=SQLiteCache("yfinance.cache"),
-        )
-
-        yf_ticker = yf.Ticker(ticker, session=session)
-        df_hist = yf_ticker.history(period=period, interval=interval)
-        df_hist.columns = df_hist.columns.str.lower()
-
-        self.data = df_hist
+        if self.store is None:
+            self.data = self._download(ticker, interval, period=period)
+        else:
+            self.data = self.store.load(ticker, period, interval, fetch=self._download)
+        self.data = self._compact(self.data)
+        self.interval = interval
+        self._pyramid = {}
+        self._set_data_key()
 
         if self.data.empty:
             print(f"Data from Yahoo Finance could not be downloaded for {ticker}.")
         else:
             print(f"Data from Yahoo Finance downloaded for {ticker}.")
 
-    def load_data(self, df_hist: pd.DataFrame):
+    def _download_many(self, tickers: list, interval: str, period: str = None, start=None, threads: int = 8):
         """
-        Loads data
-        :param df_hist: Input the dataframe with Datetime Index and OHLC format
+        :return dict: DataFrame of the bars for each ticker, downloaded as one grouped request
         """
-        df_hist.columns = df_hist.columns.str.lower()
-        self.data = df_hist
+        df_hist = yf.download(tickers, period=period, start=start, interval=interval, group_by="ticker",
+                              auto_adjust=True, actions=True, ignore_tz=False, threads=threads, progress=False,
+                              session=self.sessions.get())
+
+        frames = {}
+        for ticker in tickers:
+            if isinstance(df_hist.columns, pd.MultiIndex):
+                frame = df_hist[ticker].copy() if ticker in df_hist.columns.get_level_values(0) else pd.DataFrame()
+            else:
+                frame = df_hist.copy()
 
-        print(f"Success: data loaded.")
+            frame.columns = frame.columns.str.lower()
+            frames[ticker] = frame.dropna(how="all")
 
-    def get_cik(self, ticker: str):
+        return frames
+
+    def load_many(self, tickers: list, period: str, interval: str, chunk_size: int = 50, threads: int = 8):
         """
-        :param ticker: The ticker of interest
-        :return str: The CIK code of each ticker
+        :param tickers: The tickers to load
+        :param period: The period of data to download
+        :param interval: The interval of data
+        :param chunk_size: The number of tickers in each grouped download
+        :param threads: The number of download threads within each group, sharing the pooled session
+        :return dict: DataFrame for each ticker, all aligned on the union of their timestamps
         """
-        url = "https://www.sec.gov/files/company_tickers_exchange.json"
+        frames = {}
 
-        headers = {"User-Agent": "YourName (your@email.com)", "Accept-Encoding": "gzip, deflate"}
+        for i in range(0, len(tickers), chunk_size):
+            chunk = list(tickers[i:i + chunk_size])
 
-        response = requests.get(url, headers=headers)
+            if self.store is None:
+                frames.update(self._download_many(chunk, interval, period=period, threads=threads))
+                continue
 
-        response = response.json()["data"]
-        dict_data = {i[2]: str(i[0]).zfill(10) for i in response}
+            # Only the tickers the store cannot serve are downloaded, those with stored history only from the earliest
+            # of their last stored bars
+            updates = {ticker: self.store.needs_update(ticker, interval, period) for ticker in chunk}
+            full = [ticker for ticker, update in updates.items() if update == "full"]
+            append = [ticker for ticker, update in updates.items() if update == "append"]
 
-        cik_code = dict_data[ticker]
+            start = min(self.store.last_timestamp(ticker, interval) for ticker in append) if append else None
 
-        return cik_code
+            for stale, kwargs in [(full, {"period": period}), (append, {"start": start})]:
+                if not stale:
+                    continue
 
-    def earnings_date(self, ticker: str):
+                try:
+                    downloaded = self._download_many(stale, interval, threads=threads, **kwargs)
+                except Exception as e:
+                    warnings.warn(f"Serving stored data as the download failed: {e}", UserWarning, stacklevel=2)
+                    downloaded = {}
+
+                for ticker, frame in downloaded.items():
+                    if frame.empty:
+                        continue
+                    if updates[ticker] == "full":
+                        self.store.write(ticker, interval, frame, since=period_start(period, pd.Timestamp.now(tz="UTC")))
+                    else:
+                        self.store.append(ticker, interval, frame)
+
+            for ticker in chunk:
+                frames[ticker] = self.store.read(ticker, interval, period)
+
+        empty = [ticker for ticker, frame in frames.items() if frame.empty]
+        if empty:
+            print(f"Data from Yahoo Finance could not be downloaded for {empty}.")
+
+        index = None
+        for frame in frames.values():
+            if not frame.empty:
+                index = frame.index if index is None else index.union(frame.index)
+
+        if index is not None:
+            frames = {ticker: self._compact(frame.reindex(index)) for ticker, frame in frames.items()}
+
+        print(f"Data from Yahoo Finance loaded for {len(frames) - len(empty)} tickers.")
+
+        return frames
+
+    def load_data(self, df_hist: pd.DataFrame, interval: str = None):
         """
-        :param ticker: Ticker
-        :return list: Returns a list of timestamp containing the earnings dates for the chosen ticker
+        Loads data
+        :param df_hist: Input the dataframe with Datetime Index and OHLC format
+        :param interval: The interval of the bars, inferred from the index when not given
         """
-        cik = self.get_cik(ticker)
-        url = "https://data.sec.gov/submissions/CIK" + cik + ".json"
+        self.data = self._compact(df_hist.rename(columns=str.lower))
+        self.interval = interval
+        self._pyramid = {}
+        self._set_data_key()
 
-        headers = {"User-Agent": "YourName (your@email.com)", "Accept-Encoding": "gzip, deflate", "Host": "data.sec.gov"}
+        print(f"Success: data loaded.")
 
-        response = requests.get(url, headers=headers)
+    def _set_data_key(self):
+        # A new token for every load, so the indicator cache never serves values computed from earlier data
+        self._data_key = uuid.uuid4().hex
+        self._keyed_data = self.data
 
-        json_data = response.json()  # Parse JSON response
-        form_types = json_data["filings"]["recent"]["form"]
-        dates = json_data["filings"]["recent"]["filingDate"]
+    def indicators(self):
+        """
+        :return Indicators: The Indicators of the loaded data, keyed in indicator_cache on a token set when the data is
+        loaded rather than on a hash of the prices. Data assigned to self.data directly is hashed instead
+        """
+        if self._indicators is None or self._indicators.hist_df is not self.data:
+            data_key = self._data_key if self.data is self._keyed_data else None
+            self._indicators = Indicators(self.data, data_key=data_key)
 
-        df_dates = pd.DataFrame({"Date": dates, "Form_Type": form_types})
-        df_dates = df_dates[df_dates["Form_Type"].isin(["10-Q", "10-K"])]
-        df_dates["Date"] = pd.to_datetime(df_dates["Date"])
-        return list(df_dates["Date"])
+        return self._indicators
+
+    def get_cik(self, ticker: str):
+        """
+        :param ticker: The ticker of interest
+        :return str: The CIK code of each ticker
+        """
+        return self.tickers.cik(ticker)
+
+    def earnings_date(self, ticker: str):
+        """
+        :param ticker: Ticker
+        :return list: Returns a list of timestamp containing the earnings dates for the chosen ticker
+        """
+        return self.earnings.dates(self.get_cik(ticker))
 
     def next_earnings_date(self, date, earnings_dates):
         """
@@ -100,39 +318,34 @@ class DataHelper:
         :param earnings_dates: Earnings dates list
         :return: Returns the next date for date in the list of earnings_dates
         """
-        if date.tzinfo is not None:
-            date = date.tz_convert(None)
-            date = date.replace(tzinfo=None)
-
-        earnings_dates = np.sort(np.array(earnings_dates, dtype='datetime64[D]'))
-        date = np.datetime64(date, 'D')
-        index = np.searchsorted(earnings_dates, date)
-        if index < len(earnings_dates):
-            return earnings_dates[index]
-        else:
-            return earnings_dates[-1] + np.timedelta64(90, 'D')
+        return next_earnings(pd.DatetimeIndex([date]), earnings_dates)[0]
 
-    def add_next_earnings(self, ticker: str):
+    def add_next_earnings(self, ticker: str, earnings_dates: list = None):
         """
         :param ticker: Ticker
+        :param earnings_dates: Optional earnings dates already fetched with earnings_date
         :return: Adds the column to the data that contains the number of days to next earnings report
         """
-        earnings_dates = self.earnings_date(ticker)
-
-        self.data["next_earnings"] = self.data.index.map(lambda x: self.next_earnings_date(x, earnings_dates))
+        if earnings_dates is None:
+            earnings_dates = self.earnings_date(ticker)
 
-        self.data["next_earnings"] = self.data["next_earnings"].dt.tz_localize(None)
+        upcoming = next_earnings(self.data.index, earnings_dates)
+        self.data["next_earnings"] = pd.Series(upcoming.astype("datetime64[s]"), index=self.data.index)
         self.data.index = self.data.index.tz_localize(None)
 
         self.data["days_to_earnings"] = (self.data["next_earnings"] - self.data.index).dt.days
 
-    def add_indicator(self, indicator_name: str, indicator_method: str, *args):
+    def add_indicator(self, indicator_name: str, indicator_method: str, *args, interval: str = None):
         """
-        :param indicator_name: The name of the column to be added
+        :param indicator_name: The name of the column to be added. For the batched methods such as sma_many it is the
+        prefix of the columns, e.g. add_indicator("sma", "sma_many", [5, 10]) adds sma_5 and sma_10, and
+        bollinger_many adds a lower and upper column for each window, e.g. bb_lower_20 and bb_upper_20
         :param indicator_method: The indicator method to add
+        :param interval: Optional higher interval the indicator is computed at, e.g. "1d" on 5m data. Each bar sees the
+        value of the last higher interval bar completed by its close, see resampled
         :return: Adds the indicator to the data
         """
-        indi_methods = [method for method in dir(Indicators) if not method.startswith("__")]
+        indi_methods = [method for method in dir(Indicators) if not method.startswith("_")]
         indi_methods.append("days_to_earnings")
 
         if self.data is None:
@@ -140,8 +353,135 @@ class DataHelper:
 
         else:
             if indicator_method in indi_methods:
-                self.data[indicator_name] = getattr(Indicators(self.data), indicator_method)(*args)
+                if interval is None or canonical_interval(interval) == self.base_interval():
+                    values = getattr(self.indicators(), indicator_method)(*args)
+                else:
+                    bars, complete = self._level(interval)
+                    values = self._align(getattr(Indicators(bars), indicator_method)(*args), complete)
+
+                if indicator_method.endswith("_many"):
+                    self._add_many(indicator_name, values, args[0])
+                    return
+
+                if values.dtype.kind == "f" and values.dtype != self.dtype:
+                    values = values.astype(self.dtype)
+
+                self.data[indicator_name] = values
                 print(f"The indicator '{indicator_name}' has been added.")
 
             else:
                 warnings.warn(f"The indicator method '{indicator_method}' you have chosen is not in the Indicators class, please pass one of the following: {indi_methods}.", UserWarning, stacklevel=1)
+
+    def _add_many(self, indicator_name: str, values, windows: list):
+        """
+        Adds the columns of a batched indicator in one concat, rather than growing the data one column at a time
+        :param values: (bars x windows) array, or a (lower, upper) pair of them for bollinger_many
+        """
+        if isinstance(values, tuple):
+            parts = zip([f"{indicator_name}_lower", f"{indicator_name}_upper"], values)
+        else:
+            parts = [(indicator_name, values)]
+
+        columns = {}
+        for prefix, array in parts:
+            for j, window in enumerate(windows):
+                columns[f"{prefix}_{window}"] = array[:, j].astype(self.dtype, copy=False)
+
+        new = pd.DataFrame(columns, index=self.data.index)
+        keyed = self.data is self._keyed_data
+        self.data = pd.concat([self.data.drop(columns=new.columns, errors="ignore"), new], axis=1)
+        if keyed:
+            # The prices are unchanged, so the new frame keeps the data key
+            self._keyed_data = self.data
+        print(f"The indicators {list(columns)} have been added.")
+
+    # --- Resampling pyramid
+
+    def base_interval(self):
+        """
+        :return str: The canonical interval of the loaded bars, inferred from the closest bars when it was not given
+        """
+        if self.interval is None:
+            spacing = self.data.index.to_series().diff().min()
+            if pd.isna(spacing):
+                return None
+            self.interval = min((interval for interval in INTERVALS if interval not in INTERVAL_ALIASES),
+                                key=lambda interval: abs(INTERVALS[interval] - spacing))
+
+        return canonical_interval(self.interval)
+
+    def _level(self, interval: str):
+        """
+        Builds a level of the pyramid from the coarsest level already built that its bars are made of, so each level is
+        derived from the one below it and built once per dataset
+        :return: Tuple of the bars at the interval and the timestamp of the base bar each of them completes on
+        """
+        interval = canonical_interval(interval)
+        if interval not in RESAMPLE_RULES:
+            raise ValueError(f"The interval '{interval}' is not one of {list(RESAMPLE_RULES)}.")
+
+        # The pyramid is rebuilt when the data is reloaded or its index changes, e.g. in add_next_earnings
+        if self._pyramid_index is not self.data.index and not self.data.index.equals(self._pyramid_index):
+            self._pyramid = {}
+        self._pyramid_index = self.data.index
+
+        base = self.base_interval()
+        if interval == base:
+            return self.data, self.data.index
+        if INTERVALS[interval] <= INTERVALS[base]:
+            raise ValueError(f"The interval '{interval}' is not above the {base} interval of the data.")
+
+        if interval not in self._pyramid:
+            def made_of(level):
+                # Calendar intervals are made of days or finer bars, a quarter can also be made of months
+                if interval in CALENDAR_INTERVALS:
+                    return level not in CALENDAR_INTERVALS or (level, interval) == ("1mo", "3mo")
+                return level not in CALENDAR_INTERVALS and INTERVALS[interval] % INTERVALS[level] == pd.Timedelta(0)
+
+            levels = [level for level in self._pyramid if INTERVALS[level] < INTERVALS[interval] and made_of(level)]
+            if levels:
+                bars, complete = self._pyramid[max(levels, key=INTERVALS.get)]
+            else:
+                bars, complete = self.data, self.data.index
+
+            aggregation = {name: function for name, function in [("open", "first"), ("high", "max"), ("low", "min"),
+                                                                  ("close", "last"), ("volume", "sum")]
+                           if name in bars.columns}
+            frame = bars[list(aggregation)].assign(complete=complete)
+            resampled = frame.resample(RESAMPLE_RULES[interval], closed="left", label="left").agg(
+                dict(aggregation, complete="max"))
+            resampled = resampled[resampled["close"].notna()]
+
+            self._pyramid[interval] = (resampled.drop(columns="complete"), pd.DatetimeIndex(resampled["complete"]))
+
+        return self._pyramid[interval]
+
+    def resampled(self, interval: str):
+        """
+        :param interval: An interval above the loaded one, e.g. "1h" or "1d" on 5m data
+        :return: DataFrame of the OHLCV bars at the interval, each labelled by its start. The levels are cached, so
+        e.g. 1m -> 5m -> 1h -> 1d is built from the loaded bars once without further downloads
+        """
+        return self._level(interval)[0]
+
+    def _align(self, values, complete: pd.DatetimeIndex):
+        """
+        Forward-aligns values of a higher interval to the loaded bars without look-ahead, each bar gets the value of the
+        last higher interval bar completed by its close
+        :param values: Series or array of the higher interval, or a tuple of arrays as from bollinger_many
+        :param complete: The timestamp of the base bar each higher interval bar completes on
+        """
+        if isinstance(values, tuple):
+            return tuple(self._align(array, complete) for array in values)
+
+        positions = self.data.index.get_indexer(complete)
+        latest = np.searchsorted(positions, np.arange(len(self.data)), side="right") - 1
+
+        array = np.asarray(values, dtype=np.float64)
+        aligned = np.full((len(self.data),) + array.shape[1:], np.nan)
+        aligned[latest >= 0] = array[latest[latest >= 0]]
+
+        if isinstance(values, pd.Series):
+            return pd.Series(aligned, index=self.data.index, name=values.name)
+
+        return aligned
@@ -0,0 +1,276 @@
+# Class for the local OHLCV store
+import json
+import os
+import re
+import shutil
+import threading
+import warnings
+
+import numpy as np
+import pandas as pd
+
+
+# Approximate bar lengths of the Yahoo Finance intervals, used to decide when stored data is stale
+INTERVALS = {
+    "1m": pd.Timedelta(minutes=1), "2m": pd.Timedelta(minutes=2), "5m": pd.Timedelta(minutes=5),
+    "15m": pd.Timedelta(minutes=15), "30m": pd.Timedelta(minutes=30), "60m": pd.Timedelta(hours=1),
+    "90m": pd.Timedelta(minutes=90), "1h": pd.Timedelta(hours=1), "1d": pd.Timedelta(days=1),
+    "5d": pd.Timedelta(days=5), "1wk": pd.Timedelta(weeks=1), "1mo": pd.Timedelta(days=30),
+    "3mo": pd.Timedelta(days=90),
+}
+
+
+def period_offset(period: str):
+    """
+    :param period: A Yahoo Finance period of a fixed length, e.g. "5d", "6mo" or "2y"
+    :return pd.DateOffset: The length of the period
+    """
+    match = re.fullmatch(r"(\d+)\s*(d|wk|mo|y)", period.strip())
+    if match is None:
+        raise ValueError(f"The period '{period}' is not a valid Yahoo Finance period.")
+
+    number, unit = int(match.group(1)), match.group(2)
+    offsets = {"d": pd.DateOffset(days=number), "wk": pd.DateOffset(weeks=number),
+               "mo": pd.DateOffset(months=number), "y": pd.DateOffset(years=number)}
+
+    return offsets[unit]
+
+
+def period_start(period: str, now: pd.Timestamp):
+    """
+    :param period: A Yahoo Finance period, e.g. "5d", "6mo", "2y", "ytd" or "max"
+    :param now: The time the period is measured back from
+    :return: The first timestamp of the period, or None for "max"
+    """
+    if period == "max":
+        return None
+    if period == "ytd":
+        return now.normalize().replace(month=1, day=1)
+
+    return now - period_offset(period)
+
+
+class OHLCVStore:
+
+    def __init__(self, root: str = "ohlcv_store"):
+        """
+        On-disk columnar store of OHLCV data, with one directory per ticker and interval holding a raw binary file per
+        column. Columns are memory-mapped on read, so serving a period is a slice rather than a copy. Stored bytes are
+        never rewritten in place, new bars are appended and replaced bars go to new files that are swapped in, so frames
+        already read keep their values.
+        :param root: The directory of the store
+        """
+        self.root = root
+        self._lock = threading.Lock()
+
+    def _path(self, ticker: str, interval: str):
+        return os.path.join(self.root, ticker.upper(), interval)
+
+    def _read_meta(self, ticker: str, interval: str):
+        path = os.path.join(self._path(ticker, interval), "meta.json")
+        if not os.path.exists(path):
+            return None
+
+        with open(path) as f:
+            return json.load(f)
+
+    def _write_meta(self, ticker: str, interval: str, meta: dict):
+        path = os.path.join(self._path(ticker, interval), "meta.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".tmp", path)
+
+    def _column_file(self, ticker: str, interval: str, position: int):
+        return os.path.join(self._path(ticker, interval), f"col{position}.bin")
+
+    def _index_file(self, ticker: str, interval: str):
+        return os.path.join(self._path(ticker, interval), "index.bin")
+
+    def _memmap(self, path: str, dtype, rows: int):
+        if rows == 0:
+            return np.empty(0, dtype=dtype)
+
+        # Copy-on-write so callers can modify the frame without touching the files
+        return np.memmap(path, dtype=dtype, mode="c", shape=(rows,))
+
+    def has(self, ticker: str, interval: str):
+        """
+        :return bool: Whether the store holds any data for the ticker and interval
+        """
+        meta = self._read_meta(ticker, interval)
+        return meta is not None and meta["rows"] > 0
+
+    def write(self, ticker: str, interval: str, df: pd.DataFrame, since=None):
+        """
+        Replaces the stored data for the ticker and interval
+        :param df: The data with Datetime index and lower case OHLCV columns
+        :param since: The start of the period that df covers, None if it covers the full history
+        """
+        with self._lock:
+            os.makedirs(self._path(ticker, interval), exist_ok=True)
+
+            df = df.select_dtypes(include=["number", "bool"])
+            index = df.index if df.index.tz is not None else df.index.tz_localize("UTC")
+            meta = {
+                "columns": [[name, df[name].dtype.str] for name in df.columns],
+                "rows": 0,
+                "tz": str(index.tz),
+                "since": None if since is None else pd.Timestamp(since).value,
+                "fetched_at": pd.Timestamp.now(tz="UTC").value,
+            }
+
+            self._replace_rows(ticker, interval, meta, df, keep=0)
+
+    def append(self, ticker: str, interval: str, df: pd.DataFrame):
+        """
+        Appends new bars, replacing any stored bars from the first new timestamp onwards
+        :param df: The new data with Datetime index and lower case OHLCV columns
+        """
+        with self._lock:
+            meta = self._read_meta(ticker, interval)
+            meta["fetched_at"] = pd.Timestamp.now(tz="UTC").value
+
+            if df.empty:
+                self._write_meta(ticker, interval, meta)
+                return
+
+            # Stored bars from the first new timestamp onwards are replaced, e.g. the still forming last bar
+            first = pd.Timestamp(df.index[0]).tz_localize("UTC") if df.index.tz is None else df.index[0]
+            stored = self._memmap(self._index_file(ticker, interval), np.int64, meta["rows"])
+            keep = int(np.searchsorted(stored, first.value, side="left"))
+            del stored
+
+            if keep == meta["rows"]:
+                self._append_rows(ticker, interval, meta, df)
+            else:
+                self._replace_rows(ticker, interval, meta, df, keep)
+
+    def _row_values(self, ticker: str, interval: str, meta: dict, df: pd.DataFrame):
+        """
+        :return list: Tuples of the index and column files and the values of the rows to add to each
+        """
+        index = df.index if df.index.tz is not None else df.index.tz_localize("UTC")
+        files = [(self._index_file(ticker, interval), index.as_unit("ns").asi8.astype(np.int64))]
+
+        for position, (name, dtype) in enumerate(meta["columns"]):
+            if name in df:
+                values = df[name].to_numpy(dtype=dtype, na_value=np.nan if np.dtype(dtype).kind == "f" else 0)
+            else:
+                values = np.zeros(len(df), dtype=dtype)
+            files.append((self._column_file(ticker, interval, position), np.ascontiguousarray(values)))
+
+        return files
+
+    def _append_rows(self, ticker: str, interval: str, meta: dict, df: pd.DataFrame):
+        """
+        Appends the rows to the end of each column file and updates the metadata. The stored bytes are not touched, so
+        frames already read keep their values
+        """
+        for path, values in self._row_values(ticker, interval, meta, df):
+            with open(path, "ab") as f:
+                f.write(values.tobytes())
+
+        meta["rows"] += len(df)
+        self._write_meta(ticker, interval, meta)
+
+    def _replace_rows(self, ticker: str, interval: str, meta: dict, df: pd.DataFrame, keep: int):
+        """
+        Writes the first keep stored rows followed by the rows of df to new files and swaps them in, as _write_meta
+        does, so frames already read keep mapping the old files rather than seeing them rewritten or truncated
+        """
+        files = self._row_values(ticker, interval, meta, df)
+
+        for path, values in files:
+            if keep:
+                shutil.copyfile(path, path + ".tmp")
+                os.truncate(path + ".tmp", keep * values.itemsize)
+            else:
+                open(path + ".tmp", "wb").close()
+
+            with open(path + ".tmp", "ab") as f:
+                f.write(values.tobytes())
+
+        for path, _ in files:
+            os.replace(path + ".tmp", path)
+
+        meta["rows"] = keep + len(df)
+        self._write_meta(ticker, interval, meta)
+
+    def read(self, ticker: str, interval: str, period: str = "max"):
+        """
+        :param period: The Yahoo Finance period to serve, measured back from now
+        :return: DataFrame of the stored bars in the period, with columns memory-mapped from the store
+        """
+        # The files are mapped under the lock, so the row count always matches the files a write has swapped in
+        with self._lock:
+            meta = self._read_meta(ticker, interval)
+            if meta is None:
+                return pd.DataFrame()
+
+            rows = meta["rows"]
+            stamps = self._memmap(self._index_file(ticker, interval), np.int64, rows)
+            mapped = [self._memmap(self._column_file(ticker, interval, position), dtype, rows)
+                      for position, (_, dtype) in enumerate(meta["columns"])]
+
+        start = period_start(period, pd.Timestamp.now(tz=meta["tz"]))
+        first = 0 if start is None else int(np.searchsorted(stamps, start.value, side="left"))
+
+        index = pd.DatetimeIndex(np.asarray(stamps[first:]).view("M8[ns]")).tz_localize("UTC").tz_convert(meta["tz"])
+
+        columns = {name: values[first:] for (name, _), values in zip(meta["columns"], mapped)}
+
+        return pd.DataFrame(columns, index=index, copy=False)
+
+    def needs_update(self, ticker: str, interval: str, period: str):
+        """
+        :return str: "full" when the period starts before the stored history, "append" when newer bars may exist
+        and None when the stored data is current
+        """
+        meta = self._read_meta(ticker, interval)
+        if meta is None or meta["rows"] == 0:
+            return "full"
+
+        now = pd.Timestamp.now(tz="UTC")
+        start = period_start(period, now)
+        since = meta["since"]
+        if since is not None and (start is None or start.value < since):
+            return "full"
+
+        if now.value - meta["fetched_at"] >= INTERVALS.get(interval, pd.Timedelta(days=1)).value:
+            return "append"
+
+        return None
+
+    def last_timestamp(self, ticker: str, interval: str):
+        """
+        :return: The timestamp of the last stored bar
+        """
+        with self._lock:
+            meta = self._read_meta(ticker, interval)
+            stamps = self._memmap(self._index_file(ticker, interval), np.int64, meta["rows"])
+
+        return pd.Timestamp(int(stamps[-1]), tz="UTC").tz_convert(meta["tz"])
+
+    def load(self, ticker: str, period: str, interval: str, fetch=None):
+        """
+        Serves the period from the store, first fetching only the bars that are missing
+        :param fetch: Function fetch(ticker, interval, period=None, start=None) returning a DataFrame of bars, or None to
+        work offline from the stored data
+        :return: DataFrame of the bars in the period
+        """
+        update = self.needs_update(ticker, interval, period) if fetch is not None else None
+
+        try:
+            if update == "full":
+                df = fetch(ticker, interval, period=period)
+                if not df.empty:
+                    start = period_start(period, pd.Timestamp.now(tz="UTC"))
+                    self.write(ticker, interval, df, since=start)
+            elif update == "append":
+                self.append(ticker, interval, fetch(ticker, interval, start=self.last_timestamp(ticker, interval)))
+        except Exception as e:
+            if not self.has(ticker, interval):
+                raise
+            warnings.warn(f"Serving stored data for {ticker} as the update failed: {e}", UserWarning, stacklevel=2)
+
+        return self.read(ticker, interval, period)
@@ -0,0 +1,127 @@
+# Class for the SEC earnings calendar
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import requests
+
+
+SEC_SUBMISSIONS_URL = "https://data.sec.gov/submissions/CIK{cik}.json"
+SEC_HEADERS = {"User-Agent": "YourName (your@email.com)", "Accept-Encoding": "gzip, deflate", "Host": "data.sec.gov"}
+EARNINGS_FORMS = ["10-Q", "10-K"]
+
+
+def next_earnings(index: pd.DatetimeIndex, earnings_dates):
+    """
+    :param index: The dates of interest
+    :param earnings_dates: The earnings dates, in any order
+    :return: Array of the next earnings date on or after each date, or 90 days after the last earnings date when there
+    is none, found with a single searchsorted over the whole index
+    """
+    earnings_dates = np.sort(np.array(earnings_dates, dtype="datetime64[D]"))
+
+    if index.tz is not None:
+        index = index.tz_convert(None)
+    days = index.values.astype("datetime64[D]")
+
+    positions = np.searchsorted(earnings_dates, days)
+    upcoming = earnings_dates[np.minimum(positions, len(earnings_dates) - 1)]
+
+    return np.where(positions < len(earnings_dates), upcoming, earnings_dates[-1] + np.timedelta64(90, "D"))
+
+
+class EarningsCalendar:
+
+    def __init__(self, root: str = "earnings_calendar", ttl: float = 24 * 60 * 60):
+        """
+        Earnings dates of each CIK taken from the 10-Q and 10-K filings in the SEC submissions, persisted to disk with
+        one file per CIK. Stale calendars are refreshed with a conditional request and merged with the stored dates, so
+        filings that drop out of the recent submissions are kept.
+        :param root: The directory the calendars are persisted to
+        :param ttl: The number of seconds before a calendar is refreshed
+        """
+        self.root = root
+        self.ttl = ttl
+        self._calendars = {}
+        self._lock = threading.Lock()
+
+    def _path(self, cik: str):
+        return os.path.join(self.root, f"CIK{cik}.json")
+
+    def _read(self, cik: str):
+        path = self._path(cik)
+        if not os.path.exists(path):
+            return None
+
+        with open(path) as f:
+            return json.load(f)
+
+    def _write(self, cik: str, calendar: dict):
+        os.makedirs(self.root, exist_ok=True)
+
+        path = self._path(cik)
+        with open(path + ".tmp", "w") as f:
+            json.dump(calendar, f)
+        os.replace(path + ".tmp", path)
+
+    def _download(self, cik: str, etag: str = None):
+        """
+        :return: The SEC submissions JSON and its ETag, or None when it has not changed since the ETag
+        """
+        headers = dict(SEC_HEADERS)
+        if etag is not None:
+            headers["If-None-Match"] = etag
+
+        response = requests.get(SEC_SUBMISSIONS_URL.format(cik=cik), headers=headers)
+        if response.status_code == 304:
+            return None, etag
+        response.raise_for_status()
+
+        return response.json(), response.headers.get("ETag")
+
+    def refresh(self, cik: str):
+        """
+        Downloads the filings of the CIK and merges the earnings dates into its calendar
+        """
+        calendar = self._calendars.get(cik) or self._read(cik) or {"dates": [], "etag": None}
+
+        submissions, etag = self._download(cik, calendar["etag"])
+        if submissions is not None:
+            recent = submissions["filings"]["recent"]
+            dates = [date for date, form in zip(recent["filingDate"], recent["form"]) if form in EARNINGS_FORMS]
+            calendar["dates"] = sorted(set(calendar["dates"]) | set(dates))
+
+        calendar["etag"] = etag
+        calendar["fetched_at"] = time.time()
+        self._write(cik, calendar)
+
+        with self._lock:
+            self._calendars[cik] = calendar
+
+    def dates(self, cik: str):
+        """
+        :param cik: The zero-filled CIK code
+        :return list: The earnings dates of the CIK as Timestamps, refreshed first when the calendar is stale
+        """
+        calendar = self._calendars.get(cik)
+        if calendar is None:
+            calendar = self._read(cik)
+            if calendar is not None:
+                with self._lock:
+                    self._calendars[cik] = calendar
+
+        if calendar is None or time.time() - calendar["fetched_at"] > self.ttl:
+            try:
+                self.refresh(cik)
+            except Exception as e:
+                if calendar is None:
+                    raise
+                print(f"Serving stored earnings dates for CIK{cik} as the refresh failed: {e}")
+
+        return list(pd.to_datetime(self._calendars[cik]["dates"]))
+
+
+earnings_calendar = EarningsCalendar()
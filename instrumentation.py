@@ -0,0 +1,115 @@
+# Class for timing and profiling the backtest stages
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import time
+
+
+def _rss():
+    """
+    :return int: The resident memory of the process in bytes, or None where /proc is not available
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Instrumentation:
+
+    def __init__(self, callback=None, logger=None, profile: bool = False):
+        """
+        Records the wall time, row count and resident memory change of each stage of a backtest
+        :param callback: Optional function called with the record of each stage as it finishes
+        :param logger: Optional logging.Logger the records are logged to at INFO level, with the record in the
+        "backtest_stage" attribute for structured handlers
+        :param profile: Whether to run cProfile over the stages, the statistics are kept in profile_stats
+        """
+        self.callback = callback
+        self.logger = logger
+        self.profile = profile
+
+        self.stages = []
+        self.profile_stats = None
+        self._profiler = None
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def stage(self, name: str, **details):
+        """
+        Context manager timing one stage, e.g. with instrumentation.stage("load_ydata", ticker="AAPL") as record:
+        :param name: The name of the stage
+        :param details: Extra fields stored in the record, such as the indicator name
+        :return: Yields the record, so the stage can set its "rows" once they are known
+        """
+        record = {"stage": name, "rows": None, **details}
+
+        if self.profile and self._depth == 0:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._depth += 1
+
+        rss = _rss()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            end_rss = _rss()
+            record["memory_delta"] = end_rss - rss if rss is not None and end_rss is not None else None
+
+            self._depth -= 1
+            if self._profiler is not None and self._depth == 0:
+                self._profiler.disable()
+                stats = pstats.Stats(self._profiler, stream=io.StringIO())
+                if self.profile_stats is None:
+                    self.profile_stats = stats
+                else:
+                    self.profile_stats.add(stats)
+                self._profiler = None
+
+            self.stages.append(record)
+
+            if self.callback is not None:
+                self.callback(record)
+            if self.logger is not None:
+                self.logger.info("Stage %s took %.4f s", name, record["seconds"], extra={"backtest_stage": record})
+
+    def summary(self):
+        """
+        :return dict: The total seconds spent in each stage name
+        """
+        totals = {}
+        for record in self.stages:
+            totals[record["stage"]] = totals.get(record["stage"], 0) + record["seconds"]
+
+        return totals
+
+    def print_profile(self, sort_by: str = "cumulative", limit: int = 25):
+        """
+        Prints the cProfile statistics of the profiled stages
+        """
+        if self.profile_stats is None:
+            print("There is no profile, please create the Instrumentation with profile=True.")
+            return
+
+        stream = io.StringIO()
+        self.profile_stats.stream = stream
+        self.profile_stats.sort_stats(sort_by).print_stats(limit)
+        print(stream.getvalue())
+
+
+class _NullInstrumentation:
+    """
+    Instrumentation that records nothing, used when none is passed
+    """
+
+    @contextlib.contextmanager
+    def stage(self, name: str, **details):
+        yield {}
+
+
+no_instrumentation = _NullInstrumentation()
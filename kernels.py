@@ -0,0 +1,193 @@
+# Kernels for path-dependent indicators
+import numpy as np
+from numba import njit
+
+
+def jit(function):
+    """
+    Compiles the kernel with numba, cached on disk so later processes skip the compilation
+    """
+    return njit(cache=True, nogil=True)(function)
+
+
+@jit
+def trailing_stop(close, pct):
+    """
+    :param close: Array of close prices
+    :param pct: The distance of the stop below the highest close, e.g. 0.05 for 5%
+    :return: Array of long trailing stop levels, which restart below the close once the close falls through the stop
+    """
+    n = len(close)
+    stop = np.empty(n)
+
+    level = np.nan
+    for i in range(n):
+        candidate = close[i] * (1 - pct)
+        if np.isnan(level) or close[i] < level or candidate > level:
+            level = candidate
+        stop[i] = level
+
+    return stop
+
+
+@jit
+def parabolic_sar(high, low, step, max_step):
+    """
+    :param high: Array of high prices
+    :param low: Array of low prices
+    :param step: The acceleration factor step, typically 0.02
+    :param max_step: The maximum acceleration factor, typically 0.2
+    :return: Array of Parabolic SAR levels, starting in an uptrend
+    """
+    n = len(high)
+    sar_values = np.empty(n)
+    if n == 0:
+        return sar_values
+
+    uptrend = True
+    sar = low[0]
+    extreme = high[0]
+    factor = step
+    sar_values[0] = sar
+
+    for i in range(1, n):
+        sar = sar + factor * (extreme - sar)
+
+        if uptrend:
+            sar = min(sar, low[i - 1], low[i - 2] if i > 1 else low[i - 1])
+            if low[i] < sar:
+                uptrend = False
+                sar = extreme
+                extreme = low[i]
+                factor = step
+            elif high[i] > extreme:
+                extreme = high[i]
+                factor = min(factor + step, max_step)
+        else:
+            sar = max(sar, high[i - 1], high[i - 2] if i > 1 else high[i - 1])
+            if high[i] > sar:
+                uptrend = True
+                sar = extreme
+                extreme = high[i]
+                factor = step
+            elif low[i] < extreme:
+                extreme = low[i]
+                factor = min(factor + step, max_step)
+
+        sar_values[i] = sar
+
+    return sar_values
+
+
+@jit
+def supertrend(high, low, close, atr, multiplier):
+    """
+    :param high: Array of high prices
+    :param low: Array of low prices
+    :param close: Array of close prices
+    :param atr: Array of the Average True Range, NaN during warm-up
+    :param multiplier: The ATR multiplier of the bands, typically 3
+    :return: Array of SuperTrend levels, the lower band in an uptrend and the upper band in a downtrend
+    """
+    n = len(close)
+    trend = np.full(n, np.nan)
+
+    upper = np.nan
+    lower = np.nan
+    uptrend = True
+
+    for i in range(n):
+        if np.isnan(atr[i]):
+            continue
+
+        mid = (high[i] + low[i]) / 2
+        basic_upper = mid + multiplier * atr[i]
+        basic_lower = mid - multiplier * atr[i]
+
+        if np.isnan(upper):
+            upper = basic_upper
+            lower = basic_lower
+            uptrend = close[i] >= lower
+        else:
+            if basic_upper < upper or close[i - 1] > upper:
+                upper = basic_upper
+            if basic_lower > lower or close[i - 1] < lower:
+                lower = basic_lower
+
+            if uptrend and close[i] < lower:
+                uptrend = False
+            elif not uptrend and close[i] > upper:
+                uptrend = True
+
+        trend[i] = lower if uptrend else upper
+
+    return trend
+
+
+@jit
+def _ewm_into(values, com, adjust, min_periods, out):
+    """
+    Writes the exponentially weighted means of the values into out, with the same recursion as pandas ewm(...).mean()
+    """
+    n = len(values)
+    alpha = 1. / (1. + com)
+    old_wt_factor = 1. - alpha
+    new_wt = 1. if adjust else alpha
+    minimum = max(min_periods, 1)
+
+    weighted = values[0] if n > 0 else np.nan
+    old_wt = 1.
+    nobs = 0
+
+    for i in range(n):
+        cur = values[i]
+        is_observation = cur == cur
+        nobs += is_observation
+
+        if i > 0:
+            if weighted == weighted:
+                # Missing values still decay the weight of the earlier values, as with ignore_na=False
+                old_wt *= old_wt_factor
+                if is_observation:
+                    if weighted != cur:
+                        if not adjust and com == 1:
+                            new_wt = 1. - old_wt
+                        weighted = old_wt * weighted + new_wt * cur
+                        weighted /= (old_wt + new_wt)
+                    if adjust:
+                        old_wt += new_wt
+                    else:
+                        old_wt = 1.
+            elif is_observation:
+                weighted = cur
+
+        out[i] = weighted if nobs >= minimum else np.nan
+
+
+@jit
+def ewm_many(values, coms, adjust, min_periods):
+    """
+    :param values: Array of values, NaN for missing values
+    :param coms: Array of the centre of mass of each exponentially weighted mean, as in pandas ewm(com=...)
+    :param adjust: Whether to use the adjusted weights, as in pandas ewm(adjust=...)
+    :param min_periods: Array of the minimum number of observations of each mean, as in pandas ewm(min_periods=...)
+    :return: Array of shape (len(coms), len(values)) with the same recursion as pandas ewm(...).mean() for each com
+    """
+    out = np.empty((len(coms), len(values)))
+    for j in range(len(coms)):
+        _ewm_into(values, coms[j], adjust, min_periods[j], out[j])
+
+    return out
+
+
+@jit
+def ewm_rows(values, com, adjust, min_periods):
+    """
+    :param values: 2D array of values, one series per row, e.g. Monte Carlo paths
+    :return: Array of the same shape with the exponentially weighted mean of each row, as in ewm_many
+    """
+    out = np.empty(values.shape)
+    for j in range(values.shape[0]):
+        _ewm_into(values[j], com, adjust, min_periods, out[j])
+
+    return out
@@ -0,0 +1,135 @@
+# Classes for the LLM clients
+import hashlib
+import json
+import os
+import re
+import threading
+
+from google import genai
+
+
+MODEL = "gemini-2.0-flash"
+
+PERIOD_UNITS = {"day": "d", "week": "wk", "month": "mo", "year": "y"}
+INTERVAL_WORDS = {"minute": "1m", "hourly": "1h", "daily": "1d", "weekly": "1wk", "monthly": "1mo"}
+
+# The exact request built by Home.py from an SEC ticker, case-sensitive so free text such as "Download Microsoft ..."
+# is left to the LLM rather than read as a ticker
+DOWNLOAD_REQUEST = re.compile(
+    r"Download (?P<ticker>[A-Z][A-Z0-9.\-]{0,9}) for the past (?P<number>[1-9]\d*) (?P<unit>day|week|month|year)s? "
+    r"on an? (?P<interval>minute|hourly|daily|weekly|monthly) interval\."
+)
+
+
+def parse_json(text: str):
+    """
+    :param text: The response text, optionally wrapped in a ```json code block
+    :return: The parsed JSON
+    """
+    return json.loads(re.sub(r"```(json)?\n|\n```", "", text).strip())
+
+
+def parse_download_request(message: str):
+    """
+    Parses the structured "Download MSFT for the past 2 years on a daily interval." request built by Home.py, so it
+    does not need an LLM call
+    :param message: The request
+    :return dict: The ticker, period and interval, or None if the request is not in the structured form
+    """
+    match = DOWNLOAD_REQUEST.fullmatch(message.strip())
+    if match is None:
+        return None
+
+    return {
+        "ticker": match.group("ticker"),
+        "period": match.group("number") + PERIOD_UNITS[match.group("unit")],
+        "interval": INTERVAL_WORDS[match.group("interval")],
+    }
+
+
+class GeminiClient:
+
+    def __init__(self, api_key: str, model: str = MODEL):
+        """
+        :param api_key: The Gemini API key
+        :param model: The Gemini model
+        """
+        self.model = model
+        self._client = genai.Client(api_key=api_key)
+
+    def generate_json(self, prompt: str):
+        """
+        :param prompt: The prompt, asking for a JSON response
+        :return: The parsed JSON response
+        """
+        response = self._client.models.generate_content(model=self.model, contents=prompt)
+        return parse_json(response.text)
+
+
+class StandInClient:
+
+    def __init__(self, responses, model: str = "stand-in"):
+        """
+        Offline client returning canned responses, e.g. for tests
+        :param responses: List of responses returned in turn, or a function of the prompt returning the response.
+        Responses are JSON strings or already parsed JSON
+        :param model: The model name, used in cache keys
+        """
+        self.model = model
+        self.responses = responses if callable(responses) else list(responses)
+        self.prompts = []
+
+    def generate_json(self, prompt: str):
+        self.prompts.append(prompt)
+        response = self.responses(prompt) if callable(self.responses) else self.responses.pop(0)
+
+        return parse_json(response) if isinstance(response, str) else response
+
+
+class CachedClient:
+
+    def __init__(self, client, root: str = "llm_cache"):
+        """
+        Persistent cache of the parsed JSON responses of a client, keyed by the model and the normalised prompt
+        :param client: The client to cache, e.g. a GeminiClient
+        :param root: The directory the responses are persisted to, one file per prompt
+        """
+        self.client = client
+        self.root = root
+        self.model = client.model
+        self._responses = {}
+        self._lock = threading.Lock()
+
+    def key(self, prompt: str):
+        """
+        :return str: The cache key of the prompt, ignoring case and whitespace differences
+        """
+        normalised = " ".join(prompt.lower().split())
+        return hashlib.blake2b(f"{self.model}\n{normalised}".encode(), digest_size=16).hexdigest()
+
+    def _path(self, key: str):
+        return os.path.join(self.root, f"{key}.json")
+
+    def generate_json(self, prompt: str):
+        """
+        :return: The cached response to the prompt, or the client's response which is then cached
+        """
+        key = self.key(prompt)
+
+        response = self._responses.get(key)
+        if response is None and os.path.exists(self._path(key)):
+            with open(self._path(key)) as f:
+                response = json.load(f)
+
+        if response is None:
+            response = self.client.generate_json(prompt)
+
+            os.makedirs(self.root, exist_ok=True)
+            with open(self._path(key) + ".tmp", "w") as f:
+                json.dump(response, f)
+            os.replace(self._path(key) + ".tmp", self._path(key))
+
+        with self._lock:
+            self._responses[key] = response
+
+        return response
@@ -0,0 +1,212 @@
+# Class for multi-asset portfolio backtests
+import numpy as np
+import pandas as pd
+
+from backtest import combine_conditions, holding_states
+from indicators import Indicators
+from strategy import Strategy
+
+
+class PortfolioResult:
+    """
+    Result of Portfolio.run, with the equity curve and the weight of each ticker at each bar. The bah_values benchmark
+    is an equal-weight index of the tickers with a price rebalanced at every bar, rather than a buy and hold of each
+    ticker
+    """
+
+    __slots__ = ("final_val", "pct_chg", "num_trades", "win_rate", "dates", "tickers", "values", "bah_values",
+                 "weights", "trade_returns")
+
+    def __init__(self, final_val, pct_chg, num_trades, win_rate, dates, tickers, values, bah_values, weights,
+                 trade_returns):
+        self.final_val = final_val
+        self.pct_chg = pct_chg
+        self.num_trades = num_trades
+        self.win_rate = win_rate
+        self.dates = dates
+        self.tickers = tickers
+        self.values = values
+        self.bah_values = bah_values
+        self.weights = weights
+        self.trade_returns = trade_returns
+
+    @property
+    def bah_final_val(self):
+        return self.bah_values[-1]
+
+    @property
+    def bah_pct_chg(self):
+        return self.bah_values[-1] / self.bah_values[0] - 1
+
+    def holdings(self):
+        """
+        :return: DataFrame of the weight of each ticker held from the close of each bar to the next
+        """
+        return pd.DataFrame(self.weights, index=self.dates, columns=self.tickers)
+
+    def __repr__(self):
+        return (f"PortfolioResult(final_val={self.final_val:.2f}, pct_chg={self.pct_chg:.4f}, "
+                f"num_trades={self.num_trades}, win_rate={self.win_rate:.4f}, tickers={len(self.tickers)}, "
+                f"bars={len(self.dates)})")
+
+
+class Portfolio:
+
+    def __init__(self, strategy: Strategy, indicators: list = None, weighting: str = "equal",
+                 max_weight: float = None):
+        """
+        Runs one Strategy over many tickers at once, holding every ticker with an open signal
+        :param strategy: The Strategy whose conditions are evaluated for each ticker
+        :param indicators: Optional indicators the strategy uses, in the BacktestAI format, e.g.
+        [{"name": "rsi_20", "indicator": "rsi", "args": 20}], added to each ticker's data
+        :param weighting: "equal" splits the capital equally between the held tickers, "capped" does the same but no
+        ticker gets more than max_weight and the rest is kept in cash
+        :param max_weight: The largest weight of a ticker with "capped" weighting, e.g. 0.1
+        """
+        if weighting not in ("equal", "capped"):
+            raise ValueError(f"The weighting '{weighting}' is not 'equal' or 'capped'.")
+        if weighting == "capped" and max_weight is None:
+            raise ValueError("Capped weighting needs a max_weight.")
+
+        self.strategy = strategy
+        self.indicators = indicators or []
+        self.weighting = weighting
+        self.max_weight = max_weight
+
+    def align(self, frames: dict, names: set):
+        """
+        :param frames: DataFrame of each ticker, e.g. as returned by DataHelper.load_many
+        :param names: The columns to align
+        :return: Tuple of the union index, the tickers and a dict of (dates x tickers) arrays for each column, NaN where
+        a ticker has no bar
+        """
+        tickers = [ticker for ticker, frame in frames.items() if not frame.empty]
+
+        index = None
+        for ticker in tickers:
+            index = frames[ticker].index if index is None else index.union(frames[ticker].index)
+        if index is None:
+            index = pd.DatetimeIndex([])
+
+        columns = {}
+        for name in names:
+            matrix = np.full((len(index), len(tickers)), np.nan)
+            for j, ticker in enumerate(tickers):
+                frame = frames[ticker]
+                if name in frame.columns:
+                    values = frame[name].to_numpy(dtype=np.float64)
+                    matrix[:, j] = values if frame.index.equals(index) else frame[name].reindex(index).to_numpy()
+            columns[name] = matrix
+
+        return index, tickers, columns
+
+    def _add_indicators(self, frames: dict):
+        """
+        :return dict: The frames with the indicators added, each computed on the ticker's own bars
+        """
+        if not self.indicators:
+            return frames
+
+        added = {}
+        for ticker, frame in frames.items():
+            bars = frame.dropna(how="all")
+            indicators = Indicators(bars)
+            values = {indicator["name"]: getattr(indicators, indicator["indicator"])(indicator["args"])
+                      for indicator in self.indicators}
+            added[ticker] = frame.assign(**{name: series.reindex(frame.index) for name, series in values.items()})
+
+        return added
+
+    def weights(self, in_position):
+        """
+        :param in_position: Boolean (dates x tickers) array of the tickers held from the close of each bar
+        :return: (dates x tickers) array of the weight of each ticker
+        """
+        held = np.count_nonzero(in_position, axis=1)[:, None]
+
+        weights = np.divide(in_position, held, out=np.zeros(in_position.shape), where=held > 0)
+        if self.weighting == "capped":
+            np.minimum(weights, self.max_weight, out=weights)
+
+        return weights
+
+    def run(self, frames: dict, cash: float = 1000):
+        """
+        Evaluates the strategy's conditions on every ticker at once over a (dates x tickers) matrix and rebalances to
+        the target weights at the close of every bar
+        :param frames: DataFrame of each ticker with Datetime index and OHLC format, e.g. as returned by
+        DataHelper.load_many
+        :param cash: The initial capital
+        :return PortfolioResult: The metrics, equity curves and weights of the portfolio
+        """
+        print("Running portfolio...")
+
+        frames = self._add_indicators(frames)
+        buys, sells = self.strategy.compile()
+        names = set().union({"close"}, *(condition.columns for condition in buys + sells))
+
+        index, tickers, columns = self.align(frames, names)
+        shape = (len(index), len(tickers))
+
+        # Signals only fire at bars where every column the strategy uses is there, a missing bar keeps the position
+        valid = np.ones(shape, dtype=bool)
+        for name in names:
+            valid &= ~np.isnan(columns[name])
+
+        with np.errstate(invalid="ignore"):
+            buy_signal = np.broadcast_to(combine_conditions(buys, columns, shape), shape) & valid
+            sell_signal = np.broadcast_to(combine_conditions(sells, columns, shape), shape) & valid
+
+        holding = holding_states(buy_signal.T, sell_signal.T).T
+
+        # A held ticker keeps its last close through missing bars, so it grows flat across a gap and catches up on the
+        # next bar it trades
+        close = pd.DataFrame(columns["close"]).ffill().to_numpy()
+        listed = ~np.isnan(close)
+        last_bar = np.where(listed, np.arange(len(index))[:, None], -1).max(axis=0, initial=-1)
+
+        # As in simulate_trades, positions are held from one close to the next and sold on the last bar, which for a
+        # ticker whose data ends early is its own last bar
+        in_position = (holding == 1) & (np.arange(len(index))[:, None] < last_bar)
+        weights = self.weights(in_position)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            growth = np.where(listed[1:] & listed[:-1], close[1:] / close[:-1], 1.)
+
+        values = np.empty(len(index))
+        bah_values = np.empty(len(index))
+        if len(index):
+            returns = np.einsum("ij,ij->i", weights[:-1], growth - 1)
+            values[0] = cash
+            values[1:] = cash * np.cumprod(1 + returns)
+
+            # The benchmark is an equal-weight index rebalanced every bar between the listed tickers
+            priced = listed[1:] & listed[:-1]
+            bah_returns = np.divide(np.where(priced, growth - 1, 0).sum(axis=1), priced.sum(axis=1),
+                                    out=np.zeros(len(index) - 1), where=priced.any(axis=1))
+            bah_values[0] = cash
+            bah_values[1:] = cash * np.cumprod(1 + bah_returns)
+
+        # Each trade runs from the first bar held to the first bar not held, its return is the change in the ticker's
+        # cumulative growth over those bars
+        ticker_growth = np.ones(shape)
+        ticker_growth[1:] = np.where(in_position[:-1], growth, 1.)
+        np.cumprod(ticker_growth, axis=0, out=ticker_growth)
+
+        was_in_position = np.zeros(shape, dtype=bool)
+        was_in_position[1:] = in_position[:-1]
+        entries = np.flatnonzero((in_position & ~was_in_position).T)
+        exits = np.flatnonzero((~in_position & was_in_position).T)
+        trade_returns = ticker_growth.T.ravel()[exits] / ticker_growth.T.ravel()[entries] - 1
+
+        final_val = values[-1] if len(index) else cash
+        num_trades = len(trade_returns)
+        win_rate = np.count_nonzero(trade_returns > 0) / num_trades if num_trades > 0 else 0
+
+        print(f"Final Value: {final_val:.2f}")
+        print(f"Total Return: {(final_val / cash - 1) * 100:.2f}%")
+        print(f"Win Rate: {win_rate * 100:.2f}%")
+        print(f"Total Trades: {num_trades}")
+
+        return PortfolioResult(final_val, final_val / cash - 1, num_trades, win_rate, index, tickers, values,
+                               bah_values, weights, trade_returns)
@@ -0,0 +1,214 @@
+# Class for Monte Carlo robustness tests of backtest results
+import numpy as np
+import pandas as pd
+
+from backtest import Backtest, BacktestResult, combine_conditions, holding_states
+from indicators import IndicatorCache, Indicators
+
+# Columns the close noise leaves unchanged, any other column the conditions use is recomputed on each path
+_UNCHANGED_COLUMNS = {"open", "high", "low", "volume", "days_to_earnings"}
+# Indicators that only read the close through pandas operations, so they are computed for every path of a chunk at
+# once from a (bars x paths) DataFrame of closes. The others are computed path by path
+_PATH_INDICATORS = {"sma", "ema", "rsi", "bollinger_band_lower", "bollinger_band_upper", "macd"}
+
+
+class _Paths:
+    """
+    Stands in for the data of Indicators, with the noisy closes of a chunk of paths as a (bars x paths) DataFrame
+    """
+
+    def __init__(self, index: pd.Index, close: np.ndarray):
+        self.index = index
+        self._close = pd.DataFrame(close.T, index=index)
+
+    def __getitem__(self, name: str):
+        if name != "close":
+            raise KeyError(name)
+        return self._close
+
+    def __contains__(self, name: str):
+        return name == "close"
+
+
+def path_values(close, holding, cash=1000):
+    """
+    Equity of each path of the long-only strategy as in simulate_trades, vectorised over the paths rather than the
+    trades, with any open position sold on the last bar
+    :param close: 2D array of close prices, one path per row
+    :param holding: 2D array of holding states of the same shape
+    :param cash: The initial capital
+    :return: 2D array of the strategy values of each path
+    """
+    # A position held at the close of a bar earns the change to the next close
+    in_position = holding[:, :-1] == 1
+
+    values = np.ones(close.shape)
+    np.divide(close[:, 1:], close[:, :-1], out=values[:, 1:], where=in_position)
+    np.cumprod(values, axis=1, out=values)
+    values *= cash
+
+    return values
+
+
+def max_drawdowns(values):
+    """
+    :param values: 2D array of equity paths, one path per row
+    :return: Array of the largest fall from a running peak of each path, e.g. -0.2 for 20%
+    """
+    return np.min(values / np.maximum.accumulate(values, axis=1), axis=1) - 1
+
+
+class MonteCarlo:
+
+    def __init__(self, result: BacktestResult, n_paths: int = 10_000, seed: int = 42, chunk_size: int = 1000):
+        """
+        Resamples the result of Backtest.run_strategy into many equity paths, generated in chunks of paths so memory
+        stays bounded however many paths are asked for
+        :param result: The BacktestResult to test
+        :param n_paths: The number of paths
+        :param seed: The random seed, the same seed and chunk size always give the same paths
+        :param chunk_size: The number of paths generated at a time
+        """
+        self.result = result
+        self.n_paths = n_paths
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.start = 1000  # Initial capital, as in run_strategy
+
+    def _chunks(self):
+        """
+        :return: Generator of the number of paths in each chunk
+        """
+        for first in range(0, self.n_paths, self.chunk_size):
+            yield min(self.chunk_size, self.n_paths - first)
+
+    def trade_shuffles(self):
+        """
+        Reorders the trades of the result, which keeps the final value but changes the drawdowns. The drawdowns are
+        measured between trades, as the bars within a trade are not reordered
+        :return: Generator of 2D arrays of the equity after each trade, starting from the initial capital
+        """
+        rng = np.random.default_rng(self.seed)
+        growth = 1 + np.asarray(self.result.trade_returns, dtype=np.float64)
+
+        for size in self._chunks():
+            values = np.empty((size, len(growth) + 1))
+            values[:, 0] = self.start
+            values[:, 1:] = rng.permuted(np.broadcast_to(growth, (size, len(growth))), axis=1)
+            yield np.cumprod(values, axis=1)
+
+    def block_bootstraps(self, block_size: int = 20):
+        """
+        Rebuilds the bar returns of the strategy from blocks of consecutive bars drawn with replacement, so the
+        short-term dependence between returns is kept
+        :param block_size: The number of bars in each block
+        :return: Generator of 2D arrays of the equity at each bar, starting from the initial capital
+        """
+        rng = np.random.default_rng(self.seed)
+        values = np.asarray(self.result.strategy_values, dtype=np.float64)
+        growth = values[1:] / values[:-1]
+
+        n_returns = len(growth)
+        block_size = max(1, min(block_size, n_returns))
+        n_blocks = -(-n_returns // block_size)
+
+        for size in self._chunks():
+            paths = np.empty((size, n_returns + 1))
+            paths[:, 0] = self.start
+
+            if n_returns:
+                starts = rng.integers(0, n_returns - block_size + 1, size=(size, n_blocks))
+                bars = (starts[:, :, None] + np.arange(block_size)).reshape(size, -1)[:, :n_returns]
+                paths[:, 1:] = growth[bars]
+
+            yield np.cumprod(paths, axis=1)
+
+    def close_noise(self, backtest: Backtest, df: pd.DataFrame = None, noise: float = 0.001, indicators: list = None):
+        """
+        Multiplies the close by random noise and reruns the signals and trades of each path. The indicators the
+        conditions use are computed again from each noisy close, so they have to be given unless the conditions only
+        use the prices. The moving averages, RSI, MACD and Bollinger Bands are computed for a whole chunk of paths at
+        once, the other indicators once per path, which is much slower
+        :param backtest: The Backtest that produced the result
+        :param df: The data the result was run on, defaults to the result's data
+        :param noise: The standard deviation of the relative noise, e.g. 0.001 for 0.1%
+        :param indicators: The indicators the conditions use, in the BacktestAI format, e.g.
+        [{"name": "rsi_14", "indicator": "rsi", "args": 14}]
+        :return: Generator of 2D arrays of the equity at each bar, starting from the initial capital
+        """
+        rng = np.random.default_rng(self.seed)
+        df = self.result.data if df is None else df
+        indicators = indicators or []
+
+        rows, columns, _, _, _ = backtest.signal_arrays(df)
+        stale = set(columns) - _UNCHANGED_COLUMNS - {"close"} - {indicator["name"] for indicator in indicators}
+        if stale:
+            raise ValueError(f"The columns {sorted(stale)} may be computed from the close, pass their indicators so "
+                             f"they are recomputed on each path.")
+
+        buys, sells = backtest.strategy.compile()
+        close = df["close"].to_numpy(dtype=np.float64)
+        # Each path's indicators are used once, so they are not kept in a cache
+        no_cache = IndicatorCache(max_bytes=0)
+
+        for size in self._chunks():
+            shape = (size, len(columns["close"]))
+            noisy_close = close * (1 + noise * rng.standard_normal((size, len(close))))
+            noisy = dict(columns, close=noisy_close[:, rows])
+
+            paths = Indicators(_Paths(df.index, noisy_close), no_cache, data_key="noise")
+            for indicator in indicators:
+                if indicator["indicator"] in _PATH_INDICATORS:
+                    values = getattr(paths, indicator["indicator"])(indicator["args"])
+                    noisy[indicator["name"]] = values.to_numpy()[rows].T
+                    continue
+
+                noisy[indicator["name"]] = np.empty(shape)
+                for path in range(size):
+                    path_indicators = Indicators(df.assign(close=noisy_close[path]), no_cache, data_key="noise")
+                    values = getattr(path_indicators, indicator["indicator"])(indicator["args"])
+                    noisy[indicator["name"]][path] = values.to_numpy()[rows]
+
+            buy_signals = np.broadcast_to(combine_conditions(buys, noisy, shape), shape)
+            sell_signals = np.broadcast_to(combine_conditions(sells, noisy, shape), shape)
+
+            yield path_values(noisy["close"], holding_states(buy_signals, sell_signals), self.start)
+
+    def _generate(self, method: str, **kwargs):
+        methods = {"shuffle": self.trade_shuffles, "bootstrap": self.block_bootstraps, "noise": self.close_noise}
+        if method not in methods:
+            raise ValueError(f"The method '{method}' is not one of {list(methods)}.")
+
+        return methods[method](**kwargs)
+
+    def paths(self, method: str = "bootstrap", **kwargs):
+        """
+        :param method: "shuffle", "bootstrap" or "noise"
+        :param kwargs: Passed to the method, e.g. block_size, or backtest, noise and indicators
+        :return: 2D array of every equity path, one path per row
+        """
+        return np.concatenate(list(self._generate(method, **kwargs)))
+
+    def confidence_intervals(self, method: str = "bootstrap", levels: tuple = (0.05, 0.5, 0.95), **kwargs):
+        """
+        Only the return and drawdown of each path are kept from each chunk, so the memory is bounded by the chunk size
+        :param method: "shuffle", "bootstrap" or "noise"
+        :param levels: The quantiles of the paths, e.g. (0.05, 0.5, 0.95) for a 90% interval and the median
+        :param kwargs: Passed to the method, e.g. block_size, or backtest, noise and indicators
+        :return: DataFrame with the return and max drawdown of the result and their quantiles over the paths
+        """
+        returns, drawdowns = [], []
+        for values in self._generate(method, **kwargs):
+            returns.append(values[:, -1] / self.start - 1)
+            drawdowns.append(max_drawdowns(values))
+
+        if method == "shuffle":
+            observed = self.start * np.cumprod(np.concatenate(([1.], 1 + np.asarray(self.result.trade_returns))))
+        else:
+            observed = np.asarray(self.result.strategy_values, dtype=np.float64)
+        observed = observed[None, :]
+        intervals = pd.DataFrame(np.quantile([np.concatenate(returns), np.concatenate(drawdowns)], levels, axis=1).T,
+                                 index=["return", "max_drawdown"], columns=list(levels))
+        intervals.insert(0, "observed", [self.result.pct_chg, max_drawdowns(observed)[0]])
+
+        return intervals
@@ -0,0 +1,197 @@
+# Class for scanning a universe of tickers
+import contextlib
+import io
+import os
+from multiprocessing import Pool, current_process
+
+import numpy as np
+import pandas as pd
+
+from backtest import Backtest
+from datahelper import DataHelper
+from datastore import OHLCVStore
+from indicators import indicator_cache
+from strategy import Strategy
+from tickers import ticker_reference
+
+# Settings for the scan, set in each worker process by _init_worker
+_JOB = {}
+
+
+def _init_worker(job: dict):
+    """
+    Sets up a worker process for the scan. A spawned worker gets a small indicator cache, as indicators are not shared
+    between tickers, while a scan run in-process leaves the caller's cache as it is
+    """
+    global _JOB
+
+    _JOB = dict(job)
+    _JOB["store"] = OHLCVStore(job["store_root"]) if job["store_root"] is not None else None
+
+    if current_process().name != "MainProcess":
+        indicator_cache.clear()
+        indicator_cache.max_bytes = 32 * 1024 ** 2
+
+
+def _release_worker():
+    """
+    Drops the scan settings
+    """
+    global _JOB
+
+    _JOB = {}
+
+
+def _load(ticker: str):
+    """
+    :return DataHelper: The helper with the ticker's data, its earnings and indicators added
+    """
+    store = _JOB["store"]
+    helper = DataHelper(store=store)
+
+    if store is not None and not _JOB["download"]:
+        data = store.read(ticker, _JOB["interval"], _JOB["period"])
+        if data.empty:
+            raise ValueError(f"There is no stored data for {ticker}.")
+        helper.load_data(data, _JOB["interval"])
+    else:
+        helper.load_ydata(ticker, _JOB["period"], _JOB["interval"])
+        if helper.data.empty:
+            raise ValueError(f"Data from Yahoo Finance could not be downloaded for {ticker}.")
+
+    if _JOB["earnings"]:
+        helper.add_next_earnings(ticker)
+
+    for indicator in _JOB["indicators"]:
+        helper.add_indicator(indicator["name"], indicator["indicator"], indicator["args"],
+                             interval=indicator.get("interval"))
+
+    return helper
+
+
+def _scan_ticker(ticker: str):
+    """
+    Backtests the strategy on one ticker, returning its metrics or the error that stopped it
+    """
+    row = {"ticker": ticker, "final_val": np.nan, "pct_chg": np.nan, "num_trades": 0, "win_rate": np.nan,
+           "bah_pct_chg": np.nan, "bars": 0, "error": None}
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            helper = _load(ticker)
+            result = Backtest(_JOB["strategy"]).run_strategy(helper.data, plot=False)
+
+        row.update(final_val=result.final_val, pct_chg=result.pct_chg, num_trades=result.num_trades,
+                   win_rate=result.win_rate, bah_pct_chg=result.bah_pct_chg, bars=len(result.dates))
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+
+    return row
+
+
+class Scan:
+
+    def __init__(self, strategy: Strategy, indicators: list):
+        """
+        :param strategy: The Strategy to run on every ticker
+        :param indicators: The indicators the strategy uses, in the BacktestAI format, e.g.
+        [{"name": "rsi_20", "indicator": "rsi", "args": 20}]
+        """
+        self.strategy = strategy
+        self.indicators = indicators
+
+    def _uses_earnings(self):
+        buys, sells = self.strategy.compile()
+        return any("days_to_earnings" in condition.columns for condition in buys + sells)
+
+    def _prefetch(self, tickers: list, period: str, interval: str, store: OHLCVStore, chunk_size: int):
+        """
+        Yields the tickers, first bringing each chunk up to date in the store with one grouped download. With a pool
+        this runs in its task thread, so the next chunk downloads while the workers scan the last one
+        """
+        helper = DataHelper(store=store)
+
+        for i in range(0, len(tickers), chunk_size):
+            chunk = tickers[i:i + chunk_size]
+            try:
+                helper.load_many(chunk, period, interval)
+            except Exception as e:
+                print(f"The download of {chunk[0]} to {chunk[-1]} failed, the stored data is used: {e}")
+
+            yield from chunk
+
+    def iter_results(self, tickers: list = None, period: str = "1y", interval: str = "1d", exchange: str = None,
+                     store: OHLCVStore = None, download: bool = True, processes: int = None, chunk_size: int = 50):
+        """
+        Runs the strategy on every ticker, yielding the metrics of each ticker as it finishes
+        :param tickers: The tickers to scan, or None for every ticker of the exchange in the SEC list
+        :param period: The period of data to backtest
+        :param interval: The interval of data
+        :param exchange: The exchange scanned when no tickers are given, e.g. "NYSE" or "Nasdaq"
+        :param store: Optional OHLCVStore the data is loaded through. Each chunk of tickers is brought up to date with
+        one grouped download before the workers read it
+        :param download: Whether to download data, False scans only the data already in the store
+        :param processes: The number of worker processes, defaults to the number of CPUs. Use 1 to run in-process
+        :param chunk_size: The number of tickers downloaded together and handed to a worker at a time
+        :return: Generator of dicts with the ticker, final_val, pct_chg, num_trades, win_rate, bah_pct_chg, bars and
+        error, which is None unless the ticker failed
+        """
+        if tickers is None:
+            tickers = ticker_reference.tickers(exchange)
+        tickers = list(dict.fromkeys(tickers))
+
+        job = {
+            "strategy": self.strategy,
+            "indicators": self.indicators,
+            "period": period,
+            "interval": interval,
+            "earnings": self._uses_earnings(),
+            "store_root": store.root if store is not None else None,
+            "download": download,
+        }
+
+        if store is not None and download:
+            tickers = self._prefetch(tickers, period, interval, store, chunk_size)
+            job["download"] = False
+
+        processes = processes or os.cpu_count()
+
+        if processes == 1:
+            _init_worker(job)
+            try:
+                for ticker in tickers:
+                    yield _scan_ticker(ticker)
+            finally:
+                _release_worker()
+        else:
+            with Pool(processes, initializer=_init_worker, initargs=(job,), maxtasksperchild=chunk_size * 4) as pool:
+                yield from pool.imap_unordered(_scan_ticker, tickers, chunksize=max(1, chunk_size // processes))
+
+    def run(self, tickers: list = None, period: str = "1y", interval: str = "1d", callback=None,
+            sort_by: str = "pct_chg", **kwargs):
+        """
+        :param tickers: The tickers to scan, or None for every ticker of the exchange in the SEC list
+        :param period: The period of data to backtest
+        :param interval: The interval of data
+        :param callback: Optional function called with the metrics of each ticker as it finishes, e.g. to update a
+        table in the app
+        :param sort_by: The metric used to rank the tickers
+        :param kwargs: Passed to iter_results, e.g. exchange, store, download, processes and chunk_size
+        :return: DataFrame with the metrics of each ticker, best first, failed tickers last with their error
+        """
+        print("Running scan...")
+
+        rows = []
+        for row in self.iter_results(tickers, period, interval, **kwargs):
+            rows.append(row)
+            if callback is not None:
+                callback(row)
+
+        results = pd.DataFrame(rows, columns=["ticker", "final_val", "pct_chg", "num_trades", "win_rate",
+                                              "bah_pct_chg", "bars", "error"])
+        results = results.sort_values(sort_by, ascending=False, na_position="last", ignore_index=True)
+
+        failed = results["error"].notna().sum()
+        print(f"Scan complete: {len(results) - failed} tickers tested, {failed} failed.")
+
+        return results
@@ -1,4 +1,6 @@
 # Class for defining strategies
+from conditions import compile_condition
+
 
 class Strategy:
     def __init__(self):
@@ -6,10 +8,12 @@ class Strategy:
         self.sells = []
 
     def add_buy_signal(self, condition: str):
+        compile_condition(condition)
         self.buys.append(condition)
         print(f"Adding buy condition {condition}")
 
     def add_sell_signal(self, condition: str):
+        compile_condition(condition)
         self.sells.append(condition)
         print(f"Adding sell condition {condition}")
 
@@ -20,3 +24,12 @@ class Strategy:
     def remove_sell_signal(self, condition: str):
         self.sells.remove(condition)
         print(f"Removing sell condition {condition}")
+
+    def compile(self):
+        """
+        :return: Tuple of the compiled buy and sell conditions, parsed once per condition string
+        """
+        buys = [compile_condition(condition) for condition in self.buys]
+        sells = [compile_condition(condition) for condition in self.sells]
+
+        return buys, sells
@@ -0,0 +1,361 @@
+# Classes for streaming indicators and signals
+import abc
+import math
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from backtest import combine_conditions
+
+
+class StreamingIndicator(abc.ABC):
+    """
+    Base class for indicators that update in O(1) as each bar is appended
+    """
+
+    def __init__(self):
+        self.value = np.nan
+
+    @abc.abstractmethod
+    def update(self, bar: dict):
+        """
+        :param bar: The new bar with open, high, low, close and volume keys
+        :return: The indicator value for the new bar, NaN during warm-up
+        """
+
+
+class _RollingWindow:
+    """
+    Rolling mean and variance over the last n values, using the same Kahan/Welford updates as pandas rolling so the
+    results match Series.rolling(n).mean() and .std()
+    """
+
+    # Relative drop in the sum of squares that triggers a recompute of the variance, as in pandas
+    inv_cond_tol = np.finfo(np.float64).eps * 1e3
+
+    def __init__(self, n_days: int):
+        self.n_days = n_days
+        self.values = deque()
+
+        self.nobs = 0
+        self.neg_ct = 0
+        self.sum_x = 0.0
+        self.compensation_add = 0.0
+        self.compensation_remove = 0.0
+        self.num_consecutive_same_value = 0
+        self.prev_value = None
+
+        self.var_nobs = 0.0
+        self.mean_x = 0.0
+        self.ssqdm_x = 0.0
+        self.var_compensation_add = 0.0
+        self.var_compensation_remove = 0.0
+        self.numerically_unstable = False
+
+    def append(self, val: float):
+        if self.prev_value is None:
+            self.prev_value = val
+
+        self.values.append(val)
+        if len(self.values) > self.n_days:
+            removed = self.values.popleft()
+            self._remove_mean(removed)
+            self._remove_var(removed)
+        self._add_mean(val)
+        self._add_var(val)
+
+        if self.numerically_unstable:
+            self.var_nobs = self.mean_x = self.ssqdm_x = 0.0
+            self.var_compensation_add = self.var_compensation_remove = 0.0
+            for value in self.values:
+                self._add_var(value)
+            self.numerically_unstable = False
+
+    def _add_mean(self, val: float):
+        if val != val:
+            return
+
+        self.nobs += 1
+        y = val - self.compensation_add
+        t = self.sum_x + y
+        self.compensation_add = t - self.sum_x - y
+        self.sum_x = t
+        if math.copysign(1, val) < 0:
+            self.neg_ct += 1
+
+        if val == self.prev_value:
+            self.num_consecutive_same_value += 1
+        else:
+            self.num_consecutive_same_value = 1
+        self.prev_value = val
+
+    def _remove_mean(self, val: float):
+        if val != val:
+            return
+
+        self.nobs -= 1
+        y = -val - self.compensation_remove
+        t = self.sum_x + y
+        self.compensation_remove = t - self.sum_x - y
+        self.sum_x = t
+        if math.copysign(1, val) < 0:
+            self.neg_ct -= 1
+
+    def _add_var(self, val: float):
+        if val != val:
+            return
+
+        prev_m2 = self.ssqdm_x
+        self.var_nobs += 1
+        prev_mean = self.mean_x - self.var_compensation_add
+        y = val - self.var_compensation_add
+        t = y - self.mean_x
+        self.var_compensation_add = t + self.mean_x - y
+        self.mean_x = self.mean_x + t / self.var_nobs
+        self.ssqdm_x = self.ssqdm_x + (val - prev_mean) * (val - self.mean_x)
+
+        if prev_m2 * self.inv_cond_tol > self.ssqdm_x:
+            self.numerically_unstable = True
+
+    def _remove_var(self, val: float):
+        if val != val:
+            return
+
+        prev_m2 = self.ssqdm_x
+        self.var_nobs -= 1
+        if self.var_nobs:
+            prev_mean = self.mean_x - self.var_compensation_remove
+            y = val - self.var_compensation_remove
+            t = y - self.mean_x
+            self.var_compensation_remove = t + self.mean_x - y
+            self.mean_x = self.mean_x - t / self.var_nobs
+            self.ssqdm_x = self.ssqdm_x - (val - prev_mean) * (val - self.mean_x)
+
+            if prev_m2 * self.inv_cond_tol > self.ssqdm_x:
+                self.numerically_unstable = True
+        else:
+            self.mean_x = 0.0
+            self.ssqdm_x = 0.0
+            self.numerically_unstable = False
+
+    def mean(self):
+        if self.nobs < self.n_days or self.nobs == 0:
+            return np.nan
+
+        result = self.sum_x / self.nobs
+        if self.num_consecutive_same_value >= self.nobs:
+            result = self.prev_value
+        elif self.neg_ct == 0 and result < 0:
+            result = 0.0
+        elif self.neg_ct == self.nobs and result > 0:
+            result = 0.0
+
+        return result
+
+    def std(self):
+        if self.var_nobs < max(self.n_days, 1) or self.var_nobs <= 1:
+            return np.nan
+
+        result = self.ssqdm_x / (self.var_nobs - 1)
+        return math.sqrt(result) if result > 0 else 0.0
+
+
+class _EWM:
+    """
+    Exponentially weighted mean using the same recursion as pandas ewm(...).mean()
+    """
+
+    def __init__(self, com: float, adjust: bool, min_periods: int = 0):
+        self.com = com
+        alpha = 1. / (1. + com)
+        self.old_wt_factor = 1. - alpha
+        self.new_wt = 1. if adjust else alpha
+        self.adjust = adjust
+        self.min_periods = max(min_periods, 1)
+
+        self.weighted = None
+        self.old_wt = 1.
+        self.nobs = 0
+
+    def append(self, cur: float):
+        is_observation = cur == cur
+        self.nobs += is_observation
+
+        if self.weighted is None:
+            self.weighted = cur
+        elif self.weighted == self.weighted:
+            # Missing values still decay the weight of the earlier values, as with ignore_na=False
+            self.old_wt *= self.old_wt_factor
+            if is_observation:
+                if self.weighted != cur:
+                    if not self.adjust and self.com == 1:
+                        self.new_wt = 1. - self.old_wt
+                    self.weighted = self.old_wt * self.weighted + self.new_wt * cur
+                    self.weighted /= (self.old_wt + self.new_wt)
+                if self.adjust:
+                    self.old_wt += self.new_wt
+                else:
+                    self.old_wt = 1.
+        elif is_observation:
+            self.weighted = cur
+
+        return self.weighted if self.nobs >= self.min_periods else np.nan
+
+
+class StreamingSMA(StreamingIndicator):
+
+    def __init__(self, n_days):
+        super().__init__()
+        self.window = _RollingWindow(n_days)
+
+    def update(self, bar: dict):
+        self.window.append(float(bar["close"]))
+        self.value = self.window.mean()
+        return self.value
+
+
+class StreamingEMA(StreamingIndicator):
+
+    def __init__(self, n_days):
+        super().__init__()
+        self.ewm = _EWM(com=(n_days - 1) / 2, adjust=False)
+
+    def update(self, bar: dict):
+        self.value = self.ewm.append(float(bar["close"]))
+        return self.value
+
+
+class StreamingRSI(StreamingIndicator):
+
+    def __init__(self, n_days):
+        super().__init__()
+        alpha = 1 / n_days
+        self.ewm_up = _EWM(com=(1 - alpha) / alpha, adjust=True, min_periods=n_days)
+        self.ewm_dwn = _EWM(com=(1 - alpha) / alpha, adjust=True, min_periods=n_days)
+        self.prev_close = np.nan
+
+    def update(self, bar: dict):
+        close = float(bar["close"])
+        diff = close - self.prev_close
+        self.prev_close = close
+
+        ema_up = np.float64(self.ewm_up.append(diff if diff > 0 else 0.0))
+        ema_dwn = np.float64(self.ewm_dwn.append(-(diff if diff < 0 else 0.0)))
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rs = ema_up / ema_dwn
+            self.value = float(100 - (100 / (1 + rs)))
+
+        return self.value
+
+
+class _StreamingBollinger(StreamingIndicator):
+
+    multiplier = 2
+    side = 1
+
+    def __init__(self, n_days=20):
+        super().__init__()
+        self.window = _RollingWindow(n_days)
+
+    def update(self, bar: dict):
+        self.window.append(float(bar["close"]))
+        self.value = self.window.mean() + self.side * (self.multiplier * self.window.std())
+        return self.value
+
+
+class StreamingBollingerLower(_StreamingBollinger):
+    side = -1
+
+
+class StreamingBollingerUpper(_StreamingBollinger):
+    side = 1
+
+
+class StreamingMACD(StreamingIndicator):
+
+    def __init__(self, *args):
+        super().__init__()
+        self.short_ema = StreamingEMA(12)
+        self.long_ema = StreamingEMA(26)
+
+    def update(self, bar: dict):
+        self.value = self.short_ema.update(bar) - self.long_ema.update(bar)
+        return self.value
+
+
+class StreamingOBV(StreamingIndicator):
+
+    def __init__(self, *args):
+        super().__init__()
+        self.prev_close = None
+
+    def update(self, bar: dict):
+        close = bar["close"]
+
+        if self.prev_close is None:
+            self.value = 0
+        elif close > self.prev_close:
+            self.value = self.value + bar["volume"]
+        elif close < self.prev_close:
+            self.value = self.value - bar["volume"]
+
+        self.prev_close = close
+        return self.value
+
+
+# Streaming equivalent of each Indicators method
+STREAMING_INDICATORS = {
+    "sma": StreamingSMA,
+    "ema": StreamingEMA,
+    "rsi": StreamingRSI,
+    "bollinger_band_lower": StreamingBollingerLower,
+    "bollinger_band_upper": StreamingBollingerUpper,
+    "macd": StreamingMACD,
+    "on_balance_volume": StreamingOBV,
+}
+
+
+class StreamingBacktest:
+
+    def __init__(self, strategy, indicators: list):
+        """
+        Incremental version of Backtest.generate_signals that keeps the latest holding state as bars arrive
+        :param strategy: The Strategy to monitor
+        :param indicators: The indicators in the BacktestAI format, e.g. [{"name": "rsi_20", "indicator": "rsi", "args": 20}]
+        """
+        self.buys, self.sells = strategy.compile()
+        self.indicators = {}
+
+        for indicator in indicators:
+            args = indicator["args"] if isinstance(indicator["args"], list) else [indicator["args"]]
+            self.indicators[indicator["name"]] = STREAMING_INDICATORS[indicator["indicator"]](*args)
+
+        self.holding_signal = None
+
+    def update(self, bar: dict):
+        """
+        :param bar: The new bar with open, high, low, close and volume keys, plus any other columns the conditions use
+        :return: The latest holding state, 1 when in a position, 0 when not and None until every value is warmed up
+        """
+        row = dict(bar)
+        for name, indicator in self.indicators.items():
+            row[name] = indicator.update(bar)
+
+        # Bars with missing values are dropped by generate_signals, so they leave the state unchanged
+        if any(np.ndim(value) == 0 and pd.isna(value) for value in row.values()):
+            return self.holding_signal
+
+        columns = {name: np.array([value]) for name, value in row.items()}
+        buy = bool(combine_conditions(self.buys, columns, 1)[0])
+        sell = bool(combine_conditions(self.sells, columns, 1)[0])
+
+        if self.holding_signal is None:
+            self.holding_signal = int(buy)
+        elif buy and not sell:
+            self.holding_signal = 1
+        elif sell and not buy:
+            self.holding_signal = 0
+
+        return self.holding_signal
@@ -0,0 +1,235 @@
+# Class for parameter sweeps
+import contextlib
+import functools
+import itertools
+import os
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+import pandas as pd
+
+from backtest import combine_conditions, holding_state, simulate_trades
+from conditions import compile_condition
+from indicators import Indicators
+
+# Column data for the sweep, set in each worker process by _init_worker
+_COLUMNS = {}
+_VALID = None
+_LENGTH = 0
+_SHARED = None
+
+
+def _init_worker(shm_name: str, shape: tuple, names: list, base_names: list):
+    """
+    Attaches a worker process to the shared memory block holding the OHLCV and indicator arrays
+    """
+    global _COLUMNS, _VALID, _LENGTH, _SHARED
+
+    _SHARED = shared_memory.SharedMemory(name=shm_name)
+    block = np.ndarray(shape, dtype=np.float64, buffer=_SHARED.buf)
+
+    _COLUMNS = dict(zip(names, block))
+    _LENGTH = shape[1]
+    _VALID = ~np.isnan(block[[names.index(name) for name in base_names]]).any(axis=0)
+    _evaluate.cache_clear()
+
+
+@functools.lru_cache(maxsize=256)
+def _evaluate(conditions: tuple):
+    """
+    Evaluates the combined conditions over the full history, cached as they repeat across combinations
+    """
+    return combine_conditions([compile_condition(condition) for condition in conditions], _COLUMNS, _LENGTH)
+
+
+def _simulate(combination: dict, rows: slice = slice(None)):
+    """
+    Runs a single combination over a slice of the shared arrays
+    :return: Tuple of the metrics, the strategy values and the mask of the valid rows within the slice, the strategy
+    values are None when no row is valid
+    """
+    valid = _VALID[rows].copy()
+    for name in combination["columns"]:
+        valid &= ~np.isnan(_COLUMNS[name][rows])
+
+    if not valid.any():
+        return dict(combination["params"], final_val=np.nan, pct_chg=np.nan, num_trades=0, win_rate=0), None, valid
+
+    buy_signal = _evaluate(tuple(combination["buys"]))[rows][valid]
+    sell_signal = _evaluate(tuple(combination["sells"]))[rows][valid]
+
+    start = 1000
+    strategy_values, _, trade_returns, _, _ = simulate_trades(_COLUMNS["close"][rows][valid],
+                                                              holding_state(buy_signal, sell_signal), start)
+
+    final_val = strategy_values[-1]
+    num_trades = len(trade_returns)
+    win_rate = np.count_nonzero(trade_returns > 0) / num_trades if num_trades > 0 else 0
+
+    metrics = dict(combination["params"], final_val=final_val, pct_chg=(final_val / start) - 1,
+                   num_trades=num_trades, win_rate=win_rate)
+
+    return metrics, strategy_values, valid
+
+
+def _run_combination(combination: dict):
+    """
+    Runs a single combination against the shared arrays and returns its metrics
+    """
+    return _simulate(combination)[0]
+
+
+def _release_worker():
+    """
+    Drops the views onto the shared memory block and detaches from it
+    """
+    global _COLUMNS, _VALID, _SHARED
+
+    _COLUMNS = {}
+    _VALID = None
+    _evaluate.cache_clear()
+    if _SHARED is not None:
+        _SHARED.close()
+        _SHARED = None
+
+
+def _render(template, params: dict):
+    """
+    Fills the parameters into a template, a template that is a single placeholder keeps the parameter's type
+    """
+    if isinstance(template, str):
+        if template.startswith("{") and template.endswith("}") and template[1:-1] in params:
+            return params[template[1:-1]]
+        return template.format(**params)
+
+    if isinstance(template, (list, tuple)):
+        return [_render(item, params) for item in template]
+
+    return template
+
+
+class Sweep:
+
+    def __init__(self, buys: list, sells: list, indicators: list, params: dict):
+        """
+        :param buys: The buy condition templates, e.g. "rsi_{n} < {x}"
+        :param sells: The sell condition templates, e.g. "rsi_{n} > {y}"
+        :param indicators: The indicator templates in the BacktestAI format, e.g.
+        [{"name": "rsi_{n}", "indicator": "rsi", "args": "{n}"}]
+        :param params: The values to sweep for each parameter, e.g. {"n": range(5, 30), "x": [20, 30, 40]}
+        """
+        self.buys = buys
+        self.sells = sells
+        self.indicators = indicators
+        self.params = {name: list(values) for name, values in params.items()}
+
+    def combinations(self):
+        """
+        :return list: The parameter dictionaries for every combination of the sweep
+        """
+        names = list(self.params)
+        return [dict(zip(names, values)) for values in itertools.product(*self.params.values())]
+
+    def _compute_indicators(self, df: pd.DataFrame, combinations: list):
+        """
+        :return dict: Every distinct indicator of the sweep, computed once
+        """
+        indicators = Indicators(df)
+        computed = {}
+
+        for params in combinations:
+            for indicator in self.indicators:
+                name = _render(indicator["name"], params)
+                if name in computed:
+                    continue
+
+                args = _render(indicator["args"], params)
+                args = args if isinstance(args, list) else [args]
+                computed[name] = np.asarray(getattr(indicators, indicator["indicator"])(*args), dtype=np.float64)
+
+        return computed
+
+    def _jobs(self, combinations: list):
+        """
+        :return list: The columns and rendered conditions of each combination, as run by the workers
+        """
+        jobs = []
+        for params in combinations:
+            buys = [_render(condition, params) for condition in self.buys]
+            sells = [_render(condition, params) for condition in self.sells]
+
+            # Compiling here raises any invalid condition before the workers start
+            for condition in buys + sells:
+                compile_condition(condition)
+
+            jobs.append({
+                "params": params,
+                "columns": [_render(indicator["name"], params) for indicator in self.indicators],
+                "buys": buys,
+                "sells": sells,
+            })
+
+        return jobs
+
+    @contextlib.contextmanager
+    def _shared(self, df: pd.DataFrame, indicators: dict):
+        """
+        Context manager copying the numeric columns and the indicators into a shared memory block once, so every worker
+        reads the same arrays
+        :return: Yields the arguments of _init_worker
+        """
+        base = df.select_dtypes(include=["number", "bool"])
+        base_names = [name for name in base.columns if name not in indicators]
+        names = base_names + list(indicators)
+
+        shape = (len(names), len(df))
+        shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * 8))
+
+        block = None
+        try:
+            block = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+            for row, name in enumerate(names):
+                block[row] = base[name].to_numpy(dtype=np.float64) if name in base_names else indicators[name]
+            block = None
+
+            yield shm.name, shape, names, base_names
+        finally:
+            # The block cannot be closed while a view onto it is alive, and is unlinked even if closing fails
+            block = None
+            try:
+                shm.close()
+            finally:
+                shm.unlink()
+
+    def run(self, df: pd.DataFrame, processes: int = None, sort_by: str = "pct_chg"):
+        """
+        :param df: The data with Datetime index and OHLC format, as loaded by DataHelper
+        :param processes: The number of worker processes, defaults to the number of CPUs. Use 1 to run in-process
+        :param sort_by: The metric used to rank the combinations
+        :return: DataFrame with the parameters and metrics of each combination, best first
+        """
+        print("Running sweep...")
+
+        combinations = self.combinations()
+        indicators = self._compute_indicators(df, combinations)
+        jobs = self._jobs(combinations)
+
+        with self._shared(df, indicators) as init_args:
+            processes = processes or os.cpu_count()
+
+            if processes == 1:
+                try:
+                    _init_worker(*init_args)
+                    results = [_run_combination(job) for job in jobs]
+                finally:
+                    _release_worker()
+            else:
+                chunksize = max(1, len(jobs) // (processes * 8))
+                with Pool(processes, initializer=_init_worker, initargs=init_args) as pool:
+                    results = pool.map(_run_combination, jobs, chunksize=chunksize)
+
+        results = pd.DataFrame(results).sort_values(sort_by, ascending=False, ignore_index=True)
+
+        print(f"Sweep complete: {len(results)} combinations tested.")
+
+        return results
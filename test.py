@@ -1,9 +1,35 @@
+import json
+import tempfile
+import threading
+import time
 import unittest
+from multiprocessing import shared_memory
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+import conditions
+import sweep as sweep_module
 from ai_helper import BacktestAI
-from backtest import Backtest
-from datahelper import DataHelper
-from indicators import Indicators
+from benchmark import run_benchmarks, synthetic_ohlcv
+from backtestcache import BacktestCache
+from backtest import Backtest, holding_state, holding_states, lttb, simulate_trades
+from conditions import Condition, compile_condition
+from datahelper import DataHelper, SessionPool
+from datastore import OHLCVStore
+from earnings import EarningsCalendar, next_earnings
+from indicators import IndicatorCache, Indicators, indicator_cache
+from instrumentation import Instrumentation
+from kernels import ewm_many, trailing_stop
+from llm import CachedClient, StandInClient, parse_download_request
+from portfolio import Portfolio
+from robustness import MonteCarlo
+from scan import Scan
 from strategy import Strategy
+from streaming import STREAMING_INDICATORS, StreamingBacktest, StreamingIndicator
+from sweep import Sweep
+from tickers import TickerReference
+from walkforward import WalkForward
 
 
 class TestTradingBacktest(unittest.TestCase):
@@ -55,5 +81,726 @@ class TestTradingBacktest(unittest.TestCase):
         self.assertIn("sma_20", self.data.data.columns, "SMA should be calculated")
 
 
+class YahooStandIn(BaseHTTPRequestHandler):
+    """Local stand-in for the Yahoo Finance endpoints used by yfinance, serving 250 daily bars for any ticker"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests += 1
+
+        if self.path.startswith("/v8/finance/chart/"):
+            ticker = self.path.split("/")[4].split("?")[0]
+            stamps = (1_600_000_000 + 86_400 * np.arange(250)).tolist()
+            close = (100 + np.arange(250) * 0.5).tolist()
+            period = {"timezone": "EDT", "start": stamps[-1], "end": stamps[-1], "gmtoffset": -14400}
+            meta = {"currency": "USD", "symbol": ticker, "exchangeTimezoneName": "America/New_York",
+                    "instrumentType": "EQUITY", "timezone": "EDT", "gmtoffset": -14400, "dataGranularity": "1d",
+                    "range": "1y", "validRanges": ["1y"], "regularMarketPrice": close[-1], "priceHint": 2,
+                    "firstTradeDate": stamps[0], "exchangeName": "NMS", "regularMarketTime": stamps[-1],
+                    "currentTradingPeriod": {"pre": period, "regular": period, "post": period}}
+            quote = {"open": close, "high": close, "low": close, "close": close, "volume": [1000] * 250}
+            result = {"meta": meta, "timestamp": stamps, "indicators": {"quote": [quote], "adjclose": [{"adjclose": close}]}}
+            payload = json.dumps({"chart": {"result": [result], "error": None}}).encode()
+            self.send_response(200)
+        elif "getcrumb" in self.path:
+            payload = b"stand-in-crumb"
+            self.send_response(200)
+        else:
+            payload = b""
+            self.send_response(200)
+            self.send_header("Set-Cookie", "A3=stand-in; Path=/")
+
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class TestOfflineBacktest(unittest.TestCase):
+    def setUp(self):
+        """Set up a synthetic OHLCV frame so these tests run without network access"""
+        rng = np.random.default_rng(42)
+        close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, 500)))
+        self.df = pd.DataFrame({"open": close, "high": close * 1.01, "low": close * 0.99, "close": close,
+                                "volume": rng.integers(1_000, 10_000, 500)},
+                               index=pd.date_range("2020-01-01", periods=500, freq="D"))
+
+    def test_holding_state(self):
+        """Test the vectorised holding state transitions"""
+        buys = np.array([1, 0, 1, 1, 0, 0, 0, 1])
+        sells = np.array([1, 0, 0, 1, 1, 0, 1, 1])
+        expected = [1, 1, 1, 1, 0, 0, 0, 0]
+        self.assertEqual(list(holding_state(buys, sells)), expected, "Holding state should follow buy/sell events")
+
+    def test_generate_signals(self):
+        """Test the holding signal only changes on a buy or a sell"""
+        strategy = Strategy()
+        strategy.add_buy_signal("close < 95")
+        strategy.add_sell_signal("close > 105")
+        data = Backtest(strategy).generate_signals(self.df)
+        opens = (data["holding_signal"].diff() == 1) & (data["buy_signal"] == 0)
+        closes = (data["holding_signal"].diff() == -1) & (data["sell_signal"] == 0)
+        self.assertFalse(opens.any() or closes.any(), "Positions should only change on signals")
+
+    def test_simulate_trades(self):
+        """Test the array simulation including the forced exit on the last bar"""
+        close = np.array([10.0, 11.0, 12.0, 9.0, 10.0, 15.0])
+        holding = np.array([0, 1, 0, 0, 1, 1])
+        values, bah, trades, entries, exits = simulate_trades(close, holding, 1000)
+        self.assertEqual(list(entries), [1, 4], "Entries should be where the position opens")
+        self.assertEqual(list(exits), [2, 5], "Open positions should be closed on the last bar")
+        np.testing.assert_allclose(trades, [12 / 11 - 1, 0.5])
+        self.assertAlmostEqual(values[-1], 1000 * 12 / 11 * 1.5)
+        self.assertAlmostEqual(bah[-1], 1500)
+
+    def test_headless_and_downsampling(self):
+        """Test headless runs skip the figure and large figures are downsampled with LTTB"""
+        y = np.sin(np.linspace(0, 20, 10_000))
+        y[4321] = 5
+        kept = lttb(np.arange(10_000), y, 500)
+        self.assertEqual(len(kept), 500)
+        self.assertTrue(kept[0] == 0 and kept[-1] == 9_999 and 4321 in kept)
+        self.assertTrue((np.diff(kept) > 0).all())
+
+        strategy = Strategy()
+        strategy.add_buy_signal("close < 100")
+        strategy.add_sell_signal("close > 105")
+        backtest = Backtest(strategy)
+
+        headless = backtest.run_strategy(self.df, plot=False)
+        result = backtest.run_strategy(self.df, max_points=100)
+        self.assertIsNone(headless[5])
+        self.assertEqual(headless[:4], result[:4])
+        pd.testing.assert_frame_equal(headless[4], result[4])
+        self.assertLessEqual(len(result[5].data[0].x), 200)
+
+    def test_copy_free_signals(self):
+        """Test signals are generated from views of the data and compact dtypes are kept"""
+        helper = DataHelper(tickers=None, earnings=None, dtype=np.float32)
+        helper.load_data(self.df.astype({"volume": np.float64}))
+        helper.add_indicator("rsi_14", "rsi", 14)
+        self.assertEqual(helper.data["close"].dtype, np.float32)
+        self.assertEqual(helper.data["rsi_14"].dtype, np.float32)
+        self.assertEqual(helper.data["volume"].dtype, np.int64)
+
+        strategy = Strategy()
+        strategy.add_buy_signal("rsi_14 < 40")
+        strategy.add_sell_signal("rsi_14 > 60")
+        rows, columns, _, _, holding_signal = Backtest(strategy).signal_arrays(helper.data)
+        self.assertIsInstance(rows, slice, "The bars after the warm-up should be selected with a slice")
+        self.assertTrue(np.shares_memory(columns["rsi_14"], helper.data["rsi_14"].to_numpy()))
+        np.testing.assert_array_equal(holding_signal, Backtest(strategy).generate_signals(helper.data)["holding_signal"])
+
+    def test_backtest_result(self):
+        """Test the compact result matches the tuple layout and builds the data lazily"""
+        strategy = Strategy()
+        strategy.add_buy_signal("close < 100")
+        strategy.add_sell_signal("close > 105")
+        backtest = Backtest(strategy)
+
+        result = backtest.run_strategy(self.df)
+        compact = backtest.run_strategy(self.df, dtype=np.float32, pack_signals=True)
+        self.assertIsNone(compact._data, "The data should only be built when asked for")
+
+        final_val, pct_chg, num_trades, win_rate, data, fig = result
+        self.assertEqual((final_val, pct_chg, num_trades, win_rate), result[:4])
+        np.testing.assert_array_equal(data["holding_signal"], compact.holding_signal)
+        np.testing.assert_array_equal(data["buy_signal"], compact.data["buy_signal"])
+        self.assertEqual(compact.strategy_values.dtype, np.float32)
+        self.assertEqual(compact.num_trades, len(compact.entries))
+
+        # The data is rebuilt from the rows traded at run time, however the source changes afterwards
+        helper = DataHelper(tickers=None, earnings=None)
+        helper.load_data(self.df.copy())
+        later = backtest.run_strategy(helper.data, plot=False)
+        helper.add_indicator("sma_200", "sma", 200)
+        self.assertNotIn("sma_200", later.data.columns)
+        pd.testing.assert_frame_equal(later.data, data)
+
+    def test_instrumentation(self):
+        """Test each stage of run_strategy is recorded, passed to the callback and profiled"""
+        strategy = Strategy()
+        strategy.add_buy_signal("close < 100")
+        strategy.add_sell_signal("close > 105")
+
+        records = []
+        instrumentation = Instrumentation(callback=records.append, profile=True)
+        result = Backtest(strategy).run_strategy(self.df, instrumentation=instrumentation)
+        result.fig
+
+        self.assertEqual([record["stage"] for record in records], ["generate_signals", "simulate_trades", "figure"])
+        self.assertEqual(records[0]["rows"], len(result[4]))
+        self.assertTrue(all(record["seconds"] >= 0 for record in instrumentation.stages))
+        self.assertGreater(instrumentation.profile_stats.total_calls, 0)
+        self.assertIs(result.instrumentation, instrumentation)
+
+    def test_compile_condition(self):
+        """Test compiled conditions match DataFrame.eval and reject invalid conditions"""
+        for condition in ["close > open * 1.005 and volume < 5000", "close < 95 | close > 105 & volume > 2000",
+                          "not (close > 100)", "95 < close < 105"]:
+            expected = self.df.eval(condition).to_numpy()
+            np.testing.assert_array_equal(compile_condition(condition).evaluate(self.df), expected, condition)
+
+        for condition in ["close +", "close + open", "close.shift(1) > open"]:
+            with self.assertRaises(ValueError):
+                compile_condition(condition)
+
+        self.assertIs(compile_condition("close > 1"), compile_condition("close > 1"), "Compiled forms should be cached")
+
+        # The NumPy fallback, used without numexpr, broadcasts the columns whatever order they are stored in
+        columns = {"close": np.full((3, 4), 100.), "rsi_14": np.array([30., 50., 30., 50.])}
+        with mock.patch("conditions.numexpr", None):
+            signal = Condition("rsi_14 < 40 and close > 99").evaluate(columns)
+        np.testing.assert_array_equal(signal, np.broadcast_to([True, False, True, False], (3, 4)))
+
+        # Compact float32 columns give the same signals as DataFrame.eval with or without numexpr
+        helper = DataHelper(tickers=None, earnings=None, dtype=np.float32)
+        frame = self.df.assign(volume=self.df["volume"] + 0.5)
+        helper.load_data(frame)
+        self.assertEqual(frame["close"].dtype, np.float64, "The caller's frame should not be downcast")
+        self.assertEqual(helper.data["volume"].dtype, np.float64, "Fractional volume should not be cast to int64")
+        expected = helper.data.eval("close < 95.1 and volume > 2000").to_numpy()
+        for module in [conditions.numexpr, None]:
+            with mock.patch("conditions.numexpr", module):
+                signal = Condition("close < 95.1 and volume > 2000").evaluate(helper.data)
+            np.testing.assert_array_equal(signal, expected, f"numexpr={module}")
+
+    def test_llm_client(self):
+        """Test LLM responses are cached by normalised prompt and the download request skips the LLM"""
+        response = ('```json\n{"indicators": [{"name": "rsi_14", "indicator": "rsi", "args": 14}], "signals": '
+                    '[{"signal_type": "buy", "condition": "rsi_14 < 40"}, '
+                    '{"signal_type": "sell", "condition": "rsi_14 > 60"}]}\n```')
+        stand_in = StandInClient([response])
+
+        with tempfile.TemporaryDirectory() as root:
+            BacktestAI(client=CachedClient(stand_in, root)).create_strategy("Buy when RSI is below 40")
+            backtest_ai = BacktestAI(client=CachedClient(stand_in, root))
+            backtest_ai.create_strategy("buy when  RSI is below 40")
+
+        self.assertEqual(len(stand_in.prompts), 1, "The second strategy should come from the cache")
+        self.assertEqual(backtest_ai.indicators[0]["name"], "rsi_14")
+        self.assertEqual(len(backtest_ai.strategy.sells), 1)
+
+        self.assertEqual(parse_download_request("Download BRK-B for the past 2 years on a daily interval."),
+                         {"ticker": "BRK-B", "period": "2y", "interval": "1d"})
+        self.assertIsNone(parse_download_request("Download Microsoft since 2020"))
+        self.assertIsNone(parse_download_request("Download Microsoft for the past 2 years on a daily interval."),
+                          "Free text should go to the LLM rather than be read as a ticker")
+        self.assertIsNone(parse_download_request("download the S&P 500 for the past 2 years on a daily interval"))
+
+    def test_indicator_cache(self):
+        """Test indicators are served from the cache and the cache evicts the least recently used arrays"""
+        cache = IndicatorCache(max_bytes=3 * len(self.df) * 8)
+        lower = Indicators(self.df, cache, data_key="test").bollinger_band_lower(20)
+        self.assertEqual(len(cache), 3, "Rolling mean, std and the band should be cached")
+
+        upper = Indicators(self.df.copy(), cache, data_key="test").bollinger_band_upper(20)
+        self.assertEqual(len(cache), 3, "The oldest entry should be evicted")
+        np.testing.assert_allclose(((upper + lower) / 2).dropna(), self.df["close"].rolling(20).mean().dropna())
+
+        # Without a data key the close is hashed, cheap rolling means are not cached and other columns are not hashed
+        cache.clear()
+        Indicators(self.df, cache).sma(20)
+        self.assertEqual(len(cache), 0, "A rolling mean is cheaper to compute than to hash")
+        Indicators(self.df, cache).rsi(14)
+        Indicators(self.df.assign(volume=0), cache).rsi(14)
+        self.assertEqual(len(cache), 1, "The RSI should only be keyed on the close")
+
+    def test_on_balance_volume(self):
+        """Test the vectorised OBV against the running total and the path-dependent kernels"""
+        df = self.df.iloc[:50].copy()
+        df.loc[df.index[10], "close"] = df["close"].iloc[9]
+        obv = Indicators(df).on_balance_volume()
+
+        expected = [0]
+        for i in range(1, len(df)):
+            change = df["close"].iloc[i] - df["close"].iloc[i - 1]
+            expected.append(expected[-1] + np.sign(change) * df["volume"].iloc[i])
+        self.assertEqual(list(obv), expected, "OBV should match the running total")
+        self.assertTrue(obv.index.equals(df.index), "OBV should be aligned to the index")
+
+        close = self.df["close"].to_numpy()
+        self.assertTrue((trailing_stop(close, 0.05) < close).all(), "Trailing stops should be below the close")
+        self.assertEqual(Indicators(self.df).supertrend(10).iloc[:9].isna().sum(), 9, "SuperTrend needs an ATR")
+
+    def test_batched_indicators(self):
+        """Test the batched indicators against the single window methods and their registration as columns"""
+        df = self.df.copy()
+        df.loc[df.index[60], "close"] = np.nan
+        indicators = Indicators(df)
+        windows = [1, 2, 5, 14, 30]
+
+        sma, ema, rsi = indicators.sma_many(windows), indicators.ema_many(windows), indicators.rsi_many(windows)
+        lower, upper = indicators.bollinger_many(windows)
+        self.assertEqual(sma.shape, (len(df), len(windows)))
+        for j, window in enumerate(windows):
+            np.testing.assert_allclose(sma[:, j], indicators.sma(window), rtol=1e-12)
+            np.testing.assert_array_equal(ema[:, j], indicators.ema(window))
+            np.testing.assert_array_equal(rsi[:, j], indicators.rsi(window))
+            np.testing.assert_allclose(lower[:, j], indicators.bollinger_band_lower(window), rtol=1e-7)
+            np.testing.assert_allclose(upper[:, j], indicators.bollinger_band_upper(window), rtol=1e-7)
+
+        coms = (np.array(windows) - 1) / 2
+        np.testing.assert_array_equal(ewm_many(df["close"].to_numpy(), coms, False, np.zeros(len(windows), np.int64)),
+                                      ema.T, "The kernel should follow the pandas recursion")
+
+        helper = DataHelper(tickers=None, earnings=None)
+        helper.load_data(df)
+        helper.add_indicator("sma", "sma_many", [5, 20])
+        helper.add_indicator("bb", "bollinger_many", [20])
+        self.assertEqual(list(helper.data.columns[-4:]), ["sma_5", "sma_20", "bb_lower_20", "bb_upper_20"])
+        np.testing.assert_allclose(helper.data["sma_20"], indicators.sma(20), rtol=1e-12)
+        self.assertRaises(ValueError, indicators.sma_many, [0, 5])
+
+    def test_streaming_indicators(self):
+        """Test the streaming indicators match the batch indicators bar by bar"""
+        bars = self.df.to_dict("records")
+        indicators = Indicators(self.df)
+        for method, indicator in STREAMING_INDICATORS.items():
+            stream = indicator(14)
+            values = [stream.update(bar) for bar in bars]
+            np.testing.assert_array_equal(values, getattr(indicators, method)(14).to_numpy(dtype=float), method)
+
+        strategy = Strategy()
+        strategy.add_buy_signal("rsi_14 < 40")
+        strategy.add_sell_signal("rsi_14 > 60")
+        data = self.df.copy()
+        data["rsi_14"] = indicators.rsi(14)
+        expected = Backtest(strategy).generate_signals(data)["holding_signal"].iloc[-1]
+
+        stream = StreamingBacktest(strategy, [{"name": "rsi_14", "indicator": "rsi", "args": 14}])
+        holding = [stream.update(bar) for bar in bars]
+        self.assertIsNone(holding[0], "There is no holding state during warm-up")
+        self.assertEqual(holding[-1], expected, "The latest holding state should match generate_signals")
+
+        # Gaps in the closes decay the weights of the streaming means as they do in the batch indicators
+        gapped = self.df.copy()
+        gapped.loc[gapped.index[[30, 31, 90]], "close"] = np.nan
+        gapped_indicators = Indicators(gapped)
+        for method in ["ema", "macd"]:
+            gapped_stream = STREAMING_INDICATORS[method](14)
+            values = [gapped_stream.update(bar) for bar in gapped.to_dict("records")]
+            np.testing.assert_array_equal(values, getattr(gapped_indicators, method)(14).to_numpy(dtype=float), method)
+
+        # Missing values of any dtype leave the state unchanged
+        bar = dict(bars[-1], close=np.float32("nan"))
+        self.assertEqual(stream.update(bar), holding[-1], "A float32 NaN should count as missing")
+        self.assertRaises(TypeError, StreamingIndicator)
+
+    def test_ohlcv_store(self):
+        """Test the store only fetches missing bars and serves periods from disk"""
+        df = self.df.copy()
+        df.index = pd.date_range(end=pd.Timestamp.now(tz="America/New_York").normalize(), periods=len(df), freq="D")
+        requests = []
+
+        def fetch(ticker, interval, period=None, start=None):
+            requests.append(start)
+            return df.iloc[:-5] if start is None else df[df.index >= start]
+
+        with tempfile.TemporaryDirectory() as root:
+            store = OHLCVStore(root)
+            self.assertEqual(len(store.load("TEST", "1y", "1d", fetch)), 360, "The download should be stored")
+
+            store.append("TEST", "1d", fetch("TEST", "1d", start=store.last_timestamp("TEST", "1d")))
+            data = store.load("TEST", "6mo", "1d", fetch=None)
+            self.assertEqual(len(requests), 2, "A shorter period should be served offline")
+            self.assertTrue(data.index.equals(df.index[-len(data):]), "New bars should be appended")
+            np.testing.assert_array_equal(data["close"], df["close"].iloc[-len(data):])
+
+            # Frames already read keep their values when the stored bars are replaced or rewritten
+            closes = data["close"].to_numpy().copy()
+            store.append("TEST", "1d", fetch("TEST", "1d", start=df.index[-20]) * 2)
+            store.write("TEST", "1d", df.iloc[:10] * 0)
+            np.testing.assert_array_equal(data["close"], closes)
+
+    def test_ticker_reference(self):
+        """Test the SEC ticker list is downloaded once and then served from disk"""
+        payload = {"fields": ["cik", "name", "ticker", "exchange"],
+                   "data": [[320193, "Apple Inc.", "AAPL", "Nasdaq"], [789019, "MICROSOFT CORP", "MSFT", "Nasdaq"]]}
+        downloads = []
+
+        with tempfile.TemporaryDirectory() as root:
+            reference = TickerReference(path=f"{root}/tickers.json")
+            reference._download = lambda: downloads.append(1) or payload
+            self.assertEqual(reference.cik("AAPL"), "0000320193")
+            self.assertEqual(reference.companies()["Info"].iloc[1], "MSFT : MICROSOFT CORP")
+
+            reloaded = TickerReference(path=f"{root}/tickers.json")
+            self.assertEqual(reloaded.cik("MSFT"), "0000789019")
+            self.assertEqual(len(downloads), 1, "The list should be served from disk")
+
+    def test_earnings_calendar(self):
+        """Test earnings dates are merged on refresh and found with one searchsorted"""
+        recent = [{"filingDate": ["2020-01-10", "2020-01-03", "2020-01-04"], "form": ["10-Q", "10-K", "8-K"]},
+                  {"filingDate": ["2020-04-09"], "form": ["10-Q"]}]
+
+        with tempfile.TemporaryDirectory() as root:
+            calendar = EarningsCalendar(root, ttl=0)
+            calendar._download = lambda cik, etag=None: ({"filings": {"recent": recent.pop(0)}}, None)
+            calendar.dates("0000000001")
+
+            reloaded = EarningsCalendar(root, ttl=0)
+            reloaded._download = calendar._download
+            dates = reloaded.dates("0000000001")
+            self.assertEqual([str(date.date()) for date in dates], ["2020-01-03", "2020-01-10", "2020-04-09"],
+                             "Older filings should be kept on refresh")
+
+        index = pd.date_range("2020-01-01", periods=120, freq="D", tz="America/New_York")
+        expected = [self.helper_next_earnings(date, dates) for date in index]
+        np.testing.assert_array_equal(next_earnings(index, dates), np.array(expected, dtype="datetime64[D]"))
+
+    @staticmethod
+    def helper_next_earnings(date, earnings_dates):
+        earnings_dates = sorted(date.date() for date in earnings_dates)
+        day = date.tz_convert(None).date()
+        upcoming = [earnings for earnings in earnings_dates if earnings >= day]
+        return upcoming[0] if upcoming else earnings_dates[-1] + pd.Timedelta(days=90)
+
+    def test_load_many(self):
+        """Test grouped downloads through the pooled session against a local stand-in"""
+        server = ThreadingHTTPServer(("127.0.0.1", 0), YahooStandIn)
+        server.requests = 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        try:
+            sessions = SessionPool(backend="memory", requests_per_5s=1000,
+                                   base_url=f"http://127.0.0.1:{server.server_port}")
+            helper = DataHelper(sessions=sessions)
+            frames = helper.load_many(["AAA", "BBB", "CCC"], "1y", "1d", chunk_size=2)
+
+            self.assertEqual(sorted(frames), ["AAA", "BBB", "CCC"], "Every ticker should be loaded")
+            self.assertTrue(frames["AAA"].index.equals(frames["CCC"].index), "Frames should be aligned")
+            self.assertEqual(len(frames["BBB"]), 250)
+            self.assertIs(sessions.get(), helper.sessions.get(), "The session should be shared")
+        finally:
+            server.shutdown()
+            sessions.close()
+
+        # Tickers with stored history are downloaded together from the earliest of their last stored bars
+        downloads = []
+        df = self.df.tz_localize("UTC")
+
+        class CountingHelper(DataHelper):
+            def _download_many(self, tickers, interval, period=None, start=None, threads=8):
+                downloads.append((sorted(tickers), period, start))
+                return {ticker: df[df.index >= start] if start is not None else df for ticker in tickers}
+
+        with tempfile.TemporaryDirectory() as root:
+            store = OHLCVStore(root)
+            for ticker, rows in [("AAA", 400), ("BBB", 450)]:
+                store.write(ticker, "1d", df.iloc[:rows])
+                store._write_meta(ticker, "1d", dict(store._read_meta(ticker, "1d"), fetched_at=0))
+
+            frames = CountingHelper(store=store).load_many(["AAA", "BBB", "CCC"], "max", "1d")
+
+        self.assertEqual(downloads, [(["CCC"], "max", None), (["AAA", "BBB"], None, df.index[399])])
+        self.assertTrue(all(len(frame) == len(df) for frame in frames.values()), "Stale tickers should be appended")
+
+    def test_concurrent_pipeline(self):
+        """Test the concurrent pipeline overlaps the downloads and matches the sequential run"""
+        df = self.df.tz_localize("America/New_York")
+
+        class SlowHelper(DataHelper):
+            def _download(self, ticker, interval, period=None, start=None):
+                time.sleep(0.4)
+                return df.copy()
+
+        class SlowTickers:
+            def companies(self):
+                return None
+
+            def cik(self, ticker):
+                return "0000000001"
+
+        class SlowEarnings:
+            def dates(self, cik):
+                time.sleep(0.4)
+                return list(pd.date_range("2019-11-15", periods=8, freq="91D"))
+
+        strategy = {"indicators": [{"name": "rsi_14", "indicator": "rsi", "args": 14}],
+                    "signals": [{"signal_type": "buy", "condition": "rsi_14 < 40 and days_to_earnings > 10"},
+                                {"signal_type": "sell", "condition": "rsi_14 > 60"}]}
+        backtest_ai = BacktestAI(client=StandInClient(lambda prompt: strategy),
+                                 data_helper=lambda: SlowHelper(tickers=SlowTickers(), earnings=SlowEarnings()))
+        backtest_ai.create_strategy("Buy when RSI is below 40 away from earnings")
+
+        message = "Download TEST for the past 2 years on a daily interval."
+        start = time.perf_counter()
+        sequential = backtest_ai.run_strategy(message, plot=False)
+        sequential_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        concurrent = backtest_ai.run_strategy(message, plot=False, concurrent=True)
+        concurrent_seconds = time.perf_counter() - start
+
+        self.assertEqual(sequential[:4], concurrent[:4])
+        pd.testing.assert_frame_equal(sequential.data, concurrent.data)
+        self.assertLess(concurrent_seconds, sequential_seconds - 0.2, "The downloads should overlap")
+
+    def test_backtest_cache(self):
+        """Test shorter periods are sliced from stored data and results are reused"""
+        df = self.df.copy()
+        df.index = pd.date_range(end=pd.Timestamp.now(tz="America/New_York").normalize(), periods=len(df), freq="D")
+        downloads = []
+
+        class CountingHelper(DataHelper):
+            def _download(self, ticker, interval, period=None, start=None):
+                downloads.append(period)
+                return df.copy()
+
+        class FixedEarnings:
+            def dates(self, cik):
+                return list(pd.date_range(df.index[0].tz_localize(None), periods=8, freq="91D"))
+
+        class FixedTickers:
+            def cik(self, ticker):
+                return "0000000001"
+
+        strategy = {"indicators": [{"name": "rsi_14", "indicator": "rsi", "args": 14}],
+                    "signals": [{"signal_type": "buy", "condition": "rsi_14 < 40"},
+                                {"signal_type": "sell", "condition": "rsi_14 > 60"}]}
+
+        with tempfile.TemporaryDirectory() as root:
+            cache = BacktestCache(OHLCVStore(root), data_helper=lambda store: CountingHelper(
+                store=store, tickers=FixedTickers(), earnings=FixedEarnings()))
+            backtest_ai = BacktestAI(client=StandInClient(lambda prompt: strategy), data_helper=cache.data_helper)
+            backtest_ai.create_strategy("Buy when RSI is below 40")
+
+            cache.run(backtest_ai, "Download TEST for the past 1 year on a daily interval.", plot=False)
+            result = cache.run(backtest_ai, "Download TEST for the past 6 months on a daily interval.", plot=False)
+            again = cache.run(backtest_ai, "Download TEST for the past 6 months on a daily interval.", plot=False)
+            fewer_points = cache.run(backtest_ai, "Download TEST for the past 6 months on a daily interval.",
+                                     plot=False, max_points=100)
+
+            cache.ttl = pd.Timedelta(0)
+            expired = cache.run(backtest_ai, "Download TEST for the past 6 months on a daily interval.", plot=False)
+
+        self.assertEqual(downloads, ["1y"], "The shorter period should be sliced from the stored data")
+        self.assertIs(result, again, "The result should be reused")
+        self.assertIsNot(result, fewer_points, "Arguments changing the result should be part of the key")
+        self.assertIsNot(result, expired, "Results should be rerun once they expire")
+
+        failing = BacktestAI(client=StandInClient(lambda prompt: strategy), data_helper=cache.data_helper)
+        failing.create_strategy("Buy when RSI is below 40")
+        failing.run_strategy = lambda message, **kwargs: 1 / 0
+        self.assertRaises(ZeroDivisionError, cache.run, failing, "Download TEST for the past 1 year on a daily interval.")
+        self.assertEqual(cache._running, {}, "A failed run should not leave its lock behind")
+        self.assertLess(len(result.dates), 190)
+
+    def test_benchmark(self):
+        """Test the synthetic data is reproducible and the benchmarks record time and memory"""
+        df = synthetic_ohlcv(1_000, interval="1d", seed=7)
+        pd.testing.assert_frame_equal(df, synthetic_ohlcv(1_000, interval="1d", seed=7))
+        self.assertTrue((df["high"] >= df[["open", "close"]].max(axis=1)).all())
+        self.assertTrue((df["low"] <= df[["open", "close"]].min(axis=1)).all())
+
+        results = run_benchmarks([500], interval="1d", only="Backtest.generate_signals")["results"]
+        self.assertEqual([(result["name"], result["bars"]) for result in results], [("Backtest.generate_signals", 500)])
+        self.assertGreater(results[0]["peak_bytes"], 0)
+
+    def test_scan(self):
+        """Test a strategy is scanned over every ticker with failures isolated"""
+        strategy = Strategy()
+        strategy.add_buy_signal("rsi_14 < 40")
+        strategy.add_sell_signal("rsi_14 > 60")
+        scan = Scan(strategy, [{"name": "rsi_14", "indicator": "rsi", "args": 14}])
+
+        with tempfile.TemporaryDirectory() as root:
+            store = OHLCVStore(root)
+            end = pd.Timestamp.now(tz="America/New_York").normalize()
+            for seed in range(3):
+                store.write(f"T{seed}", "1d", synthetic_ohlcv(400, interval="1d", seed=seed,
+                                                               start=end - pd.Timedelta(days=399)))
+
+            streamed = []
+            results = scan.run(["T0", "T1", "MISSING", "T2"], period="1y", store=store, download=False, processes=2,
+                               callback=streamed.append)
+
+            # In-process scans leave the caller's indicator cache as it is
+            Indicators(self.df, data_key="caller").rsi(14)
+            max_bytes = indicator_cache.max_bytes
+            scan.run(["T0"], period="1y", store=store, download=False, processes=1)
+            self.assertIn(("caller", "rsi", 14), indicator_cache, "The caller's cached indicators should be kept")
+            self.assertEqual(indicator_cache.max_bytes, max_bytes)
+
+            helper = DataHelper()
+            helper.load_data(store.read("T1", "1d", "1y"))
+            helper.add_indicator("rsi_14", "rsi", 14)
+            expected = Backtest(strategy).run_strategy(helper.data, plot=False)
+
+        self.assertEqual(len(streamed), 4, "Each ticker should be streamed as it finishes")
+        self.assertEqual(results["ticker"].iloc[-1], "MISSING", "Failed tickers should be ranked last")
+        self.assertIn("MISSING", results["error"].iloc[-1])
+        self.assertTrue(results["error"].iloc[:3].isna().all())
+        self.assertAlmostEqual(results.set_index("ticker").loc["T1", "final_val"], expected.final_val)
+
+    def test_sweep(self):
+        """Test the sweep ranks combinations with the same metrics as a single backtest"""
+        sweep = Sweep(["sma_{n} < close"], ["sma_{n} > close"], [{"name": "sma_{n}", "indicator": "sma", "args": "{n}"}],
+                      {"n": [5, 10, 20]})
+        results = sweep.run(self.df, processes=1)
+        self.assertEqual(len(results), 3, "Every combination should be tested")
+
+        best = int(results["n"].iloc[0])
+        data = self.df.copy()
+        data[f"sma_{best}"] = Indicators(data).sma(best)
+        strategy = Strategy()
+        strategy.add_buy_signal(f"sma_{best} < close")
+        strategy.add_sell_signal(f"sma_{best} > close")
+        final_val = Backtest(strategy).run_strategy(data)[0]
+        self.assertEqual(results["final_val"].iloc[0], final_val, "Sweep should match the backtest")
+
+        # A failing in-process run still detaches from the shared block and removes it
+        with mock.patch("sweep._init_worker", wraps=sweep_module._init_worker) as init_worker, \
+                mock.patch("sweep.simulate_trades", side_effect=RuntimeError("failed")):
+            with self.assertRaisesRegex(RuntimeError, "failed"):
+                sweep.run(self.df, processes=1)
+        self.assertIsNone(sweep_module._SHARED)
+        with self.assertRaises(FileNotFoundError, msg="The shared block should be unlinked"):
+            shared_memory.SharedMemory(name=init_worker.call_args.args[0])
+
+    def test_walk_forward(self):
+        """Test each test window trades the combination chosen on its train window, stitched into one equity curve"""
+        walk_forward = WalkForward(["sma_{n} < close"], ["sma_{n} > close"],
+                                   [{"name": "sma_{n}", "indicator": "sma", "args": "{n}"}], {"n": [5, 10, 20]})
+        summary, equity = walk_forward.run(self.df, train=200, test=50, processes=1)
+        self.assertEqual(len(summary), 6, "The 300 bars after the first train window should make 6 test windows")
+        self.assertEqual(equity.index[0], self.df.index[200])
+
+        window = summary.iloc[2]
+        data = self.df.copy()
+        data[f"sma_{window['n']}"] = Indicators(data).sma(int(window["n"]))
+        strategy = Strategy()
+        strategy.add_buy_signal(f"sma_{window['n']} < close")
+        strategy.add_sell_signal(f"sma_{window['n']} > close")
+        result = Backtest(strategy).run_strategy(data.loc[window["test_start"]:window["test_end"]], plot=False)
+        self.assertAlmostEqual(window["final_val"], result.final_val, msg="The test window should match a backtest")
+
+        growth = summary["final_val"].prod() / 1000 ** len(summary)
+        self.assertAlmostEqual(equity.iloc[-1], 1000 * growth, msg="The windows should compound into the equity curve")
+
+        for train, test in [(200, 0), (0, 50), ("2y", "0mo")]:
+            with self.assertRaises(ValueError, msg="Empty windows would never advance"):
+                walk_forward.windows(self.df.index, train, test)
+
+        with mock.patch("sweep._init_worker", wraps=sweep_module._init_worker) as init_worker, \
+                mock.patch("walkforward._run_window", side_effect=RuntimeError("failed")):
+            with self.assertRaisesRegex(RuntimeError, "failed"):
+                walk_forward.run(self.df, train=200, test=50, processes=1)
+        self.assertIsNone(sweep_module._SHARED, "A failing in-process run should still detach from the shared block")
+        with self.assertRaises(FileNotFoundError, msg="The shared block should be unlinked"):
+            shared_memory.SharedMemory(name=init_worker.call_args.args[0])
+
+    def test_monte_carlo(self):
+        """Test the resampled paths keep the result's trades and match it when nothing is resampled"""
+        strategy = Strategy()
+        strategy.add_buy_signal("close < 100")
+        strategy.add_sell_signal("close > 105")
+        backtest = Backtest(strategy)
+        result = backtest.run_strategy(self.df, plot=False)
+        monte_carlo = MonteCarlo(result, n_paths=250, chunk_size=100)
+
+        shuffles = monte_carlo.paths("shuffle")
+        self.assertEqual(shuffles.shape, (250, result.num_trades + 1))
+        np.testing.assert_allclose(shuffles[:, -1], result.final_val, err_msg="Shuffles should keep the final value")
+
+        noiseless = monte_carlo.paths("noise", backtest=backtest, df=self.df, noise=0)
+        np.testing.assert_allclose(noiseless, np.broadcast_to(result.strategy_values, noiseless.shape))
+
+        _, _, buy_signal, sell_signal, holding_signal = backtest.signal_arrays(self.df)
+        np.testing.assert_array_equal(holding_states(buy_signal[None], sell_signal[None])[0], holding_signal)
+
+        # Indicators are recomputed from each noisy close, so the conditions on them need the indicators to be given
+        rsi_strategy = Strategy()
+        rsi_strategy.add_buy_signal("rsi_14 < 40")
+        rsi_strategy.add_sell_signal("rsi_14 > 60")
+        data = self.df.assign(rsi_14=Indicators(self.df).rsi(14))
+        rsi_backtest = Backtest(rsi_strategy)
+        rsi_result = rsi_backtest.run_strategy(data, plot=False)
+        rsi_monte_carlo = MonteCarlo(rsi_result, n_paths=20, chunk_size=8)
+        with self.assertRaises(ValueError, msg="Indicators computed from the close should not be reused"):
+            rsi_monte_carlo.paths("noise", backtest=rsi_backtest, df=data)
+        indicators = [{"name": "rsi_14", "indicator": "rsi", "args": 14}]
+        noiseless = rsi_monte_carlo.paths("noise", backtest=rsi_backtest, df=data, noise=0, indicators=indicators)
+        np.testing.assert_allclose(noiseless, np.broadcast_to(rsi_result.strategy_values, noiseless.shape))
+        noisy = rsi_monte_carlo.paths("noise", backtest=rsi_backtest, df=data, noise=0.05, indicators=indicators)
+        self.assertFalse(np.allclose(noisy, noisy[0]), "Each path should trade on its own indicators")
+        with mock.patch("robustness._PATH_INDICATORS", set()):
+            per_path = rsi_monte_carlo.paths("noise", backtest=rsi_backtest, df=data, noise=0.05,
+                                             indicators=indicators)
+        np.testing.assert_array_equal(noisy, per_path, err_msg="A chunk's indicators should match each path's own")
+
+        intervals = monte_carlo.confidence_intervals("bootstrap", block_size=10)
+        self.assertEqual(list(intervals.index), ["return", "max_drawdown"])
+        self.assertTrue((intervals[0.05] <= intervals[0.95]).all())
+        self.assertAlmostEqual(intervals.loc["return", "observed"], result.pct_chg)
+
+    def test_portfolio(self):
+        """Test the portfolio matches a single backtest for one ticker and splits the capital between tickers"""
+        strategy = Strategy()
+        strategy.add_buy_signal("rsi_14 < 40")
+        strategy.add_sell_signal("rsi_14 > 60")
+        indicators = [{"name": "rsi_14", "indicator": "rsi", "args": 14}]
+
+        data = self.df.copy()
+        data["rsi_14"] = Indicators(data).rsi(14)
+        single = Backtest(strategy).run_strategy(data, plot=False)
+        result = Portfolio(strategy, indicators).run({"T1": self.df})
+        self.assertAlmostEqual(result.final_val, single.final_val, msg="One ticker should match run_strategy")
+        self.assertEqual(result.num_trades, single.num_trades)
+
+        frames = {"T1": self.df, "T2": self.df.iloc[100:] * 1.5, "T3": self.df.iloc[::-1].set_index(self.df.index)}
+        equal = Portfolio(strategy, indicators).run(frames).holdings()
+        capped = Portfolio(strategy, indicators, weighting="capped", max_weight=0.4).run(frames).holdings()
+        self.assertEqual(list(equal.columns), ["T1", "T2", "T3"])
+        self.assertTrue((equal["T2"].iloc[:100] == 0).all(), "Tickers should not be held before their first bar")
+        self.assertTrue(np.allclose(equal.sum(axis=1)[equal.sum(axis=1) > 0], 1), "Equal weights should be fully invested")
+        self.assertLessEqual(capped.max().max(), 0.4)
+
+        # A missing bar neither closes a position nor closes it on the bar before, it is held flat across the gap
+        full = Portfolio(strategy, indicators).run({"T1": self.df, "T2": self.df}).holdings()["T2"].to_numpy()
+        held = np.flatnonzero((full[:-3] > 0) & (full[1:-2] > 0) & (full[2:-1] > 0) & (full[3:] > 0))[0]
+        frames = {"T1": self.df, "T2": self.df.drop(self.df.index[held + 1:held + 3])}
+        gapped = Portfolio(strategy, indicators).run(frames).holdings()["T2"]
+        self.assertTrue((gapped.iloc[held:held + 3] > 0).all(), "The gap should not close the position")
+
+    def test_resampling_pyramid(self):
+        """Test higher interval indicators are built from the cached pyramid and aligned without look-ahead"""
+        bars = synthetic_ohlcv(288 * 30, interval="5m", start="2024-01-02 09:30")
+        bars = bars[(bars.index.hour * 60 + bars.index.minute).isin(range(570, 960)) & (bars.index.dayofweek < 5)]
+
+        helper = DataHelper(tickers=None, earnings=None)
+        helper.load_data(bars.copy())
+        helper.add_indicator("sma_20_1h", "sma", 20, interval="1h")
+        helper.add_indicator("rsi_5_1d", "rsi", 5, interval="1d")
+        self.assertEqual(helper.base_interval(), "5m")
+        self.assertIs(helper.resampled("1d"), helper.resampled("1d"), "Each level should be built once")
+
+        daily = bars.resample("1D").agg({"open": "first", "high": "max", "low": "min", "close": "last",
+                                         "volume": "sum"}).dropna(subset=["close"])
+        pd.testing.assert_frame_equal(helper.resampled("1d"), daily, check_freq=False)
+
+        # The daily value only reaches the bars of a day on its last bar, earlier bars see the day before
+        rsi = Indicators(daily).rsi(5)
+        day = helper.data.loc[helper.data.index.normalize() == daily.index[10], "rsi_5_1d"]
+        self.assertEqual(day.iloc[-1], rsi.iloc[10])
+        self.assertTrue((day.iloc[:-1] == rsi.iloc[9]).all(), "Bars within a day should not see its close")
+
+        strategy = Strategy()
+        strategy.add_buy_signal("rsi_5_1d < 50 and close > sma_20_1h")
+        strategy.add_sell_signal("rsi_5_1d > 60")
+        self.assertGreater(Backtest(strategy).run_strategy(helper.data, plot=False).num_trades, 0)
+        self.assertRaises(ValueError, helper.resampled, "1m")
+
+        # Aliases of the same interval share one level, and an alias of the loaded interval is the loaded data
+        self.assertIs(helper.resampled("60m"), helper.resampled("1h"))
+        hourly = DataHelper(tickers=None, earnings=None)
+        hourly.load_data(helper.resampled("1h").copy(), interval="60m")
+        self.assertEqual(hourly.base_interval(), "1h")
+        hourly.add_indicator("sma_5_1h", "sma", 5, interval="1h")
+        pd.testing.assert_series_equal(hourly.data["sma_5_1h"], Indicators(hourly.data).sma(5), check_names=False)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,131 @@
+# Class for the SEC ticker reference data
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+import requests
+
+
+SEC_TICKERS_URL = "https://www.sec.gov/files/company_tickers_exchange.json"
+SEC_HEADERS = {"User-Agent": "YourName (your@email.com)", "Accept-Encoding": "gzip, deflate"}
+
+
+class TickerReference:
+
+    def __init__(self, path: str = "sec_tickers.json", ttl: float = 24 * 60 * 60, url: str = SEC_TICKERS_URL):
+        """
+        Ticker to CIK reference built from the SEC exchange list. The list is downloaded once, persisted to disk and
+        served from memory, with a background refresh once it is older than the TTL.
+        :param path: The file the list is persisted to
+        :param ttl: The number of seconds before the list is refreshed
+        :param url: The URL of the SEC exchange list
+        """
+        self.path = path
+        self.ttl = ttl
+        self.url = url
+
+        self.fetched_at = None
+        self._ciks = None
+        self._companies = None
+        self._lock = threading.Lock()
+        self._refreshing = None
+
+    def _download(self):
+        """
+        :return dict: The SEC exchange list with its fields and rows
+        """
+        response = requests.get(self.url, headers=SEC_HEADERS)
+        response.raise_for_status()
+
+        return response.json()
+
+    def _index(self, payload: dict, fetched_at: float):
+        """
+        Builds the in-memory lookups from the SEC exchange list
+        """
+        companies = pd.DataFrame(payload["data"], columns=["CIK", "Company Name", "Ticker", "Exchange"])
+        companies["Info"] = companies["Ticker"] + " : " + companies["Company Name"]
+
+        ciks = {row[2]: str(row[0]).zfill(10) for row in payload["data"]}
+
+        with self._lock:
+            self._companies = companies
+            self._ciks = ciks
+            self.fetched_at = fetched_at
+
+    def refresh(self):
+        """
+        Downloads the SEC exchange list and persists it to disk
+        """
+        payload = self._download()
+        fetched_at = time.time()
+
+        if self.path is not None:
+            with open(self.path + ".tmp", "w") as f:
+                json.dump({"fetched_at": fetched_at, "fields": payload["fields"], "data": payload["data"]}, f,
+                          separators=(",", ":"))
+            os.replace(self.path + ".tmp", self.path)
+
+        self._index(payload, fetched_at)
+
+    def _refresh_in_background(self):
+        """
+        Refreshes the list on a background thread, unless a refresh is already running
+        """
+        with self._lock:
+            if self._refreshing is not None and self._refreshing.is_alive():
+                return
+
+            self._refreshing = threading.Thread(target=self._background_refresh, daemon=True)
+            self._refreshing.start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"The SEC ticker list could not be refreshed: {e}")
+
+    def _ensure_loaded(self):
+        """
+        Loads the list from memory, then disk, then the SEC, refreshing in the background when it is stale
+        """
+        if self._ciks is None and self.path is not None and os.path.exists(self.path):
+            with open(self.path) as f:
+                payload = json.load(f)
+            self._index(payload, payload["fetched_at"])
+
+        if self._ciks is None:
+            self.refresh()
+        elif time.time() - self.fetched_at > self.ttl:
+            self._refresh_in_background()
+
+    def cik(self, ticker: str):
+        """
+        :param ticker: The ticker of interest
+        :return str: The CIK code of the ticker
+        """
+        self._ensure_loaded()
+        return self._ciks[ticker]
+
+    def companies(self):
+        """
+        :return: DataFrame of the CIK, Company Name, Ticker, Exchange and "Ticker : Company Name" Info of every company
+        """
+        self._ensure_loaded()
+        return self._companies
+
+    def tickers(self, exchange: str = None):
+        """
+        :param exchange: Optional exchange to filter on, e.g. "NYSE" or "Nasdaq"
+        :return list: The tickers on the exchange, or every ticker
+        """
+        companies = self.companies()
+        if exchange is not None:
+            companies = companies[companies["Exchange"] == exchange]
+
+        return companies["Ticker"].tolist()
+
+
+ticker_reference = TickerReference()
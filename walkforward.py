@@ -0,0 +1,180 @@
+# Class for walk-forward analysis
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+import sweep
+from datastore import period_offset
+from sweep import Sweep
+
+# The combinations and ranking of the walk-forward, set in each worker process by _init_worker
+_COMBINATIONS = []
+_SORT_BY = "pct_chg"
+
+
+def _init_worker(init_args: tuple, combinations: list, sort_by: str):
+    """
+    Attaches a worker process to the sweep's shared arrays and keeps the combinations every window chooses from
+    """
+    global _COMBINATIONS, _SORT_BY
+
+    sweep._init_worker(*init_args)
+    _COMBINATIONS = combinations
+    _SORT_BY = sort_by
+
+
+def _release_worker():
+    global _COMBINATIONS
+
+    sweep._release_worker()
+    _COMBINATIONS = []
+
+
+def _run_window(window: dict):
+    """
+    Selects the best combination on the train slice of the shared arrays and evaluates it on the test slice
+    :return dict: The window with the chosen parameters, their train and test metrics, and the test strategy values
+    with the bar positions they belong to
+    """
+    train = slice(window["train_start"], window["test_start"])
+    test = slice(window["test_start"], window["test_end"])
+
+    # The first best combination wins ties, combinations without a valid row rank last
+    scores = [sweep._simulate(combination, train)[0][_SORT_BY] for combination in _COMBINATIONS]
+    scores = np.where(np.isnan(scores), -np.inf, scores)
+    best = _COMBINATIONS[int(np.argmax(scores))]
+
+    metrics, strategy_values, valid = sweep._simulate(best, test)
+
+    train_score = scores.max() if np.isfinite(scores.max()) else np.nan
+
+    return dict(window, params=best["params"], train_score=train_score, metrics=metrics,
+                strategy_values=strategy_values, positions=np.flatnonzero(valid) + window["test_start"])
+
+
+def _advance(index: pd.DatetimeIndex, position: int, length):
+    """
+    :param length: A number of bars, or a Yahoo Finance period such as "1mo"
+    :return int: The position of the first bar at least length after the bar at position
+    """
+    if isinstance(length, (int, np.integer)):
+        return position + int(length)
+
+    return int(index.searchsorted(index[position] + period_offset(length)))
+
+
+def _retreat(index: pd.DatetimeIndex, position: int, length):
+    """
+    :param length: A number of bars, or a Yahoo Finance period such as "2y"
+    :return int: The position of the first bar within length before the bar at position
+    """
+    if isinstance(length, (int, np.integer)):
+        return max(0, position - int(length))
+
+    return int(index.searchsorted(index[position] - period_offset(length)))
+
+
+def _check_length(length, name: str):
+    """
+    :raises ValueError: If the window length is not a positive number of bars or a period of a positive length
+    """
+    if isinstance(length, (int, np.integer)):
+        positive = length > 0
+    else:
+        positive = pd.Timestamp(0) + period_offset(length) > pd.Timestamp(0)
+
+    if not positive:
+        raise ValueError(f"The {name} window must be longer than zero, not {length!r}.")
+
+
+class WalkForward(Sweep):
+
+    def windows(self, index: pd.DatetimeIndex, train="2y", test="1mo", anchored: bool = False):
+        """
+        :param index: The index of the data
+        :param train: The length of each train window, a number of bars or a Yahoo Finance period such as "2y"
+        :param test: The length of each test window, which is also the step between windows, e.g. "1mo"
+        :param anchored: Whether every train window starts on the first bar, rather than rolling with the test window
+        :return list: Dicts of the train_start, test_start and test_end bar positions of each window, the train window
+        ends where its test window starts
+        """
+        _check_length(train, "train")
+        _check_length(test, "test")
+
+        windows = []
+
+        test_start = _advance(index, 0, train) if len(index) else 0
+        while test_start < len(index):
+            test_end = min(_advance(index, test_start, test), len(index))
+            if test_end <= test_start:
+                raise ValueError(f"The test window at bar {test_start} does not advance, the index may not be sorted.")
+            train_start = 0 if anchored else _retreat(index, test_start, train)
+
+            windows.append({"train_start": train_start, "test_start": test_start, "test_end": test_end})
+            test_start = test_end
+
+        return windows
+
+    def run(self, df: pd.DataFrame, train="2y", test="1mo", anchored: bool = False, processes: int = None,
+            sort_by: str = "pct_chg"):
+        """
+        Selects the best combination on each train window and trades it on the following test window. The indicators
+        are computed once over the full history, so each window is a slice of the shared arrays
+        :param df: The data with Datetime index and OHLC format, as loaded by DataHelper
+        :param train: The length of each train window, a number of bars or a Yahoo Finance period such as "2y"
+        :param test: The length of each test window, which is also the step between windows, e.g. "1mo"
+        :param anchored: Whether every train window starts on the first bar, rather than rolling with the test window
+        :param processes: The number of worker processes the windows are shared between, defaults to the number of
+        CPUs. Use 1 to run in-process
+        :param sort_by: The train metric the combinations are chosen on
+        :return: Tuple of a DataFrame with the dates, chosen parameters and test metrics of each window, and the
+        out-of-sample equity Series stitched from the test windows, starting from 1000
+        """
+        print("Running walk-forward...")
+
+        windows = self.windows(df.index, train, test, anchored)
+        combinations = self.combinations()
+        indicators = self._compute_indicators(df, combinations)
+        jobs = self._jobs(combinations)
+
+        with self._shared(df, indicators) as init_args:
+            processes = processes or os.cpu_count()
+
+            if processes == 1:
+                try:
+                    _init_worker(init_args, jobs, sort_by)
+                    results = [_run_window(window) for window in windows]
+                finally:
+                    _release_worker()
+            else:
+                with Pool(processes, initializer=_init_worker, initargs=(init_args, jobs, sort_by)) as pool:
+                    results = pool.map(_run_window, windows, chunksize=1)
+
+        # Each test window starts from 1000, so it is scaled to the capital the previous windows ended with
+        capital = 1000
+        rows, curves, positions = [], [], []
+        for result in results:
+            metrics = result["metrics"]
+            if result["strategy_values"] is not None:
+                curves.append(result["strategy_values"] * (capital / 1000))
+                positions.append(result["positions"])
+                capital = curves[-1][-1]
+
+            rows.append(dict(result["params"],
+                             train_start=df.index[result["train_start"]],
+                             test_start=df.index[result["test_start"]],
+                             test_end=df.index[result["test_end"] - 1],
+                             train_score=result["train_score"],
+                             final_val=metrics["final_val"], pct_chg=metrics["pct_chg"],
+                             num_trades=metrics["num_trades"], win_rate=metrics["win_rate"]))
+
+        summary = pd.DataFrame(rows)
+        equity = pd.Series(np.concatenate(curves) if curves else np.zeros(0),
+                           index=df.index[np.concatenate(positions)] if positions else df.index[:0], name="equity")
+
+        print(f"Walk-forward complete: {len(windows)} windows tested, "
+              f"out-of-sample return {(capital / 1000 - 1) * 100:.2f}%.")
+
+        return summary, equity